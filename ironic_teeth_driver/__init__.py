@@ -14,13 +14,38 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from ironic.drivers import base
-from ironic.drivers.modules import ipmitool
-from ironic_teeth_driver import teeth
-from ironic_teeth_driver import vendor
+from ironic.openstack.common import importutils
+
+
+class _LazyInterface(object):
+    """Driver interface built the first time it is accessed.
+
+    Ironic constructs every enabled driver when its services start, so
+    importing and building the interfaces eagerly makes startup pay for
+    ipmitool, the REST client and the HTTP stack even in processes which
+    never use them.
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.module, self.cls = path.rsplit('.', 1)
+
+    def __get__(self, driver, owner):
+        if driver is None:
+            return self
+        module = importutils.import_module(self.module)
+        interface = getattr(module, self.cls)()
+        # Shadows this descriptor, so later accesses are plain lookups.
+        setattr(driver, self.name, interface)
+        return interface
 
 
 class TeethDriver(base.BaseDriver):
+    power = _LazyInterface('power',
+                           'ironic_teeth_driver.power.CachedPower')
+    deploy = _LazyInterface('deploy',
+                            'ironic_teeth_driver.teeth.TeethDeploy')
+    vendor = _LazyInterface('vendor',
+                            'ironic_teeth_driver.vendor.TeethVendorInterface')
+
     def __init__(self):
-        self.power = ipmitool.IPMIPower()
-        self.deploy = teeth.TeethDeploy()
-        self.vendor = vendor.TeethVendorInterface()
+        pass
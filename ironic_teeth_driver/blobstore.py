@@ -0,0 +1,215 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import contextlib
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+
+from oslo.config import cfg
+
+from ironic.common import exception
+
+blobstore_opts = [
+    cfg.StrOpt('blob_store_dir',
+               default='/var/lib/ironic/teeth/blobs',
+               help='Directory of the content-addressed store holding large '
+                    'instance files. When running several conductors it '
+                    'should be on storage they all share.'),
+    cfg.IntOpt('blob_inline_max_size',
+               default=4096,
+               help='Instance files up to this many bytes are sent to the '
+                    'agent inline, larger ones are moved to the blob store '
+                    'and fetched by the agent when needed.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(blobstore_opts, group='teeth_driver')
+
+# One lock per first byte of the digest, see BlobStore._locked.
+_LOCKS = [threading.Lock() for _ in range(256)]
+
+
+def _validate_digest(digest):
+    if (not digest or len(digest) != 64 or
+            not all(c in '0123456789abcdef' for c in digest)):
+        raise exception.InvalidParameterValue(
+            'Invalid blob digest {0}'.format(digest))
+
+
+class BlobStore(object):
+    """Content-addressed store for blobs, with per-node references.
+
+    Blobs are named by the sha256 of their content, so identical payloads
+    sent to many nodes are stored once. Every node using a blob has a
+    reference file, and a blob is deleted once its last reference is
+    released.
+
+    Layout:
+        <root>/objects/<digest[:2]>/<digest>
+        <root>/refs/<digest>/<node uuid>
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest)
+
+    def _refs_path(self, digest):
+        return os.path.join(self.root, 'refs', digest)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextlib.contextmanager
+    def _locked(self, digest):
+        """Hold the lock of digest, between the threads of this process
+        and between the conductors sharing the store.
+
+        Locks are shared by all the digests starting with the same byte,
+        so there are at most 256 lock files.
+        """
+        stripe = digest[:2]
+        with _LOCKS[int(stripe, 16)]:
+            directory = os.path.join(self.root, 'locks')
+            self._makedirs(directory)
+            with open(os.path.join(directory, stripe), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def put(self, data):
+        """Store data and return its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest
+        directory = os.path.dirname(path)
+        self._makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        """Return the data stored under digest.
+
+        :raises: NotFound if there is no such blob.
+        """
+        _validate_digest(digest)
+        try:
+            with open(self._object_path(digest), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise exception.NotFound(
+                    'Blob {0} not found'.format(digest))
+            raise
+
+    def add_ref(self, digest, node_uuid):
+        """Record that node_uuid uses the blob.
+
+        Take the reference before putting the data: once it is taken, the
+        blob can't be deleted by another node releasing it.
+        """
+        _validate_digest(digest)
+        refs_path = self._refs_path(digest)
+        with self._locked(digest):
+            self._makedirs(refs_path)
+            open(os.path.join(refs_path, node_uuid), 'a').close()
+
+    def release(self, digest, node_uuid):
+        """Drop node_uuid's reference to the blob, and delete the blob if
+        nothing else references it.
+        """
+        _validate_digest(digest)
+        refs_path = self._refs_path(digest)
+        # Hold the lock from finding no references left to deleting the
+        # blob, or a reference added in between would be left dangling.
+        with self._locked(digest):
+            try:
+                os.unlink(os.path.join(refs_path, node_uuid))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                # Fails if another node still holds a reference.
+                os.rmdir(refs_path)
+            except OSError as e:
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    return
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                os.unlink(self._object_path(digest))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def get_store():
+    return BlobStore(CONF.teeth_driver.blob_store_dir)
+
+
+def offload_files(node):
+    """Move large instance files of node into the blob store.
+
+    Each file in instance_info['files'] larger than blob_inline_max_size is
+    replaced by a {'blob': digest, 'size': size} reference, which the agent
+    resolves through the node's get_blob vendor passthru. The digests the
+    node references are kept in instance_info['blobs'], which get_blob
+    checks and `release_files` drops on tear_down.
+    """
+    files = node.instance_info.get('files')
+    if not isinstance(files, dict):
+        return
+    store = get_store()
+    max_size = CONF.teeth_driver.blob_inline_max_size
+    blobs = set(node.instance_info.get('blobs') or [])
+    for path, content in files.items():
+        if isinstance(content, dict) and 'blob' in content:
+            continue
+        if content is None or len(content) <= max_size:
+            continue
+        data = content
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        # Take the reference before storing, so a concurrent release by
+        # another node can't delete the blob out from under us.
+        digest = hashlib.sha256(data).hexdigest()
+        store.add_ref(digest, node.uuid)
+        store.put(data)
+        blobs.add(digest)
+        files[path] = {'blob': digest, 'size': len(data)}
+    if blobs:
+        node.instance_info['blobs'] = sorted(blobs)
+
+
+def release_files(node):
+    """Drop the node's references to its blobs, deleting unused ones."""
+    blobs = node.instance_info.pop('blobs', None) or []
+    store = get_store()
+    for digest in blobs:
+        store.release(digest, node.uuid)
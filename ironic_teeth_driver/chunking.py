@@ -0,0 +1,231 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+
+from oslo.config import cfg
+import six
+
+from ironic.openstack.common import log
+
+chunking_opts = [
+    cfg.StrOpt('image_manifest_dir',
+               default='/var/lib/ironic/teeth/manifests',
+               help='Directory holding image chunk manifests, as written by '
+                    'teeth-image-manifest.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(chunking_opts, group='teeth_driver')
+
+LOG = log.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# Chunks are never smaller than 256KiB or larger than 4MiB. Boundaries are
+# only looked for past the first 256KiB, and are then 1MiB apart on average,
+# so chunks average about 1.2MiB.
+MIN_CHUNK_SIZE = 256 * 1024
+AVG_CHUNK_BITS = 20
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Random, but fixed, values for the gear rolling hash.
+_GEAR = [struct.unpack('>I', hashlib.sha256(struct.pack('>B', i))
+                       .digest()[:4])[0] for i in range(256)]
+
+
+def _find_boundary(data, min_size, mask):
+    """Return the length of the chunk at the start of data.
+
+    A gear hash is rolled over the bytes after min_size, and the chunk ends
+    at the first byte where the hash's masked bits are all zero. Because the
+    hash only depends on the last 32 bytes, boundaries move with the content
+    and an edit only changes the chunks around it.
+    """
+    h = 0
+    gear = _GEAR
+    hashed = itertools.islice(six.iterbytes(data), min_size, None)
+    for i, byte in enumerate(hashed, min_size + 1):
+        h = ((h << 1) + gear[byte]) & 0xffffffff
+        if not h & mask:
+            return i
+    return len(data)
+
+
+if six.PY3:
+    def _window(mapped, offset, length):
+        return memoryview(mapped)[offset:offset + length]
+else:
+    def _window(mapped, offset, length):
+        return buffer(mapped, offset, length)  # noqa
+
+
+def _next_chunk(mapped, offset, min_size, mask, max_size):
+    """Return the digest and length of the chunk at offset in mapped.
+
+    The chunk is hashed through a view of the mapping rather than a copy,
+    and the views are gone once this returns so the mapping can be closed.
+    """
+    length = _find_boundary(_window(mapped, offset, max_size), min_size,
+                            mask)
+    digest = hashlib.sha256(_window(mapped, offset, length)).hexdigest()
+    return digest, length
+
+
+def iter_chunks(path, min_size=MIN_CHUNK_SIZE, avg_bits=AVG_CHUNK_BITS,
+                max_size=MAX_CHUNK_SIZE):
+    """Split the file at path into content-defined chunks.
+
+    The file is memory mapped rather than read, so only the pages being
+    hashed are resident.
+
+    :returns: an iterator of (sha256 hex digest, offset, length) tuples.
+    """
+    mask = (1 << avg_bits) - 1
+    # Test the high bits of the hash, which depend on more input bytes.
+    mask <<= 32 - avg_bits
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < size:
+                digest, length = _next_chunk(mapped, offset, min_size, mask,
+                                             max_size)
+                yield digest, offset, length
+                offset += length
+        finally:
+            mapped.close()
+
+
+def build_manifest(path, image_id=None, **kwargs):
+    """Build the chunk manifest of the image at path."""
+    chunks = [list(chunk) for chunk in iter_chunks(path, **kwargs)]
+    return {
+        'version': MANIFEST_VERSION,
+        'image_id': image_id,
+        'size': sum(chunk[2] for chunk in chunks),
+        'chunks': chunks,
+    }
+
+
+def manifest_digest(manifest):
+    """Return the content address of a manifest."""
+    body = json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def write_manifest(manifest, directory):
+    """Write manifest to directory, named by its digest."""
+    digest = manifest_digest(manifest)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, digest + '.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, separators=(',', ':'))
+    os.rename(tmp_path, path)
+    return digest
+
+
+def load_manifest(digest, directory=None):
+    """Load the manifest with the given digest.
+
+    :raises: IOError if there is no such manifest.
+    """
+    directory = directory or CONF.teeth_driver.image_manifest_dir
+    # Digests come from agents, so don't let them name arbitrary files.
+    if (not isinstance(digest, six.string_types) or len(digest) != 64 or
+            not all(c in '0123456789abcdef' for c in digest)):
+        raise IOError('Invalid manifest digest {0}'.format(digest))
+    with open(os.path.join(directory, digest + '.json')) as f:
+        return json.load(f)
+
+
+def missing_chunks(manifest, cached_manifests):
+    """Return the chunks of manifest which appear in none of
+    cached_manifests, without duplicates.
+    """
+    have = set()
+    for cached in cached_manifests:
+        have.update(chunk[0] for chunk in cached['chunks'])
+    missing = []
+    for chunk in manifest['chunks']:
+        if chunk[0] not in have:
+            missing.append(chunk)
+            have.add(chunk[0])
+    return missing
+
+
+def add_delta(node, image_info):
+    """Return a copy of image_info with the list of chunks the agent is
+    missing, or image_info itself if no delta can be computed.
+
+    image_info must name the image's manifest in 'manifest', and the agent
+    must have reported the manifests of the images it has cached. The
+    agent builds the image from its cached images and the 'chunks' it
+    downloads, which are [sha256, offset, length] lists.
+    """
+    if not image_info or 'manifest' not in image_info:
+        return image_info
+    cached_digests = node.instance_info.get('cached_manifests') or []
+    if not cached_digests:
+        return image_info
+    try:
+        manifest = load_manifest(image_info['manifest'])
+    except (IOError, ValueError):
+        LOG.warning('Could not load manifest %s, sending the full image.',
+                    image_info['manifest'])
+        return image_info
+
+    cached = []
+    base_manifests = []
+    for digest in cached_digests:
+        try:
+            cached.append(load_manifest(digest))
+        except (IOError, ValueError):
+            continue
+        base_manifests.append(digest)
+    if not cached:
+        return image_info
+
+    image_info = dict(image_info)
+    image_info['base_manifests'] = base_manifests
+    image_info['chunks'] = missing_chunks(manifest, cached)
+    return image_info
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write the chunk manifest of an image, so redeploys of '
+                    'a changed image only transfer the changed chunks.')
+    parser.add_argument('image', help='Path of the image file.')
+    parser.add_argument('--image-id', help='Image id to record.')
+    parser.add_argument('--output-dir',
+                        default=CONF.teeth_driver.image_manifest_dir,
+                        help='Directory to write the manifest to.')
+    args = parser.parse_args()
+
+    manifest = build_manifest(args.image, image_id=args.image_id)
+    digest = write_manifest(manifest, args.output_dir)
+    print(digest)
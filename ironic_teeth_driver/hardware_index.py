@@ -0,0 +1,249 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+
+from eventlet import greenthread
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic.db.sqlalchemy import api as dbapi
+from ironic.db.sqlalchemy import models
+#TODO(pcsforeducation) drop this when we move into Ironic
+from ironic.openstack.common.gettextutils import _
+from ironic.openstack.common import log
+from ironic_teeth_driver import exceptions
+
+hardware_index_opts = [
+    cfg.IntOpt('hardware_index_refresh',
+               default=300,
+               help='Seconds between rebuilds of the in-memory index of '
+                    'node serial numbers and BMC addresses used by lookup. '
+                    'Lookups keep using the old index while it is rebuilt '
+                    'in the background.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hardware_index_opts, group='teeth_driver')
+
+LOG = log.getLogger(__name__)
+
+MAC_ADDRESS = 'mac_address'
+SYSTEM_SERIAL = 'system_serial'
+BMC_ADDRESS = 'bmc_address'
+DISK_SERIAL = 'disk_serial'
+
+# How much a matching key of each type counts towards a node being the
+# one looking itself up. System serials and BMC addresses identify a
+# chassis; NICs and especially disks get moved between chassis.
+KEY_WEIGHTS = {
+    SYSTEM_SERIAL: 10,
+    BMC_ADDRESS: 8,
+    MAC_ADDRESS: 4,
+    DISK_SERIAL: 2,
+}
+
+# A node needs at least this score to match: one MAC, or anything
+# stronger. Disk serials alone are not enough.
+MIN_SCORE = KEY_WEIGHTS[MAC_ADDRESS]
+
+
+def normalize(key_type, value):
+    """Return the canonical form of a hardware key."""
+    value = value.strip()
+    if key_type in (MAC_ADDRESS, BMC_ADDRESS):
+        return value.lower()
+    return value.upper()
+
+
+def update_properties(node, keys):
+    """Record the system and disk serials among the hardware keys the
+    node's agent reported in the node's 'system_serial' and 'disk_serials'
+    properties, which the index reads. Operators can also set them, for
+    nodes whose agent hasn't looked them up yet.
+
+    :param keys: a list of (key type, value) tuples.
+    :returns: True if the properties changed and the node must be saved.
+    """
+    properties = dict(node.properties or {})
+    system_serials = [value for key_type, value in keys
+                      if key_type == SYSTEM_SERIAL]
+    if system_serials:
+        properties['system_serial'] = system_serials[0]
+    disk_serials = sorted(set(value for key_type, value in keys
+                              if key_type == DISK_SERIAL))
+    if disk_serials:
+        properties['disk_serials'] = disk_serials
+    if properties == (node.properties or {}):
+        return False
+    node.properties = properties
+    return True
+
+
+class HardwareIndex(object):
+    """Finds the node an agent runs on from the hardware it reports.
+
+    MAC addresses are matched against ports with a single query, whatever
+    the number of MACs. System serials, disk serials (from the node's
+    'system_serial' and 'disk_serials' properties) and BMC addresses (from
+    driver_info's 'ipmi_address') are matched against an in-memory index
+    built with a single query over the nodes and rebuilt periodically.
+
+    Nodes and MACs already loaded elsewhere can be primed into the index,
+    see `prime`; primed MACs are matched without a query until the index
+    is next rebuilt.
+
+    Only the first lookup waits for the index to be built. Once it is
+    older than hardware_index_refresh, lookups keep using it while it is
+    rebuilt in the background, so a node enrolled meanwhile is only found
+    by its MACs until the rebuild finishes.
+    """
+    def __init__(self):
+        self._index = {}
+        self._built_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _node_keys(self, node_uuid, driver_info, properties):
+        keys = []
+        properties = properties or {}
+        if properties.get('system_serial'):
+            keys.append((SYSTEM_SERIAL, properties['system_serial']))
+        for serial in properties.get('disk_serials') or []:
+            keys.append((DISK_SERIAL, serial))
+        if (driver_info or {}).get('ipmi_address'):
+            keys.append((BMC_ADDRESS, driver_info['ipmi_address']))
+        return [((key_type, normalize(key_type, value)), node_uuid)
+                for key_type, value in keys]
+
+    def _build(self):
+        index = {}
+        query = dbapi.model_query(models.Node.uuid,
+                                  models.Node.driver_info,
+                                  models.Node.properties)
+        for row in query.all():
+            for key, node_uuid in self._node_keys(*row):
+                index.setdefault(key, set()).add(node_uuid)
+        return index
+
+    def _get_index(self):
+        with self._lock:
+            if self._built_at is None:
+                # Keep what was primed before the first build.
+                index = self._build()
+                for key, node_uuids in self._index.items():
+                    index[key] = index.get(key, set()) | node_uuids
+                self._index = index
+                self._built_at = time.time()
+            elif (not self._refreshing and time.time() - self._built_at >
+                    CONF.teeth_driver.hardware_index_refresh):
+                self._refreshing = True
+                greenthread.spawn_n(self._refresh_in_background)
+            return self._index
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            LOG.warning('Failed to rebuild the hardware index: %s', e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def refresh(self):
+        """Rebuild the index now."""
+        index = self._build()
+        with self._lock:
+            self._index = index
+            self._built_at = time.time()
+
+    def prime(self, nodes=(), ports=()):
+        """Add already loaded nodes and ports to the index, without a query.
+
+        The nodes' serials and BMC addresses are indexed as a rebuild
+        would. The ports' MACs are matched without a query until the next
+        rebuild.
+
+        :param nodes: Node rows or objects.
+        :param ports: (node uuid, MAC address) tuples.
+        """
+        entries = []
+        for node in nodes:
+            entries.extend(self._node_keys(node.uuid, node.driver_info,
+                                           node.properties))
+        for node_uuid, address in ports:
+            entries.append(((MAC_ADDRESS, normalize(MAC_ADDRESS, address)),
+                            node_uuid))
+        with self._lock:
+            # Lookups iterate the index without the lock, so replace it
+            # rather than change it.
+            index = dict(self._index)
+            for key, node_uuid in entries:
+                index[key] = index.get(key, set()) | set([node_uuid])
+            self._index = index
+
+    def _match_macs(self, macs):
+        if not macs:
+            return []
+        query = dbapi.model_query(models.Node.uuid, models.Port.address)
+        query = query.filter(models.Port.node_id == models.Node.id)
+        query = query.filter(models.Port.address.in_(macs))
+        return query.all()
+
+    def _add_mac_scores(self, scores, keys, index):
+        # MACs primed into the index are scored from it.
+        macs = [value for key_type, value in keys
+                if key_type == MAC_ADDRESS and (key_type, value) not in index]
+        for node_uuid, _address in self._match_macs(macs):
+            scores[node_uuid] = (scores.get(node_uuid, 0) +
+                                 KEY_WEIGHTS[MAC_ADDRESS])
+
+    def _add_index_scores(self, scores, keys, index):
+        for key in keys:
+            for node_uuid in index.get(key, ()):
+                scores[node_uuid] = (scores.get(node_uuid, 0) +
+                                     KEY_WEIGHTS[key[0]])
+
+    def find_node_uuid(self, keys):
+        """Return the uuid of the node best matching the hardware keys.
+
+        Each node scores the sum of KEY_WEIGHTS of the keys it matches, and
+        the best scoring node wins if it scores at least MIN_SCORE.
+
+        :param keys: a list of (key type, value) tuples.
+        :raises: NotFound if no node scores enough.
+        :raises: MultipleChassisFound if several nodes have the best score.
+        """
+        keys = set((key_type, normalize(key_type, value))
+                   for key_type, value in keys
+                   if key_type in KEY_WEIGHTS)
+        if not keys:
+            raise exception.NotFound(_('No usable hardware keys given.'))
+
+        scores = {}
+        index = self._get_index()
+        self._add_mac_scores(scores, keys, index)
+        self._add_index_scores(scores, keys, index)
+
+        best = max(scores.values()) if scores else 0
+        if best < MIN_SCORE:
+            raise exception.NotFound(_('Could not find matching node for '
+                                       'the provided hardware.'))
+        winners = [node_uuid for node_uuid, score in scores.items()
+                   if score == best]
+        if len(winners) > 1:
+            raise exceptions.MultipleChassisFound()
+        return winners[0]
@@ -0,0 +1,116 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import datetime
+import hashlib
+import json
+
+from oslo.config import cfg
+
+inventory_opts = [
+    cfg.IntOpt('inventory_history_length',
+               default=10,
+               help='Number of inventory changes kept for each node.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(inventory_opts, group='teeth_driver')
+
+
+def _canonical(entry):
+    return json.dumps(entry, sort_keys=True, separators=(',', ':'))
+
+
+def serialize(hardware):
+    """Return the canonical serialization of a hardware list and its
+    digest. Neither depends on the order of the entries.
+    """
+    entries = sorted(set(_canonical(entry) for entry in hardware
+                         if isinstance(entry, dict)))
+    body = '[' + ','.join(entries) + ']'
+    return body, hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def diff(old, new):
+    """Return the entries added and removed between two hardware lists."""
+    old = set(_canonical(entry) for entry in old)
+    new = set(_canonical(entry) for entry in new)
+    return {
+        'added': [json.loads(entry) for entry in sorted(new - old)],
+        'removed': [json.loads(entry) for entry in sorted(old - new)],
+    }
+
+
+def get_inventory(node):
+    """Return the last hardware list the node's agent reported, or None."""
+    return (node.extra.get('inventory') or {}).get('hardware')
+
+
+def update_inventory(node, hardware):
+    """Record the hardware list reported by the node's agent.
+
+    The inventory is kept with the node, so every conductor sees it, in
+    node.extra['inventory']:
+    {
+        'digest': 'SHA256_HEX_DIGEST',
+        'updated_at': 'ISO8601 TIMESTAMP',
+        'hardware': [HARDWARE_ENTRY, ...],
+        'history': [
+            {
+                'digest': 'SHA256_HEX_DIGEST',
+                'at': 'ISO8601 TIMESTAMP',
+                'added': [HARDWARE_ENTRY, ...],
+                'removed': [HARDWARE_ENTRY, ...]
+            }
+        ]
+    }
+    where hardware is in canonical order, see `serialize`, and history
+    holds the last inventory_history_length changes, oldest first. The
+    first inventory of a node has no 'added' or 'removed'.
+
+    Agents report the same hardware on every lookup, so when the digest is
+    unchanged nothing is written at all.
+
+    The full list is kept, not only the changes, because the next change
+    is worked out against it and get_inventory returns it, from any
+    conductor; the node row is the only place they all read (the blob
+    store is local to each conductor). It is a few dozen small entries,
+    rewritten only when the hardware changes, and the bulk heartbeat
+    does not read extra at all.
+
+    :returns: True if the inventory changed and the node must be saved.
+    """
+    body, digest = serialize(hardware)
+    current = node.extra.get('inventory') or {}
+    if current.get('digest') == digest:
+        return False
+
+    hardware = json.loads(body)
+    now = datetime.datetime.utcnow().isoformat()
+    change = {'digest': digest, 'at': now}
+    if current.get('hardware') is not None:
+        change.update(diff(current['hardware'], hardware))
+
+    history = (current.get('history') or []) + [change]
+    length = CONF.teeth_driver.inventory_history_length
+    extra = dict(node.extra)
+    extra['inventory'] = {
+        'digest': digest,
+        'updated_at': now,
+        'hardware': hardware,
+        'history': history[-length:] if length > 0 else [],
+    }
+    node.extra = extra
+    return True
@@ -0,0 +1,141 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+import threading
+import time
+
+from oslo.config import cfg
+
+from ironic.openstack.common import log
+
+log_utils_opts = [
+    cfg.IntOpt('log_rate_limit_interval',
+               default=60,
+               help='Length in seconds of the window over which repetitive '
+                    'log messages are rate limited. 0 disables rate '
+                    'limiting.'),
+    cfg.IntOpt('log_rate_limit_burst',
+               default=5,
+               help='Number of times the same message about the same node '
+                    'or hardware is logged in each window before further '
+                    'ones are suppressed.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(log_utils_opts, group='teeth_driver')
+
+# Windows tracked at once. Fleet-wide floods of distinct keys are bounded
+# by dropping all state, which at worst lets a burst through again.
+MAX_KEYS = 10000
+
+# message -> number of times it was suppressed, since startup.
+_SUPPRESSED = {}
+_SUPPRESSED_LOCK = threading.Lock()
+
+
+class Deferred(object):
+    """A log argument computed only if the message is formatted.
+
+        LOG.debug('Sent to %s', Deferred(self._get_command_url, node))
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class RateLimitedLogger(object):
+    """Logger which drops records before formatting them if their level is
+    disabled, and rate limits messages given a key.
+
+    Messages are never formatted eagerly: pass arguments separately, as
+    with the standard logging methods, and wrap expensive ones in
+    Deferred. When a key is given, for instance a node uuid or a MAC, the
+    same message with the same key is logged at most log_rate_limit_burst
+    times per log_rate_limit_interval seconds. The next message logged
+    after a window ends says how many were suppressed.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+        self._lock = threading.Lock()
+        # (message, key) -> [window start, logged, suppressed]
+        self._windows = {}
+
+    def _allow(self, msg, key):
+        """Return whether to log, and how many were suppressed before."""
+        interval = CONF.teeth_driver.log_rate_limit_interval
+        if interval <= 0:
+            return True, 0
+        now = time.time()
+        with self._lock:
+            window = self._windows.get((msg, key))
+            if window is None or now - window[0] >= interval:
+                suppressed = window[2] if window else 0
+                if window is None and len(self._windows) >= MAX_KEYS:
+                    self._windows.clear()
+                self._windows[(msg, key)] = [now, 1, 0]
+                return True, suppressed
+            if window[1] < CONF.teeth_driver.log_rate_limit_burst:
+                window[1] += 1
+                return True, 0
+            window[2] += 1
+        with _SUPPRESSED_LOCK:
+            _SUPPRESSED[msg] = _SUPPRESSED.get(msg, 0) + 1
+        return False, 0
+
+    def _log(self, level, msg, args, key=None, exc_info=None):
+        if not self.logger.isEnabledFor(level):
+            return
+        suppressed = 0
+        if key is not None:
+            allowed, suppressed = self._allow(msg, key)
+            if not allowed:
+                return
+        if suppressed:
+            msg = '%s (%d similar messages suppressed)' % (msg, suppressed)
+        self.logger.log(level, msg, *args, exc_info=exc_info)
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log(logging.DEBUG, msg, args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._log(logging.INFO, msg, args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self._log(logging.WARNING, msg, args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self._log(logging.ERROR, msg, args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        kwargs['exc_info'] = True
+        self._log(logging.ERROR, msg, args, **kwargs)
+
+
+def getLogger(name):
+    return RateLimitedLogger(log.getLogger(name))
+
+
+def get_suppressed():
+    """Return how many times each message was suppressed."""
+    with _SUPPRESSED_LOCK:
+        return dict(_SUPPRESSED)
@@ -0,0 +1,311 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import datetime
+import threading
+import time
+
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import semaphore
+from oslo.config import cfg
+import six
+
+from ironic.common import states
+from ironic.conductor import utils as manager_utils
+from ironic.drivers import base
+from ironic.openstack.common import importutils
+from ironic.openstack.common import log
+from ironic.openstack.common import timeutils
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import timeline
+
+power_opts = [
+    cfg.IntOpt('bulk_power_workers',
+               default=64,
+               help='Maximum number of power actions (and so ipmitool '
+                    'processes) run at once by bulk power actions.'),
+    cfg.IntOpt('bmc_concurrency',
+               default=1,
+               help='Maximum number of power actions run at once against '
+                    'the same BMC.'),
+    cfg.FloatOpt('bmc_min_interval',
+                 default=1.0,
+                 help='Minimum number of seconds between the start of two '
+                      'power actions against the same BMC.'),
+    cfg.IntOpt('power_action_retries',
+               default=2,
+               help='Number of times a failed power action is retried by '
+                    'bulk power actions.'),
+    cfg.FloatOpt('power_action_retry_interval',
+                 default=2.0,
+                 help='Seconds to wait before retrying a failed power '
+                      'action.'),
+    cfg.IntOpt('power_state_cache_ttl',
+               default=30,
+               help='Seconds a power state read from the BMC, or set by a '
+                    'power action, is trusted before the BMC is asked '
+                    'again. 0 disables caching.'),
+    cfg.IntOpt('power_state_heartbeat_ttl',
+               default=300,
+               help='Seconds an agent heartbeat or lookup is trusted as '
+                    'proof its node is powered on. 0 disables it.'),
+    cfg.IntOpt('power_state_heartbeat_grace',
+               default=60,
+               help='Seconds after a power action during which agent '
+                    'heartbeats and lookups are not trusted as proof its '
+                    'node is powered on, because they may have been sent '
+                    'before the action.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(power_opts, group='teeth_driver')
+
+LOG = log.getLogger(__name__)
+
+
+class _BMCLimiter(object):
+    """Limits concurrency and rate of actions against one BMC."""
+    def __init__(self, concurrency, min_interval):
+        self.semaphore = semaphore.Semaphore(concurrency)
+        self.min_interval = min_interval
+        self.last_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        wait = self.last_start + self.min_interval - time.time()
+        if wait > 0:
+            greenthread.sleep(wait)
+        self.last_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+
+
+def get_last_heartbeat(node):
+    """Return the time.time() of the node's last recorded heartbeat, or
+    None.
+    """
+    last = (node.instance_info or {}).get('last_heartbeat')
+    if isinstance(last, six.string_types):
+        try:
+            last = timeutils.parse_strtime(last)
+        except ValueError:
+            return None
+    if not isinstance(last, datetime.datetime):
+        return None
+    return time.mktime(last.timetuple())
+
+
+# BMC address -> _BMCLimiter, shared by all the bulk power actions of this
+# conductor.
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def _get_bmc(node):
+    # Nodes without a BMC address are limited individually.
+    return node.driver_info.get('ipmi_address') or node.uuid
+
+
+def _get_limiter(node):
+    bmc = _get_bmc(node)
+    with _LIMITERS_LOCK:
+        if bmc not in _LIMITERS:
+            _LIMITERS[bmc] = _BMCLimiter(CONF.teeth_driver.bmc_concurrency,
+                                         CONF.teeth_driver.bmc_min_interval)
+        return _LIMITERS[bmc]
+
+
+def node_power_actions(task, nodes, new_state):
+    """Run the same power action on many nodes at once.
+
+    Actions run on a bounded pool of green threads, so at most
+    bulk_power_workers ipmitool processes exist at a time. Actions against
+    the same BMC are limited to bmc_concurrency at a time and spaced by
+    bmc_min_interval, across all the calls made on this conductor, and
+    failed actions are retried power_action_retries times.
+
+    :param task: a TaskManager instance holding locks on all the nodes.
+    :param nodes: the Nodes to act upon.
+    :param new_state: the power state to set, or states.REBOOT.
+    :returns: a dict mapping each node's uuid to None if its action
+              succeeded, or to the exception it last failed with.
+    """
+    def act(node):
+        limiter = _get_limiter(node)
+        attempts = CONF.teeth_driver.power_action_retries + 1
+        for attempt in range(attempts):
+            try:
+                with limiter:
+                    with timeline.get_timeline().span(node.uuid,
+                                                      'power.' + new_state,
+                                                      attempt=attempt):
+                        manager_utils.node_power_action(task, node,
+                                                        new_state)
+                return node.uuid, None
+            except Exception as e:
+                LOG.warning('Power action %(state)s failed on node '
+                            '%(node)s (attempt %(attempt)d of '
+                            '%(attempts)d): %(error)s',
+                            {'state': new_state, 'node': node.uuid,
+                             'attempt': attempt + 1, 'attempts': attempts,
+                             'error': e})
+                error = e
+                if attempt + 1 < attempts:
+                    greenthread.sleep(
+                        CONF.teeth_driver.power_action_retry_interval)
+        return node.uuid, error
+
+    pool = greenpool.GreenPool(CONF.teeth_driver.bulk_power_workers)
+    return dict(pool.imap(act, nodes))
+
+
+class PowerStateCache(object):
+    """Power states of nodes, learned without asking their BMC.
+
+    Each node has one entry, from the most recent evidence: a heartbeat
+    or lookup from its agent (which proves it is on), a power action, or
+    a read from its BMC. Evidence older than the entry is ignored, so a
+    heartbeat sent before a power off can't mark the node on again.
+
+    Most heartbeats only carry the time they were handled, which can be
+    long after they were sent if the conductor is busy, so heartbeats
+    handled within power_state_heartbeat_grace seconds of a power action
+    are ignored too.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # node uuid -> (power state or None, observed at, expires at)
+        self._entries = {}
+        # node uuid -> time of its last power action
+        self._actions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, node_uuid):
+        """Return the cached power state of the node, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(node_uuid)
+            if entry is None or entry[0] is None or entry[2] <= now:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def record(self, node_uuid, state, ttl, observed_at=None):
+        """Cache state for ttl seconds, unless newer evidence is cached.
+
+        Only POWER_ON and POWER_OFF are cached.
+        """
+        if state not in (states.POWER_ON, states.POWER_OFF) or ttl <= 0:
+            return
+        if observed_at is None:
+            observed_at = time.time()
+        with self._lock:
+            entry = self._entries.get(node_uuid)
+            if entry is not None and entry[1] > observed_at:
+                return
+            self._entries[node_uuid] = (state, observed_at,
+                                        observed_at + ttl)
+
+    def heartbeat(self, node_uuid, observed_at=None):
+        """Record that the node's agent was heard from, so it is on."""
+        grace = CONF.teeth_driver.power_state_heartbeat_grace
+        if observed_at is None:
+            observed_at = time.time()
+        with self._lock:
+            action_at = self._actions.get(node_uuid)
+        if action_at is not None and observed_at < action_at + grace:
+            return
+        self.record(node_uuid, states.POWER_ON,
+                    CONF.teeth_driver.power_state_heartbeat_ttl,
+                    observed_at=observed_at)
+
+    def invalidate(self, node_uuid):
+        """Forget the node's power state, and ignore evidence older than
+        now, because its power is about to change.
+        """
+        now = time.time()
+        with self._lock:
+            self._entries[node_uuid] = (None, now, now)
+            self._actions[node_uuid] = now
+
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'nodes': len(self._entries)}
+
+
+_POWER_CACHE = PowerStateCache()
+
+
+def get_power_cache():
+    return _POWER_CACHE
+
+
+class CachedPower(base.PowerInterface):
+    """IPMI power interface which avoids asking BMCs what it already knows.
+
+    Every IPMI power state read forks ipmitool and waits on a slow BMC,
+    though a node whose agent heartbeated recently is known to be on.
+    Power states are answered from the PowerStateCache while it has
+    fresh evidence, and read with IPMI otherwise.
+
+    Heartbeats are sent to any conductor, not only the one which owns
+    the node and syncs its power state, so the cache of the owner is also
+    fed from the last_heartbeat recorded in the node's instance_info.
+    Lookups are not recorded there, so only the conductor which handled
+    a lookup learns from it.
+    """
+    def __init__(self):
+        ipmitool = importutils.import_module(
+            'ironic.drivers.modules.ipmitool')
+        self.ipmi = ipmitool.IPMIPower()
+
+    def validate(self, node):
+        return self.ipmi.validate(node)
+
+    def get_power_state(self, task, node):
+        cache = get_power_cache()
+        last_heartbeat = get_last_heartbeat(node)
+        if last_heartbeat is not None:
+            cache.heartbeat(node.uuid, observed_at=last_heartbeat)
+        state = cache.get(node.uuid)
+        if state is None:
+            state = self.ipmi.get_power_state(task, node)
+            cache.record(node.uuid, state,
+                         CONF.teeth_driver.power_state_cache_ttl)
+        return state
+
+    def set_power_state(self, task, node, power_state):
+        cache = get_power_cache()
+        cache.invalidate(node.uuid)
+        # The agent won't survive the power action; a new one may be a
+        # different version.
+        rest.invalidate_node_capabilities(node)
+        self.ipmi.set_power_state(task, node, power_state)
+        cache.record(node.uuid, power_state,
+                     CONF.teeth_driver.power_state_cache_ttl)
+
+    def reboot(self, task, node):
+        cache = get_power_cache()
+        cache.invalidate(node.uuid)
+        rest.invalidate_node_capabilities(node)
+        self.ipmi.reboot(task, node)
+        cache.record(node.uuid, states.POWER_ON,
+                     CONF.teeth_driver.power_state_cache_ttl)
@@ -0,0 +1,167 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import cProfile
+import functools
+import os
+import pstats
+import random
+import threading
+import time
+
+from oslo.config import cfg
+import six
+
+from ironic.common import exception
+
+profiling_opts = [
+    cfg.FloatOpt('profiling_sample_rate',
+                 default=0.0,
+                 help='Fraction of vendor passthru and deploy calls run '
+                      'under cProfile, between 0 (disabled) and 1. Stats '
+                      'are aggregated per entry point and returned by the '
+                      'get_profile vendor passthru. They include the green '
+                      'threads which ran while a profiled call waited.'),
+    cfg.StrOpt('profiling_dump_dir',
+               default='/var/lib/ironic/teeth/profiles',
+               help='Directory get_profile writes pstats files to when '
+                    'asked to dump them.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(profiling_opts, group='teeth_driver')
+
+SORT_KEYS = ('cumulative', 'time', 'calls')
+
+
+class Profiler(object):
+    """Aggregates cProfile stats of sampled calls per entry point.
+
+    Python has one profiler per OS thread, which all green threads share,
+    so only one call is profiled at a time; calls sampled while another is
+    being profiled run unprofiled.
+
+    For the same reason, whatever other green threads run while the
+    profiled call waits on I/O (the agent, the BMC, the database) is
+    recorded too, and shows up in the stats next to the profiled call's
+    own functions, in particular under the hub's switch. Profiles are only
+    meaningful aggregated over many calls, and the 'seconds' of an entry
+    point are the wall-clock time of its calls, waits included.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy = False
+        # entry point -> pstats.Stats
+        self._stats = {}
+        # entry point -> [calls profiled, seconds spent in them]
+        self._calls = {}
+
+    def _acquire(self):
+        with self._lock:
+            if self._busy:
+                return False
+            self._busy = True
+            return True
+
+    def run(self, name, func, *args, **kwargs):
+        """Run func under cProfile and add its stats to name's."""
+        if not self._acquire():
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                self._busy = False
+                if name in self._stats:
+                    self._stats[name].add(profile)
+                else:
+                    self._stats[name] = pstats.Stats(profile)
+                calls = self._calls.setdefault(name, [0, 0.0])
+                calls[0] += 1
+                calls[1] += elapsed
+
+    def get_report(self, sort='cumulative', limit=20):
+        """Return, per entry point, the number of calls profiled, the time
+        spent in them and the pstats listing of the top limit functions.
+        """
+        if sort not in SORT_KEYS:
+            raise exception.InvalidParameterValue(
+                'sort must be one of {0}'.format(', '.join(SORT_KEYS)))
+        report = {}
+        with self._lock:
+            for name, stats in self._stats.items():
+                stream = six.StringIO()
+                stats.stream = stream
+                stats.sort_stats(sort).print_stats(limit)
+                report[name] = {
+                    'calls': self._calls[name][0],
+                    'seconds': self._calls[name][1],
+                    'report': stream.getvalue(),
+                }
+        return report
+
+    def dump(self, directory):
+        """Write each entry point's stats to directory, in the format read
+        by pstats and tools like snakeviz.
+
+        :returns: the paths written.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        suffix = time.strftime('%Y%m%d%H%M%S')
+        paths = []
+        with self._lock:
+            for name, stats in self._stats.items():
+                path = os.path.join(directory, '{0}-{1}-{2}.pstats'.format(
+                    name, os.getpid(), suffix))
+                stats.dump_stats(path)
+                paths.append(path)
+        return sorted(paths)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._calls = {}
+
+
+_PROFILER = Profiler()
+
+
+def get_profiler():
+    return _PROFILER
+
+
+def call(name, func, *args, **kwargs):
+    """Call func, profiling a profiling_sample_rate fraction of calls.
+
+    When profiling is disabled this costs one option lookup.
+    """
+    rate = CONF.teeth_driver.profiling_sample_rate
+    if rate <= 0 or random.random() >= rate:
+        return func(*args, **kwargs)
+    return _PROFILER.run(name, func, *args, **kwargs)
+
+
+def profiled(name):
+    """Decorator sampling calls of the decorated function under name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return call(name, func, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -14,23 +14,276 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from ironic.common import exception
+from ironic.openstack.common import importutils
 from ironic.openstack.common import jsonutils
-from ironic.openstack.common import log
+from ironic_teeth_driver import exceptions
+from ironic_teeth_driver import log_utils
+from ironic_teeth_driver import scheduler
+from ironic_teeth_driver import swarm
+from ironic_teeth_driver import timeline
 
 import json
-import requests
+import threading
+import time
+import zlib
+
+from oslo.config import cfg
+import six
+
+rest_opts = [
+    cfg.IntOpt('command_reuse_window',
+               default=10,
+               help='Seconds for which the result of an idempotent agent '
+                    'command (such as cache_image) is returned to callers '
+                    'sending the same command again, instead of sending it '
+                    'to the agent. Set to 0 to disable.'),
+    cfg.IntOpt('agent_connection_pools',
+               default=1000,
+               help='Number of agents for which HTTP connections are kept '
+                    'open for reuse.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(rest_opts, group='teeth_driver')
+
+LOG = log_utils.getLogger(__name__)
+
+COMMAND_RUNNING = 'RUNNING'
+COMMAND_SUCCEEDED = 'SUCCEEDED'
+COMMAND_FAILED = 'FAILED'
+
+# API versions this client can speak, oldest first.
+SUPPORTED_VERSIONS = ('v1.0',)
+DEFAULT_VERSION = 'v1.0'
+
+CAPABILITY_BATCH = 'batch'
+CAPABILITY_GZIP = 'gzip'
+
+# Request bodies at least this big are compressed for agents which accept
+# gzip.
+GZIP_MIN_SIZE = 1024
+
+# agent_url -> AgentCapabilities, kept until the agent restarts.
+_CAPABILITIES = {}
+
+# Commands which can safely be answered with the result of an identical
+# earlier command.
+IDEMPOTENT_COMMANDS = ('standby.cache_image',)
+
+
+class AgentCapabilities(object):
+    """What an agent has said it supports."""
+    def __init__(self, version=DEFAULT_VERSION, capabilities=None):
+        self.version = version
+        self.capabilities = set(capabilities or [])
+
+    def supports(self, capability):
+        return capability in self.capabilities
+
+
+class CommandResult(object):
+    """The status of an agent command.
+
+    Thousands of these may be held for in-flight commands, so they use
+    __slots__ and keep only what the driver needs. Agents may send the
+    command's result payload as a JSON string, which is only parsed if
+    `result` is read.
+    """
+    __slots__ = ('id', 'name', 'status', 'error', '_result')
+
+    def __init__(self, id=None, name=None, status=None, error=None,
+                 result=None):
+        self.id = id
+        self.name = name
+        self.status = status
+        self.error = error
+        self._result = result
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a CommandResult from the agent's representation:
+        {
+            'id': 'COMMAND_ID',
+            'command_name': 'standby.prepare_image',
+            'command_status': 'RUNNING',
+            'command_error': None,
+            'command_result': None
+        }
+        """
+        return cls(id=data.get('id'),
+                   name=data.get('command_name'),
+                   status=data.get('command_status'),
+                   error=data.get('command_error'),
+                   result=data.get('command_result'))
+
+    @property
+    def result(self):
+        if isinstance(self._result, six.string_types):
+            self._result = json.loads(self._result)
+        return self._result
+
+    @property
+    def running(self):
+        return self.status == COMMAND_RUNNING
+
+    @property
+    def succeeded(self):
+        return self.status == COMMAND_SUCCEEDED
+
+    @property
+    def failed(self):
+        return self.status == COMMAND_FAILED
+
+    def raise_for_status(self):
+        """Raise AgentExecutionError if the command failed."""
+        if self.failed:
+            raise exceptions.AgentExecutionError(
+                'Agent command {0} failed: {1}'.format(self.name,
+                                                       self.error))
+
+    def __repr__(self):
+        return '<CommandResult {0} {1} {2}>'.format(self.id, self.name,
+                                                   self.status)
+
+
+def _check_response(response, method):
+    """Raise AgentExecutionError if the agent rejected the request.
+
+    Agents describe errors as {'type': ..., 'code': ..., 'message': ...}.
+    """
+    if response.status_code < 400:
+        return
+    try:
+        message = json.loads(response.text).get('message')
+    except (ValueError, AttributeError):
+        message = None
+    raise exceptions.AgentExecutionError(
+        'Agent rejected {0} with HTTP {1}: {2}'.format(
+            method, response.status_code, message or response.text))
+
+
+def invalidate_capabilities(agent_url):
+    """Forget what is known about an agent, because it restarted."""
+    _CAPABILITIES.pop(agent_url, None)
+
+
+def invalidate_node_capabilities(node):
+    """Forget what is known about the node's agent, because it restarted
+    or is about to.
+    """
+    # Rows read by the bulk heartbeat can hold NULL columns.
+    for info in (node.instance_info or {}, node.driver_info or {}):
+        if info.get('agent_url'):
+            invalidate_capabilities(info['agent_url'])
+
+
+def has_capabilities(agent_url):
+    """Return whether the capabilities of the agent at agent_url are known,
+    which means a client has talked to it since it started.
+    """
+    return agent_url in _CAPABILITIES
+
+
+def _requests():
+    # requests pulls in most of the HTTP stack, so it is only imported by
+    # the first agent command.
+    return importutils.import_module('requests')
+
+
+class _PendingCommand(object):
+    """A command being sent, which identical commands can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class RESTAgentClient(object):
-    """Client for interacting with nodes via a REST API."""
+    """Client for interacting with nodes via a REST API.
+
+    Commands are sent in the order of their priority, see
+    `scheduler.Scheduler`.
+    """
     def __init__(self):
-        self.session = requests.Session()
-        self.log = log.getLogger(__name__)
+        self._session = None
+        self.scheduler = scheduler.get_scheduler()
+        self._lock = threading.Lock()
+        # command key -> _PendingCommand
+        self._pending = {}
+        # command key -> (expiry time, result)
+        self._recent = {}
 
-    def _get_command_url(self, node):
+    @property
+    def session(self):
+        if self._session is None:
+            requests = _requests()
+            session = requests.Session()
+            # Connections are pooled per agent, and requests only keeps 10
+            # pools by default.
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=CONF.teeth_driver.agent_connection_pools)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def _get_agent_url(self, node):
         if 'agent_url' not in node.driver_info:
             raise exception.IronicException('REST Agent requires agent_url')
-        return '{0}/v1.0/commands'.format(node.driver_info['agent_url'])
+        return node.driver_info['agent_url']
+
+    def get_capabilities(self, node):
+        """Return the capabilities of the node's agent.
+
+        The agent is asked once, with a GET of its root, which should
+        return:
+        {
+            'versions': [{'id': 'v1.0'}],
+            'capabilities': ['batch', 'gzip']
+        }
+        The answer is cached until the agent restarts. Agents which don't
+        answer are assumed to speak v1.0 and support nothing else; that
+        is only cached if they answered, so an agent which could not be
+        reached is asked again next time.
+        """
+        agent_url = self._get_agent_url(node)
+        capabilities = _CAPABILITIES.get(agent_url)
+        if capabilities is None:
+            try:
+                capabilities = self._discover_capabilities(agent_url)
+            except _requests().RequestException as e:
+                LOG.warning('Could not reach agent %(agent)s to discover '
+                            'its capabilities: %(error)s',
+                            {'agent': agent_url, 'error': e}, key=agent_url)
+                return AgentCapabilities()
+            _CAPABILITIES[agent_url] = capabilities
+        return capabilities
+
+    def _discover_capabilities(self, agent_url):
+        response = self.session.get('{0}/'.format(agent_url))
+        if response.status_code != 200:
+            return AgentCapabilities()
+        try:
+            data = json.loads(response.text)
+        except ValueError as e:
+            LOG.warning('Could not discover capabilities of agent '
+                        '%(agent)s: %(error)s',
+                        {'agent': agent_url, 'error': e}, key=agent_url)
+            return AgentCapabilities()
+
+        versions = [v.get('id') for v in data.get('versions', [])]
+        usable = [v for v in SUPPORTED_VERSIONS if v in versions]
+        return AgentCapabilities(usable[-1] if usable else DEFAULT_VERSION,
+                                 data.get('capabilities'))
+
+    def _get_command_url(self, node):
+        agent_url = self._get_agent_url(node)
+        return '{0}/{1}/commands'.format(agent_url,
+                                         self.get_capabilities(node).version)
 
     def _get_command_body(self, method, params):
         return jsonutils.dumps({
@@ -38,28 +291,185 @@ class RESTAgentClient(object):
             'params': params,
         })
 
+    def _encode_body(self, node, body, headers):
+        """Compress body if it is large and the agent accepts gzip."""
+        if (len(body) < GZIP_MIN_SIZE or
+                not self.get_capabilities(node).supports(CAPABILITY_GZIP)):
+            return body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        # wbits of 31 makes zlib write a gzip header.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        headers['Content-Encoding'] = 'gzip'
+        return compressor.compress(body) + compressor.flush()
+
+    def _get_command_key(self, node, method, params, wait):
+        image_info = params.get('image_info')
+        if image_info and 'peers' in image_info:
+            # Peers are a download hint chosen afresh for every call, so
+            # they don't make otherwise identical commands different.
+            params = dict(params)
+            params['image_info'] = dict(image_info)
+            del params['image_info']['peers']
+        return (self._get_agent_url(node), method, wait,
+                jsonutils.dumps(params, sort_keys=True))
+
     def _command(self, node, method, params, wait=False):
+        """Send a command to the agent.
+
+        If an identical command (same agent, method, params and wait) is
+        already being sent, wait for it and return its result instead of
+        sending another. Results of IDEMPOTENT_COMMANDS are also reused for
+        command_reuse_window seconds.
+        """
+        key = self._get_command_key(node, method, params, wait)
+        with self._lock:
+            recent = self._recent.get(key)
+            if recent is not None and recent[0] > time.time():
+                return recent[1]
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = _PendingCommand()
+                self._pending[key] = pending
+
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = self._send_command(node, method, params, wait)
+        except Exception as e:
+            pending.error = e
+            raise
+        except BaseException:
+            # This green thread was killed or timed out before the agent
+            # answered. That is no reason to end the followers too, so they
+            # get an error of their own.
+            pending.error = exceptions.AgentConnectionLostError()
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+                self._remember_result(key, method, pending)
+            pending.done.set()
+        return pending.result
+
+    def _remember_result(self, key, method, pending):
+        window = CONF.teeth_driver.command_reuse_window
+        if (pending.error is not None or window <= 0 or
+                method not in IDEMPOTENT_COMMANDS):
+            return
+        now = time.time()
+        for old_key, (expiry, _) in list(self._recent.items()):
+            if expiry <= now:
+                del self._recent[old_key]
+        self._recent[key] = (now + window, pending.result)
+
+    def _send_command(self, node, method, params, wait):
         url = self._get_command_url(node)
-        body = self._get_command_body(method, params)
         request_params = {
             'wait': str(wait).lower()
         }
         headers = {
             'Content-Type': 'application/json'
         }
-        response = self.session.post(url,
-                                     params=request_params,
-                                     data=body,
-                                     headers=headers)
+        body = self._encode_body(node,
+                                 self._get_command_body(method, params),
+                                 headers)
+        with self.scheduler.slot(scheduler.get_priority([method])):
+            with timeline.get_timeline().span(getattr(node, 'uuid', None),
+                                              'agent.' + method,
+                                              wait=wait):
+                response = self.session.post(url,
+                                             params=request_params,
+                                             data=body,
+                                             headers=headers)
+
+        _check_response(response, method)
+        return CommandResult.from_dict(json.loads(response.text))
+
+    def supports_batch(self, node):
+        """Whether the agent accepts `batch` requests."""
+        return self.get_capabilities(node).supports(CAPABILITY_BATCH)
+
+    def batch(self, node, commands, wait=False):
+        """Run several commands, in order, in a single request.
+
+        The agent stops at the first command which fails, and reports the
+        commands after it as failed without running them. Agents which
+        don't support batches are only sent the first command, and callers
+        send the others once it finishes: waiting for it here would hold a
+        conductor worker. Agents which advertise batches but reject them
+        are remembered until they restart.
 
-        # TODO(russellhaering): real error handling
-        return json.loads(response.text)
+        :param commands: a list of (method, params) tuples.
+        :returns: a list with the result of each command, or only the
+                  result of the first command if the agent doesn't support
+                  batches.
+        """
+        if self.supports_batch(node):
+            url = '{0}/batch'.format(self._get_command_url(node))
+            request_params = {
+                'wait': str(wait).lower()
+            }
+            headers = {
+                'Content-Type': 'application/json'
+            }
+            body = self._encode_body(node, jsonutils.dumps({
+                'commands': [{'name': method, 'params': params}
+                             for method, params in commands],
+                'stop_on_error': True,
+            }), headers)
+            priority = scheduler.get_priority(
+                [method for method, params in commands])
+            with self.scheduler.slot(priority):
+                with timeline.get_timeline().span(
+                        getattr(node, 'uuid', None), 'agent.batch',
+                        wait=wait):
+                    response = self.session.post(url,
+                                                 params=request_params,
+                                                 data=body,
+                                                 headers=headers)
+            if response.status_code not in (404, 405):
+                _check_response(response, 'batch')
+                return [CommandResult.from_dict(result) for result
+                        in json.loads(response.text)['results']]
+            self.get_capabilities(node).capabilities.discard(
+                CAPABILITY_BATCH)
+
+        method, params = commands[0]
+        return [self._command(node=node,
+                              method=method,
+                              params=params,
+                              wait=wait)]
+
+    def get_command_status(self, node, command_id):
+        """Get the status of a previously issued command.
+
+        Returns None if the agent has no record of the command, which
+        happens when the agent restarted after the command was issued.
+        """
+        url = '{0}/{1}'.format(self._get_command_url(node), command_id)
+        with self.scheduler.slot(scheduler.NORMAL):
+            response = self.session.get(url)
+        if response.status_code == 404:
+            return None
+        _check_response(response, 'get_command_status')
+        return CommandResult.from_dict(json.loads(response.text))
 
     def cache_image(self, node, image_info, force=False, wait=False):
-        """Attempt to cache the specified image."""
-        self.log.debug('Caching image {image} on node {node}.'.format(
-                       image=image_info,
-                       node=self._get_command_url(node)))
+        """Attempt to cache the specified image.
+
+        If other nodes are known to hold the image, they are added to
+        image_info as 'peers' for the agent to download from.
+        """
+        image_info = swarm.get_registry().add_peers(node, image_info)
+        LOG.debug('Caching image %(image)s on node %(node)s.',
+                  {'image': image_info.get('image_id'),
+                   'node': log_utils.Deferred(self._get_command_url, node)})
         params = {
               'image_info': image_info,
               'force': force
@@ -70,23 +480,48 @@ class RESTAgentClient(object):
                              wait=wait)
 
     def prepare_image(self, node, image_info, metadata, files, wait=False):
-        """Call the `prepare_image` method on the node."""
-        self.log.debug('Preparing image {image} on node {node}.'.format(
-                       image=image_info.get('image_id'),
-                       node=self._get_command_url(node)))
+        """Call the `prepare_image` method on the node.
+
+        Like `cache_image`, peers holding the image are added to image_info.
+        """
+        LOG.debug('Preparing image %(image)s on node %(node)s.',
+                  {'image': image_info.get('image_id'),
+                   'node': log_utils.Deferred(self._get_command_url, node)})
         return self._command(node=node,
                              method='standby.prepare_image',
-                             params={
-                                 'image_info': image_info,
-                                 'metadata': metadata,
-                                 'files': files,
-                             },
+                             params=self._prepare_image_params(node,
+                                                               image_info,
+                                                               metadata,
+                                                               files),
                              wait=wait)
 
+    def _prepare_image_params(self, node, image_info, metadata, files):
+        return {
+            'image_info': swarm.get_registry().add_peers(node, image_info),
+            'metadata': metadata,
+            'files': files,
+        }
+
+    def prepare_and_run_image(self, node, image_info, metadata, files,
+                              wait=False):
+        """Prepare the image and run it, in one `batch` request.
+
+        :returns: the results of prepare_image and run_image.
+        """
+        LOG.debug('Preparing and running image %(image)s on node %(node)s.',
+                  {'image': image_info.get('image_id'),
+                   'node': log_utils.Deferred(self._get_command_url, node)})
+        return self.batch(node, [
+            ('standby.prepare_image',
+             self._prepare_image_params(node, image_info, metadata, files)),
+            ('standby.run_image', {}),
+        ], wait=wait)
+
     #TODO(pcsforeducation) match agent function def to this.
     def run_image(self, node, wait=False):
         """Run the specified image."""
-        self.log.debug('Running image {image} on node {node}.')
+        LOG.debug('Running image on node %s.',
+                  log_utils.Deferred(self._get_command_url, node))
         return self._command(node=node,
                              method='standby.run_image',
                              params={},
@@ -94,9 +529,9 @@ class RESTAgentClient(object):
 
     def secure_drives(self, node, drives, key, wait=False):
         """Secures given drives with given key."""
-        self.log.info('Securing drives {drives} for node {node}'.format(
-                      drives=drives,
-                      node=self._get_command_url(node)))
+        LOG.info('Securing drives %(drives)s for node %(node)s',
+                 {'drives': drives,
+                  'node': log_utils.Deferred(self._get_command_url, node)})
         params = {
             'drives': drives,
             'key': key,
@@ -106,16 +541,49 @@ class RESTAgentClient(object):
                              params=params,
                              wait=wait)
 
-    def erase_drives(self, node, drives, key, wait=False):
-        """Erases given drives."""
-        self.log.info('Erasing drives {drives} for node {node}'.format(
-                      drives=drives,
-                      node=self._get_command_url(node)))
+    def erase_drives(self, node, drives, key, wait=False, progress=None):
+        """Erases given drives.
+
+        progress optionally maps drives to the progress their last,
+        interrupted, erase reported so the agent can resume from there.
+        """
+        LOG.info('Erasing drives %(drives)s for node %(node)s',
+                 {'drives': drives,
+                  'node': log_utils.Deferred(self._get_command_url, node)})
         params = {
             'drives': drives,
             'key': key,
         }
+        if progress:
+            params['progress'] = progress
         return self._command(node=node,
                              method='decom.erase_drives',
                              params=params,
                              wait=wait)
+
+    def secure_and_erase_drives(self, node, drives, key, wait=False):
+        """Secure and then erase the given drives, in one `batch` request.
+
+        :returns: the results of secure_drives and erase_drives.
+        """
+        LOG.info('Securing and erasing drives %(drives)s for node %(node)s',
+                 {'drives': drives,
+                  'node': log_utils.Deferred(self._get_command_url, node)})
+        params = {
+            'drives': drives,
+            'key': key,
+        }
+        return self.batch(node, [
+            ('decom.secure_drives', params),
+            ('decom.erase_drives', params),
+        ], wait=wait)
+
+
+_CLIENT = RESTAgentClient()
+
+
+def get_client():
+    """Return the client shared by the driver, so its HTTP session and
+    connection pools are reused between deploy calls and heartbeats.
+    """
+    return _CLIENT
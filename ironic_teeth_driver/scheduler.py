@@ -0,0 +1,206 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+from oslo.config import cfg
+
+from ironic_teeth_driver import timeline
+
+scheduler_opts = [
+    cfg.IntOpt('agent_request_slots',
+               default=100,
+               help='Maximum number of requests to agents in flight at '
+                    'once. Further requests are queued by priority. A '
+                    'command sent with wait=True is in flight until it '
+                    'completes on the agent.'),
+    cfg.IntOpt('agent_request_quota_normal',
+               default=50,
+               help='Maximum number of agent_request_slots used by normal '
+                    'priority requests, such as securing drives and '
+                    'polling command status.'),
+    cfg.IntOpt('agent_request_quota_background',
+               default=20,
+               help='Maximum number of agent_request_slots used by '
+                    'background requests, such as caching images and '
+                    'erasing drives.'),
+    cfg.FloatOpt('agent_request_max_wait',
+                 default=60.0,
+                 help='Seconds after which a queued request is sent before '
+                      'higher priority ones, so they can\'t starve it.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(scheduler_opts, group='teeth_driver')
+
+INTERACTIVE = 'interactive'
+NORMAL = 'normal'
+BACKGROUND = 'background'
+
+# Highest priority first.
+PRIORITIES = (INTERACTIVE, NORMAL, BACKGROUND)
+
+COMMAND_PRIORITIES = {
+    'standby.prepare_image': INTERACTIVE,
+    'standby.run_image': INTERACTIVE,
+    'standby.cache_image': BACKGROUND,
+    'decom.erase_drives': BACKGROUND,
+}
+
+# Recent waits kept per priority for percentiles.
+WAIT_SAMPLES = 1000
+
+
+def get_priority(methods):
+    """Return the priority of a request running methods, the highest of
+    theirs. Commands not in COMMAND_PRIORITIES are NORMAL.
+    """
+    priorities = [COMMAND_PRIORITIES.get(method, NORMAL)
+                  for method in methods]
+    for priority in PRIORITIES:
+        if priority in priorities:
+            return priority
+    return NORMAL
+
+
+class _Waiter(object):
+    def __init__(self, priority):
+        self.priority = priority
+        self.queued_at = time.time()
+        self.ready = threading.Event()
+
+
+class Scheduler(object):
+    """Orders requests to agents so deploys don't wait on background work.
+
+    At most agent_request_slots requests are in flight. Queued requests
+    are sent highest priority first, and FIFO within a priority. NORMAL
+    and BACKGROUND requests only use up to their quota of the slots, so
+    INTERACTIVE requests always find slots free of background work.
+    Requests queued for more than agent_request_max_wait are sent first,
+    within their quota, so a steady stream of higher priority requests
+    can't starve them.
+
+    A slot is held until the agent responds, so a command sent with
+    wait=True holds its slot for as long as it runs on the agent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = dict((priority, collections.deque())
+                            for priority in PRIORITIES)
+        self._running = dict((priority, 0) for priority in PRIORITIES)
+        self._sent = dict((priority, 0) for priority in PRIORITIES)
+        self._waits = dict((priority, collections.deque(maxlen=WAIT_SAMPLES))
+                           for priority in PRIORITIES)
+
+    def _get_quota(self, priority):
+        slots = CONF.teeth_driver.agent_request_slots
+        if priority == NORMAL:
+            return min(slots, CONF.teeth_driver.agent_request_quota_normal)
+        if priority == BACKGROUND:
+            return min(slots,
+                       CONF.teeth_driver.agent_request_quota_background)
+        return slots
+
+    def _next(self):
+        """Return the queued waiter to run next, or None."""
+        candidates = []
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if queue and self._running[priority] < self._get_quota(priority):
+                candidates.append(queue[0])
+        if not candidates:
+            return None
+        oldest = min(candidates, key=lambda waiter: waiter.queued_at)
+        if time.time() - oldest.queued_at >= \
+                CONF.teeth_driver.agent_request_max_wait:
+            return oldest
+        return candidates[0]
+
+    def _dispatch(self):
+        # Called with the lock held.
+        slots = CONF.teeth_driver.agent_request_slots
+        while sum(self._running.values()) < slots:
+            waiter = self._next()
+            if waiter is None:
+                return
+            self._queues[waiter.priority].popleft()
+            self._running[waiter.priority] += 1
+            self._sent[waiter.priority] += 1
+            self._waits[waiter.priority].append(
+                time.time() - waiter.queued_at)
+            waiter.ready.set()
+
+    def acquire(self, priority):
+        """Wait until a request of this priority may be sent."""
+        waiter = _Waiter(priority)
+        with self._lock:
+            self._queues[priority].append(waiter)
+            self._dispatch()
+        try:
+            waiter.ready.wait()
+        except BaseException:
+            # Killed or timed out while queued: give up the place in the
+            # queue, or the slot if it was granted meanwhile.
+            with self._lock:
+                if waiter.ready.is_set():
+                    self._running[priority] -= 1
+                else:
+                    self._queues[priority].remove(waiter)
+                self._dispatch()
+            raise
+
+    def release(self, priority):
+        with self._lock:
+            self._running[priority] -= 1
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, priority):
+        """Hold a slot for a request of this priority."""
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def get_stats(self):
+        """Return, per priority, the requests queued, in flight and sent,
+        and the 50th and 99th percentile and maximum seconds recent ones
+        waited in the queue.
+        """
+        stats = {}
+        with self._lock:
+            for priority in PRIORITIES:
+                waits = sorted(self._waits[priority])
+                stats[priority] = {
+                    'queued': len(self._queues[priority]),
+                    'running': self._running[priority],
+                    'sent': self._sent[priority],
+                    'wait_p50': timeline.percentile(waits, 50),
+                    'wait_p99': timeline.percentile(waits, 99),
+                    'wait_max': waits[-1] if waits else None,
+                }
+        return stats
+
+
+_SCHEDULER = Scheduler()
+
+
+def get_scheduler():
+    return _SCHEDULER
@@ -0,0 +1,167 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+
+from oslo.config import cfg
+
+swarm_opts = [
+    cfg.IntOpt('image_peers',
+               default=3,
+               help='Maximum number of peer nodes to suggest to an agent '
+                    'caching an image. Set to 0 to always download images '
+                    'from the image store.'),
+    cfg.IntOpt('image_peer_uploads',
+               default=2,
+               help='Maximum number of agents a single peer is suggested to '
+                    'at the same time.'),
+    cfg.IntOpt('image_peer_assignment_timeout',
+               default=1800,
+               help='Seconds after which a peer suggested to an agent is '
+                    'considered free again, even if the agent never '
+                    'reported finishing its download.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(swarm_opts, group='teeth_driver')
+
+
+def get_rack(node):
+    """Return the rack a node is in, from its 'rack' property."""
+    return (getattr(node, 'properties', None) or {}).get('rack')
+
+
+def get_agent_url(node):
+    """Return the most recently heartbeated agent_url of a node."""
+    return (node.instance_info.get('agent_url') or
+            node.driver_info.get('agent_url'))
+
+
+class PeerRegistry(object):
+    """Tracks which nodes have which images cached, so agents can be told
+    to download an image from nearby peers instead of the image store.
+
+    Agents report the images they hold in their heartbeats. When an agent
+    is asked to cache or prepare an image, it is given a ranked list of
+    holders: holders in the same rack first, then the least busy ones. Each
+    peer is only suggested to a bounded number of agents at a time, so the
+    image spreads through the fleet as a swarm and the image store is only
+    hit once per rack.
+
+    The registry only knows about nodes which heartbeat to this conductor.
+    """
+    def __init__(self):
+        # image_id -> {node_uuid: {'agent_url': ..., 'rack': ...,
+        #                          'seen': ...}}
+        self._holders = {}
+        # peer node_uuid -> {downloader node_uuid: assigned at}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def update_holder(self, node, image_ids):
+        """Record the full set of images a node's agent has cached."""
+        now = time.time()
+        entry = {
+            'agent_url': get_agent_url(node),
+            'rack': get_rack(node),
+            'seen': now,
+        }
+        with self._lock:
+            for image_id, holders in self._holders.items():
+                if image_id not in image_ids:
+                    holders.pop(node.uuid, None)
+            for image_id in image_ids:
+                self._holders.setdefault(image_id, {})[node.uuid] = entry
+            # A node holding images is done downloading them, so it no
+            # longer counts against its peers.
+            for downloads in self._uploads.values():
+                downloads.pop(node.uuid, None)
+
+    def remove_node(self, node_uuid):
+        """Forget a node, eg. because its agent is about to go away."""
+        with self._lock:
+            for holders in self._holders.values():
+                holders.pop(node_uuid, None)
+            self._uploads.pop(node_uuid, None)
+            for downloads in self._uploads.values():
+                downloads.pop(node_uuid, None)
+
+    def get_peers(self, node, image_id):
+        """Return a ranked list of peers node can fetch image_id from, and
+        count node against each of them until it reports the image cached.
+        """
+        max_peers = CONF.teeth_driver.image_peers
+        if max_peers <= 0:
+            return []
+        # Imported here rather than at module level, vendor imports swarm.
+        CONF.import_opt('heartbeat_timeout', 'ironic_teeth_driver.vendor',
+                        group='teeth_driver')
+        now = time.time()
+        rack = get_rack(node)
+        stale = now - CONF.teeth_driver.heartbeat_timeout
+        expired = now - CONF.teeth_driver.image_peer_assignment_timeout
+        max_uploads = CONF.teeth_driver.image_peer_uploads
+
+        with self._lock:
+            candidates = []
+            holders = self._holders.get(image_id, {})
+            for peer_uuid, entry in holders.items():
+                if peer_uuid == node.uuid or entry['seen'] < stale:
+                    continue
+                downloads = self._uploads.setdefault(peer_uuid, {})
+                for downloader, assigned in list(downloads.items()):
+                    if assigned < expired:
+                        del downloads[downloader]
+                if len(downloads) >= max_uploads:
+                    continue
+                same_rack = rack is not None and entry['rack'] == rack
+                candidates.append((not same_rack, len(downloads), peer_uuid,
+                                   entry))
+
+            candidates.sort(key=lambda c: c[:3])
+            peers = []
+            for _, _, peer_uuid, entry in candidates[:max_peers]:
+                self._uploads[peer_uuid][node.uuid] = now
+                peers.append({
+                    'node': peer_uuid,
+                    'agent_url': entry['agent_url'],
+                    'rack': entry['rack'],
+                })
+            return peers
+
+    def add_peers(self, node, image_info):
+        """Return a copy of image_info with a 'peers' list added, or
+        image_info itself if there are no suitable peers.
+        """
+        if not image_info or 'image_id' not in image_info:
+            return image_info
+        peers = self.get_peers(node, image_info['image_id'])
+        if not peers:
+            return image_info
+        image_info = dict(image_info)
+        image_info['peers'] = peers
+        return image_info
+
+
+_REGISTRY = None
+
+
+def get_registry():
+    """Return the peer registry shared by the whole driver."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = PeerRegistry()
+    return _REGISTRY
@@ -13,11 +13,42 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
+import hmac
+import uuid
+
+from oslo.config import cfg
+
 from ironic.common import exception
 from ironic.common import states
-from ironic.conductor import utils as manager_utils
 from ironic.drivers import base
+from ironic_teeth_driver import blobstore
+from ironic_teeth_driver import chunking
+from ironic_teeth_driver import exceptions
+from ironic_teeth_driver import log_utils
+from ironic_teeth_driver import power
+from ironic_teeth_driver import profiling
 from ironic_teeth_driver import rest
+from ironic_teeth_driver import swarm
+from ironic_teeth_driver import timeline
+from ironic_teeth_driver import warmup
+from ironic_teeth_driver import watchdog
+
+teeth_opts = [
+    cfg.StrOpt('decom_key_secret',
+               secret=True,
+               help='Secret from which the ATA security keys used to erase '
+                    'drives are derived, with a random nonce per decom. It '
+                    'must be the same on all conductors. When unset, the '
+                    'keys themselves are stored in the instance_info of '
+                    'nodes being decommissioned, where the node API shows '
+                    'them.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(teeth_opts, group='teeth_driver')
+
+LOG = log_utils.getLogger(__name__)
 
 """States:
 
@@ -30,14 +61,52 @@ DELETING: doing decom
 DELETED: decom finished
 """
 
+# Deploys are driven by agent heartbeats. The current phase and the id of
+# the agent command it is waiting on are kept in instance_info so that any
+# conductor can pick the deploy up where it was left. A deploy which makes
+# no progress for provision_timeout is failed, see watchdog.Watchdog.
+DEPLOY_PHASE_PREPARE_IMAGE = 'prepare_image'
+DEPLOY_PHASE_RUN_IMAGE = 'run_image'
+
+DEPLOY_PHASE_ORDER = [
+    DEPLOY_PHASE_PREPARE_IMAGE,
+    DEPLOY_PHASE_RUN_IMAGE,
+]
+
+# Used instead of the phases above for agents which accept batches: both
+# commands are sent in one request, and the deploy waits on run_image. If
+# the agent turns out not to accept them after all, only prepare_image is
+# sent and the deploy continues from DEPLOY_PHASE_PREPARE_IMAGE.
+DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE = 'prepare_and_run_image'
+
+# Decom is driven the same way. Each drive goes through secure_drives and
+# then erase_drives independently of the others, so all drives are worked
+# on in parallel. For agents which accept batches both commands are sent
+# together, but the drive stays DRIVE_SECURING until secure_drives is
+# done, and the erase_drives command id waits in 'erase_command_id'.
+DECOM_PHASE_REBOOT = 'reboot'
+DECOM_PHASE_DRIVES = 'drives'
+
+DRIVE_SECURING = 'securing'
+DRIVE_ERASING = 'erasing'
+DRIVE_ERASED = 'erased'
+
+
+def _is_diskless(node):
+    """Whether the node is known to have no local disk to erase."""
+    properties = getattr(node, 'properties', None) or {}
+    return str(properties.get('local_gb')) == '0'
+
 
 class TeethDeploy(base.DeployInterface):
     """Interface for deploy-related actions."""
 
+    def __init__(self):
+        watchdog.get_watchdog().start()
+
     def _get_client(self):
         # TODO(pcsforeducation) add config
-        client = rest.RESTAgentClient({})
-        return client
+        return rest.get_client()
 
     def validate(self, node):
         """Validate the driver-specific git Node deployment info.
@@ -64,6 +133,7 @@ class TeethDeploy(base.DeployInterface):
                 raise exception.InvalidParameterValue('files in deploy_data '
                                                       'required for deploy.')
 
+    @profiling.profiled('deploy')
     def deploy(self, task, node):
         """Perform a deployment to a node.
 
@@ -72,22 +142,160 @@ class TeethDeploy(base.DeployInterface):
         performed any preparatory steps, such as pre-caching some data for the
         node.
 
+        The deploy is asynchronous: the first agent command is sent without
+        waiting for it, and the remaining phases are advanced by
+        `continue_deploy` as the agent heartbeats.
+
         :param task: a TaskManager instance.
         :param node: the Node to act upon.
         :returns: status of the deploy. One of ironic.common.states.
+        :raises: AgentExecutionError if the agent rejects the first command.
         """
-        image_info = node.instance_info.get('image_info')
-        metadata = node.instance_info.get('metadata')
-        files = node.instance_info.get('files')
+        tl = timeline.get_timeline()
+        tl.start_phase(node.uuid, 'deploy')
+        # Keep large files out of the node and out of the prepare_image
+        # request; the agent fetches them with get_blob.
+        blobstore.offload_files(node)
+        if self._get_client().supports_batch(node):
+            phase = DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE
+        else:
+            phase = DEPLOY_PHASE_PREPARE_IMAGE
+        try:
+            self._start_deploy_phase(node, phase)
+        except exceptions.AgentExecutionError:
+            tl.end_phase(node.uuid, 'deploy', status=rest.COMMAND_FAILED)
+            raise
+        return states.DEPLOYING
 
-        # Tell the client to run the image with the given args
+    def _start_deploy_phase(self, node, phase):
+        """Send the agent command for a deploy phase without waiting for it,
+        and record the phase and command id on the node.
+        """
         client = self._get_client()
-        client.prepare_image(node, image_info, metadata, files, wait=True)
-        # TODO(pcsforeducation) Switch network here
-        client.run_image(node, wait=True)
-        # TODO(pcsforeducation) don't return until we have a totally working
-        # machine, so we'll need to do some kind of testing here.
-        return states.DEPLOYDONE
+        if phase in (DEPLOY_PHASE_PREPARE_IMAGE,
+                     DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE):
+            # Only send the chunks the agent doesn't already have.
+            image_info = chunking.add_delta(
+                node, node.instance_info.get('image_info'))
+            metadata = node.instance_info.get('metadata')
+            files = node.instance_info.get('files')
+
+        if phase == DEPLOY_PHASE_PREPARE_IMAGE:
+            result = client.prepare_image(node, image_info, metadata, files,
+                                          wait=False)
+        elif phase == DEPLOY_PHASE_RUN_IMAGE:
+            # The agent goes away once the image runs, so it can no longer
+            # serve images to its peers.
+            swarm.get_registry().remove_node(node.uuid)
+            # TODO(pcsforeducation) Switch network here
+            result = client.run_image(node, wait=False)
+        elif phase == DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE:
+            # The batch stops if prepare_image fails, and then reports
+            # run_image as failed too, so only run_image needs watching.
+            try:
+                results = client.prepare_and_run_image(node, image_info,
+                                                       metadata, files,
+                                                       wait=False)
+            finally:
+                # The agent won't report the image cached before it runs
+                # it, so free the peers it was just counted against.
+                swarm.get_registry().remove_node(node.uuid)
+            for result in results:
+                result.raise_for_status()
+            if len(results) == 1:
+                # Only prepare_image was sent, see RESTAgentClient.batch.
+                phase = DEPLOY_PHASE_PREPARE_IMAGE
+            result = results[-1]
+        else:
+            raise exception.IronicException(
+                'Unknown deploy phase {0}'.format(phase))
+        result.raise_for_status()
+
+        deploy_state = {
+            'phase': phase,
+            'command_id': result.id,
+        }
+        watchdog.record_progress(deploy_state)
+        node.instance_info['deploy_state'] = deploy_state
+        timeline.get_timeline().start_phase(node.uuid, 'deploy.' + phase,
+                                            command_id=result.id)
+
+    def continue_deploy(self, task, node, commands=None):
+        """Advance an in-flight deploy. Called on every agent heartbeat.
+
+        :param task: a TaskManager instance.
+        :param node: the Node to act upon. The caller is responsible for
+                     saving it.
+        :param commands: optional list of command results reported by the
+                         agent in its heartbeat. If the command the deploy is
+                         waiting on is not in the list, the agent is asked
+                         for its status.
+        """
+        deploy_state = node.instance_info.get('deploy_state')
+        if node.provision_state != states.DEPLOYING or not deploy_state:
+            return
+
+        phase = deploy_state['phase']
+        result = self._get_command_result(node,
+                                          deploy_state.get('command_id'),
+                                          commands)
+        if result is None:
+            # The agent lost the command (most likely it rebooted), so
+            # send it again.
+            self._continue_deploy_phase(node, phase)
+            return
+
+        if result.running:
+            return
+        tl = timeline.get_timeline()
+        tl.end_phase(node.uuid, 'deploy.' + phase, status=result.status)
+        if result.failed:
+            self._fail_deploy(node, 'Agent command {0} failed: {1}'.format(
+                phase, result.error))
+            return
+
+        if phase in DEPLOY_PHASE_ORDER:
+            next_index = DEPLOY_PHASE_ORDER.index(phase) + 1
+            if next_index < len(DEPLOY_PHASE_ORDER):
+                self._continue_deploy_phase(node,
+                                            DEPLOY_PHASE_ORDER[next_index])
+                return
+
+        # TODO(pcsforeducation) don't mark the node active until we have a
+        # totally working machine, so we'll need to do some kind of testing
+        # here.
+        node.provision_state = states.ACTIVE
+        node.target_provision_state = states.NOSTATE
+        del node.instance_info['deploy_state']
+        swarm.get_registry().remove_node(node.uuid)
+        tl.end_phase(node.uuid, 'deploy', status=result.status)
+
+    def _continue_deploy_phase(self, node, phase):
+        """Start a deploy phase from a heartbeat, failing the deploy if the
+        agent rejects it.
+        """
+        try:
+            self._start_deploy_phase(node, phase)
+        except exceptions.AgentExecutionError as e:
+            self._fail_deploy(node, str(e))
+
+    def _fail_deploy(self, node, error):
+        timeline.get_timeline().end_phase(node.uuid, 'deploy',
+                                          status=rest.COMMAND_FAILED)
+        node.provision_state = states.DEPLOYFAIL
+        node.target_provision_state = states.NOSTATE
+        node.last_error = error
+        del node.instance_info['deploy_state']
+        swarm.get_registry().remove_node(node.uuid)
+
+    def _get_command_result(self, node, command_id, commands):
+        """Find the CommandResult for command_id, preferring the results
+        reported in the heartbeat over asking the agent.
+        """
+        for command in commands or []:
+            if command.get('id') == command_id:
+                return rest.CommandResult.from_dict(command)
+        return self._get_client().get_command_status(node, command_id)
 
     def tear_down(self, task, node):
         """Reboot the machine and begin decom.
@@ -99,10 +307,289 @@ class TeethDeploy(base.DeployInterface):
         :param node: the Node to act upon.
         :returns: status of the deploy. One of ironic.common.states.
         """
-        # Reboot
-        manager_utils.node_power_action(task, node, states.REBOOT)
-        # TODO(russell_h): resume decom when the agent comes back up
-        return states.DELETING
+        result = self.tear_down_nodes(task, [node])[node.uuid]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def tear_down_nodes(self, task, nodes):
+        """Reboot many machines at once and begin their decom.
+
+        The reboots run concurrently, see `power.node_power_actions`.
+        Ironic has no bulk tear down yet, so it only calls this through
+        `tear_down`, one node at a time; the per-BMC limits still apply
+        across those calls.
+
+        :param task: a TaskManager instance holding locks on all the nodes.
+        :param nodes: the Nodes to act upon. The caller is responsible for
+                      setting their provision state and saving them.
+        :returns: a dict mapping each node's uuid to its new provision
+                  state, or to the exception its reboot failed with.
+        """
+        registry = swarm.get_registry()
+        for node in nodes:
+            registry.remove_node(node.uuid)
+            blobstore.release_files(node)
+
+        errors = power.node_power_actions(task, nodes, states.REBOOT)
+
+        tl = timeline.get_timeline()
+        results = {}
+        for node in nodes:
+            if errors[node.uuid] is not None:
+                results[node.uuid] = errors[node.uuid]
+                continue
+            # Ended when the agent looks the node up after booting.
+            tl.start_phase(node.uuid, 'agent_boot')
+            tl.start_phase(node.uuid, 'decom')
+            # Decom resumes in continue_decom when the agent heartbeats.
+            decom_state = {
+                'phase': DECOM_PHASE_REBOOT
+            }
+            watchdog.record_progress(decom_state)
+            node.instance_info['decom_state'] = decom_state
+            results[node.uuid] = states.DELETING
+        return results
+
+    def continue_decom(self, task, node, commands=None, drives=None):
+        """Advance an in-flight decom. Called on every agent heartbeat.
+
+        The first heartbeat after the tear_down reboot starts securing every
+        drive the agent reported. After that, each heartbeat moves secured
+        drives on to erasing and records erase progress. Drives whose
+        command the agent has lost (because it rebooted) have the command
+        sent again; erases are resumed from the last reported progress.
+
+        :param task: a TaskManager instance.
+        :param node: the Node to act upon. The caller is responsible for
+                     saving it.
+        :param commands: optional list of command results reported by the
+                         agent in its heartbeat.
+        :param drives: list of the drives the agent found on the node. Only
+                       used by the first heartbeat after the reboot. An
+                       empty list is taken to mean the agent has not found
+                       them yet, unless the node's local_gb property is 0.
+        """
+        decom_state = node.instance_info.get('decom_state')
+        if node.provision_state != states.DELETING or not decom_state:
+            return
+
+        if decom_state['phase'] == DECOM_PHASE_REBOOT:
+            if not drives and not _is_diskless(node):
+                # Wait for a heartbeat which tells us what to erase, rather
+                # than hand the node over unerased. If none ever does, the
+                # decom fails after provision_timeout.
+                return
+            drives = drives or []
+            decom_state['phase'] = DECOM_PHASE_DRIVES
+            watchdog.record_progress(decom_state)
+            self._new_decom_key(decom_state)
+            decom_state['drives'] = {}
+            for drive in drives:
+                decom_state['drives'][drive] = {
+                    'status': DRIVE_SECURING,
+                    'command_id': None,
+                    'progress': None,
+                }
+            # Drives get locked with the key, so it must be saved before
+            # any command is sent.
+            node.save(task)
+            for drive in drives:
+                if not self._send_drive_command(node, decom_state, drive):
+                    return
+            self._finish_decom_if_done(node, decom_state)
+            return
+
+        for drive, drive_state in decom_state['drives'].items():
+            if drive_state['status'] == DRIVE_ERASED:
+                continue
+            result = None
+            if drive_state['command_id'] is not None:
+                result = self._get_command_result(node,
+                                                  drive_state['command_id'],
+                                                  commands)
+            if result is None:
+                # The command could not be sent, or the agent lost it:
+                # send it again.
+                if not self._send_drive_command(node, decom_state, drive):
+                    return
+                continue
+
+            if result.failed:
+                self._fail_decom(node, 'Decom of {0} failed: {1}'.format(
+                    drive, result.error))
+                return
+            if drive_state['status'] == DRIVE_ERASING:
+                command_result = result.result or {}
+                progress = command_result.get('progress', {}).get(drive)
+                if progress is not None and \
+                        progress != drive_state.get('progress'):
+                    drive_state['progress'] = progress
+                    watchdog.record_progress(decom_state)
+            if result.running:
+                continue
+
+            if drive_state['status'] == DRIVE_SECURING:
+                drive_state['status'] = DRIVE_ERASING
+                erase_command_id = drive_state.pop('erase_command_id', None)
+                if erase_command_id is not None:
+                    # Sent in the same batch as secure_drives.
+                    drive_state['command_id'] = erase_command_id
+                elif not self._send_drive_command(node, decom_state, drive):
+                    return
+            else:
+                drive_state['status'] = DRIVE_ERASED
+                drive_state['command_id'] = None
+            watchdog.record_progress(decom_state)
+            timeline.get_timeline().record(node.uuid, 'decom.drive',
+                                           drive=drive,
+                                           status=drive_state['status'])
+
+        self._finish_decom_if_done(node, decom_state)
+
+    def check_timeout(self, task, node):
+        """Fail the node's deploy or decom if it made no progress for
+        provision_timeout seconds. Called by `watchdog.Watchdog` with the
+        node locked.
+
+        The agent is asked for the status of the command first, in case
+        only its heartbeats were lost. That is also how run_image is
+        caught when the agent rebooted into the instance before a heartbeat
+        reported it. If the agent is gone and never reported run_image,
+        the deploy fails: the instance may well have booted, but the driver
+        can't tell, so the node is left for an operator to check.
+
+        :param task: a TaskManager instance.
+        :param node: the Node to act upon. The caller is responsible for
+                     saving it.
+        """
+        key = watchdog.STATE_KEYS.get(node.provision_state)
+        state = node.instance_info.get(key) if key else None
+        if not state:
+            return
+        if 'progress_at' not in state:
+            # Started before progress was recorded, give it a full timeout.
+            watchdog.record_progress(state)
+            return
+        if not watchdog.is_stalled(state):
+            return
+
+        try:
+            if node.provision_state == states.DEPLOYING:
+                self.continue_deploy(task, node)
+            else:
+                self.continue_decom(task, node)
+        except IOError as e:
+            # requests' connection errors are IOErrors.
+            LOG.warning('Could not reach the agent of stalled node '
+                        '%(node)s: %(error)s',
+                        {'node': node.uuid, 'error': e}, key=node.uuid)
+        if node.provision_state not in watchdog.STATE_KEYS:
+            return
+        state = node.instance_info.get(key)
+        if not state or not watchdog.is_stalled(state):
+            return
+
+        error = 'No progress for {0} seconds in phase {1}'.format(
+            CONF.teeth_driver.provision_timeout, state['phase'])
+        if node.provision_state == states.DEPLOYING:
+            self._fail_deploy(node, error)
+        else:
+            self._fail_decom(node, error)
+
+    def _new_decom_key(self, decom_state):
+        secret = CONF.teeth_driver.decom_key_secret
+        if secret:
+            decom_state['key_nonce'] = uuid.uuid4().hex
+        else:
+            decom_state['key'] = uuid.uuid4().hex
+
+    def _get_decom_key(self, node, decom_state):
+        if 'key' in decom_state:
+            return decom_state['key']
+        secret = CONF.teeth_driver.decom_key_secret
+        if not secret:
+            raise exception.IronicException(
+                'decom_key_secret is needed to decommission node {0}'.format(
+                    node.uuid))
+        message = '{0}:{1}'.format(node.uuid, decom_state['key_nonce'])
+        # ATA passwords are at most 32 bytes.
+        return hmac.new(secret.encode('utf-8'), message.encode('utf-8'),
+                        hashlib.sha256).hexdigest()[:32]
+
+    def _send_drive_command(self, node, decom_state, drive):
+        """Send the command for the current step of a drive's decom, and
+        record its id.
+
+        A command the agent rejects fails the decom. A command which could
+        not be sent is left without an id, so the next heartbeat sends it
+        again.
+
+        :returns: False if the decom failed.
+        """
+        drive_state = decom_state['drives'][drive]
+        drive_state['command_id'] = None
+        drive_state.pop('erase_command_id', None)
+        key = self._get_decom_key(node, decom_state)
+        try:
+            if drive_state['status'] == DRIVE_SECURING:
+                result = self._secure_drive(node, key, drive_state, drive)
+            else:
+                result = self._erase_drive(node, key, drive_state, drive)
+            result.raise_for_status()
+        except exceptions.AgentExecutionError as e:
+            self._fail_decom(node, 'Decom of {0} failed: {1}'.format(
+                drive, e))
+            return False
+        except (IOError, exceptions.AgentConnectionLostError) as e:
+            # requests' connection errors are IOErrors.
+            LOG.warning('Could not send decom command for drive %(drive)s '
+                        'of node %(node)s, will retry: %(error)s',
+                        {'drive': drive, 'node': node.uuid, 'error': e},
+                        key=node.uuid)
+            return True
+        drive_state['command_id'] = result.id
+        return True
+
+    def _fail_decom(self, node, error):
+        node.provision_state = states.ERROR
+        node.target_provision_state = states.NOSTATE
+        node.last_error = error
+        timeline.get_timeline().end_phase(node.uuid, 'decom',
+                                          status=rest.COMMAND_FAILED)
+
+    def _secure_drive(self, node, key, drive_state, drive):
+        """Send secure_drives, batched with erase_drives for agents which
+        accept batches, and return the result of secure_drives.
+        """
+        client = self._get_client()
+        if not client.supports_batch(node):
+            return client.secure_drives(node, [drive], key, wait=False)
+        results = client.secure_and_erase_drives(node, [drive], key,
+                                                 wait=False)
+        for result in results:
+            result.raise_for_status()
+        if len(results) > 1:
+            drive_state['erase_command_id'] = results[1].id
+        return results[0]
+
+    def _erase_drive(self, node, key, drive_state, drive):
+        progress = None
+        if drive_state.get('progress') is not None:
+            progress = {drive: drive_state['progress']}
+        return self._get_client().erase_drives(node, [drive], key,
+                                               progress=progress,
+                                               wait=False)
+
+    def _finish_decom_if_done(self, node, decom_state):
+        for drive_state in decom_state['drives'].values():
+            if drive_state['status'] != DRIVE_ERASED:
+                return
+        node.provision_state = states.NOSTATE
+        node.target_provision_state = states.NOSTATE
+        del node.instance_info['decom_state']
+        timeline.get_timeline().end_phase(node.uuid, 'decom',
+                                          status=rest.COMMAND_SUCCEEDED)
 
     def prepare(self, task, node):
         """Prepare the deployment environment for this node.
@@ -154,5 +641,6 @@ class TeethDeploy(base.DeployInterface):
         :param task: a TaskManager instance.
         :param node: the Node which is now being managed by this Conductor.
         """
-        # Unnecessary. Trying to keep everything as stateless as possible.
-        pass
+        # Nothing needs moving, but a conductor taking over nodes is about
+        # to get their lookups and heartbeats: warm its caches in bulk.
+        warmup.get_warmer().add(task.driver, node.uuid)
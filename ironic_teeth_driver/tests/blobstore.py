@@ -0,0 +1,146 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic_teeth_driver import blobstore
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class FakeNode(object):
+    def __init__(self, uuid, files):
+        self.uuid = uuid
+        self.instance_info = {'files': files}
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        CONF.set_override('blob_store_dir', self.tempdir,
+                          group='teeth_driver')
+        CONF.set_override('blob_inline_max_size', 8, group='teeth_driver')
+        self.store = blobstore.get_store()
+
+    def tearDown(self):
+        CONF.clear_override('blob_store_dir', group='teeth_driver')
+        CONF.clear_override('blob_inline_max_size', group='teeth_driver')
+        shutil.rmtree(self.tempdir)
+
+    def test_put_get(self):
+        digest = self.store.put(b'some data')
+        self.assertEqual(hashlib.sha256(b'some data').hexdigest(), digest)
+        self.assertEqual(b'some data', self.store.get(digest))
+
+    def test_get_missing(self):
+        self.assertRaises(exception.NotFound,
+                          self.store.get,
+                          hashlib.sha256(b'nope').hexdigest())
+
+    def test_get_invalid_digest(self):
+        self.assertRaises(exception.InvalidParameterValue,
+                          self.store.get,
+                          '../../etc/passwd')
+
+    def test_release_keeps_shared_blob(self):
+        digest = self.store.put(b'shared')
+        self.store.add_ref(digest, 'node1')
+        self.store.add_ref(digest, 'node2')
+
+        self.store.release(digest, 'node1')
+        self.assertEqual(b'shared', self.store.get(digest))
+
+        self.store.release(digest, 'node2')
+        self.assertRaises(exception.NotFound, self.store.get, digest)
+
+    def test_add_ref_waits_for_release(self):
+        digest = self.store.put(b'data')
+        self.store.add_ref(digest, 'node1')
+
+        def add_node2():
+            self.store.add_ref(digest, 'node2')
+            self.store.put(b'data')
+
+        node2 = threading.Thread(target=add_node2)
+        unlink = os.unlink
+
+        def racing_unlink(path):
+            if path.endswith(digest):
+                # node2 takes a reference while node1 deletes the blob.
+                node2.start()
+                node2.join(0.1)
+                self.assertTrue(node2.is_alive())
+            unlink(path)
+
+        with mock.patch('os.unlink', side_effect=racing_unlink):
+            self.store.release(digest, 'node1')
+        node2.join()
+        self.assertEqual(b'data', self.store.get(digest))
+
+    def test_release_twice(self):
+        digest = self.store.put(b'data')
+        self.store.add_ref(digest, 'node1')
+        self.store.release(digest, 'node1')
+        self.store.release(digest, 'node1')
+
+    def test_offload_files(self):
+        node = FakeNode('node1', {'/etc/small': 'tiny',
+                                  '/etc/large': 'x' * 100})
+        blobstore.offload_files(node)
+
+        files = node.instance_info['files']
+        self.assertEqual('tiny', files['/etc/small'])
+        digest = files['/etc/large']['blob']
+        self.assertEqual(100, files['/etc/large']['size'])
+        self.assertEqual([digest], node.instance_info['blobs'])
+        self.assertEqual(b'x' * 100, self.store.get(digest))
+
+    def test_offload_files_idempotent(self):
+        node = FakeNode('node1', {'/etc/large': 'x' * 100})
+        blobstore.offload_files(node)
+        files = dict(node.instance_info['files'])
+        blobstore.offload_files(node)
+        self.assertEqual(files, node.instance_info['files'])
+
+    def test_offload_files_not_a_dict(self):
+        node = FakeNode('node1', ['foo.tar.gz'])
+        blobstore.offload_files(node)
+        self.assertEqual(['foo.tar.gz'], node.instance_info['files'])
+        self.assertNotIn('blobs', node.instance_info)
+
+    def test_dedup_and_release_files(self):
+        node1 = FakeNode('node1', {'/etc/large': 'x' * 100})
+        node2 = FakeNode('node2', {'/etc/other': 'x' * 100})
+        blobstore.offload_files(node1)
+        blobstore.offload_files(node2)
+        digest = node1.instance_info['blobs'][0]
+        self.assertEqual([digest], node2.instance_info['blobs'])
+
+        blobstore.release_files(node1)
+        self.assertNotIn('blobs', node1.instance_info)
+        self.assertEqual(b'x' * 100, self.store.get(digest))
+
+        blobstore.release_files(node2)
+        self.assertRaises(exception.NotFound, self.store.get, digest)
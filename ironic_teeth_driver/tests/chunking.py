@@ -0,0 +1,140 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import random
+import shutil
+import tempfile
+
+from oslo.config import cfg
+
+from ironic_teeth_driver import chunking
+
+import unittest
+
+CONF = cfg.CONF
+
+SMALL_CHUNKS = {
+    'min_size': 512,
+    'avg_bits': 12,
+    'max_size': 32768,
+}
+
+
+class FakeNode(object):
+    def __init__(self, cached_manifests=None):
+        self.instance_info = {}
+        if cached_manifests is not None:
+            self.instance_info['cached_manifests'] = cached_manifests
+
+
+class TestChunking(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        CONF.set_override('image_manifest_dir', self.tempdir,
+                          group='teeth_driver')
+        rand = random.Random(42)
+        self.data = bytearray(rand.randint(0, 255) for _ in range(200000))
+
+    def tearDown(self):
+        CONF.clear_override('image_manifest_dir', group='teeth_driver')
+        shutil.rmtree(self.tempdir)
+
+    def _write_image(self, name, data):
+        path = os.path.join(self.tempdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _manifest(self, name, data):
+        path = self._write_image(name, data)
+        return chunking.build_manifest(path, image_id=name, **SMALL_CHUNKS)
+
+    def test_build_manifest(self):
+        manifest = self._manifest('image', self.data)
+        self.assertEqual(len(self.data), manifest['size'])
+        offset = 0
+        for digest, chunk_offset, length in manifest['chunks']:
+            self.assertEqual(offset, chunk_offset)
+            self.assertTrue(length <= SMALL_CHUNKS['max_size'])
+            offset += length
+        self.assertTrue(len(manifest['chunks']) > 1)
+
+    def test_build_manifest_empty(self):
+        manifest = self._manifest('empty', bytearray())
+        self.assertEqual([], manifest['chunks'])
+        self.assertEqual(0, manifest['size'])
+
+    def test_insert_only_changes_nearby_chunks(self):
+        old = self._manifest('old', self.data)
+        patched = self.data[:100000] + bytearray(b'patch') + \
+            self.data[100000:]
+        new = self._manifest('new', patched)
+
+        missing = chunking.missing_chunks(new, [old])
+        self.assertTrue(len(missing) < 3)
+        self.assertTrue(sum(c[2] for c in missing) <
+                        len(self.data) / 4)
+
+    def test_missing_chunks_deduplicates(self):
+        manifest = {'chunks': [['a', 0, 1], ['b', 1, 1], ['a', 2, 1]]}
+        cached = {'chunks': [['b', 0, 1]]}
+        self.assertEqual([['a', 0, 1]],
+                         chunking.missing_chunks(manifest, [cached]))
+
+    def test_write_and_load_manifest(self):
+        manifest = self._manifest('image', self.data)
+        digest = chunking.write_manifest(manifest, self.tempdir)
+        self.assertEqual(chunking.manifest_digest(manifest), digest)
+        self.assertEqual(manifest, chunking.load_manifest(digest))
+
+    def test_load_manifest_rejects_paths(self):
+        self.assertRaises(IOError, chunking.load_manifest, '../etc/passwd')
+
+    def test_load_manifest_rejects_malformed_digests(self):
+        for digest in ('', 'abc', 'A' * 64, None):
+            self.assertRaises(IOError, chunking.load_manifest, digest,
+                              self.tempdir)
+
+    def test_add_delta(self):
+        old = chunking.write_manifest(self._manifest('old', self.data),
+                                      self.tempdir)
+        patched = self.data[:5000] + bytearray(b'patch') + self.data[5000:]
+        new = chunking.write_manifest(self._manifest('new', patched),
+                                      self.tempdir)
+        image_info = {'image_id': 'new', 'manifest': new}
+
+        result = chunking.add_delta(FakeNode([old]), image_info)
+        self.assertEqual([old], result['base_manifests'])
+        self.assertTrue(0 < len(result['chunks']) < 3)
+        self.assertNotIn('chunks', image_info)
+
+    def test_add_delta_same_image(self):
+        digest = chunking.write_manifest(self._manifest('old', self.data),
+                                         self.tempdir)
+        image_info = {'image_id': 'old', 'manifest': digest}
+
+        result = chunking.add_delta(FakeNode([digest]), image_info)
+        self.assertEqual([], result['chunks'])
+
+    def test_add_delta_nothing_cached(self):
+        image_info = {'image_id': 'new', 'manifest': 'abc'}
+        self.assertEqual(image_info,
+                         chunking.add_delta(FakeNode(), image_info))
+
+    def test_add_delta_unknown_manifest(self):
+        image_info = {'image_id': 'new', 'manifest': 'abc'}
+        self.assertEqual(image_info,
+                         chunking.add_delta(FakeNode(['def']), image_info))
@@ -0,0 +1,64 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import json
+import subprocess
+import sys
+
+import ironic_teeth_driver
+
+import mock
+import unittest
+
+
+class TestTeethDriver(unittest.TestCase):
+    @mock.patch('ironic.openstack.common.importutils.import_module')
+    def test_interfaces_built_on_first_use(self, import_mock):
+        driver = ironic_teeth_driver.TeethDriver()
+        self.assertFalse(import_mock.called)
+
+        deploy = driver.deploy
+        import_mock.assert_called_once_with('ironic_teeth_driver.teeth')
+        self.assertEqual(import_mock.return_value.TeethDeploy.return_value,
+                         deploy)
+        self.assertEqual(deploy, driver.deploy)
+        self.assertEqual(1, import_mock.call_count)
+
+    @mock.patch('ironic.openstack.common.importutils.import_module')
+    def test_interfaces_per_driver(self, import_mock):
+        import_mock.return_value.TeethVendorInterface.side_effect = [
+            mock.sentinel.vendor1, mock.sentinel.vendor2]
+
+        self.assertEqual(mock.sentinel.vendor1,
+                         ironic_teeth_driver.TeethDriver().vendor)
+        self.assertEqual(mock.sentinel.vendor2,
+                         ironic_teeth_driver.TeethDriver().vendor)
+
+    def test_construction_imports_nothing_heavy(self):
+        # Other tests have imported everything already, so check in a
+        # fresh interpreter.
+        child = ('import json, sys\n'
+                 'import ironic_teeth_driver\n'
+                 'ironic_teeth_driver.TeethDriver()\n'
+                 'print(json.dumps(sorted(sys.modules)))\n')
+        output = subprocess.check_output([sys.executable, '-c', child])
+        modules = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        for module in ('requests',
+                       'ironic.drivers.modules.ipmitool',
+                       'ironic_teeth_driver.power',
+                       'ironic_teeth_driver.rest',
+                       'ironic_teeth_driver.teeth',
+                       'ironic_teeth_driver.vendor'):
+            self.assertNotIn(module, modules)
@@ -0,0 +1,213 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from ironic.common import exception
+from ironic_teeth_driver import exceptions
+from ironic_teeth_driver import hardware_index
+
+import mock
+import unittest
+
+
+class TestHardwareIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = hardware_index.HardwareIndex()
+        build_patcher = mock.patch.object(self.index, '_build')
+        self.build_mock = build_patcher.start()
+        self.addCleanup(build_patcher.stop)
+        self.build_mock.return_value = {
+            ('system_serial', 'SERIAL1'): set(['node-1']),
+            ('bmc_address', '10.0.0.2'): set(['node-2']),
+            ('disk_serial', 'DISK1'): set(['node-1', 'node-2']),
+        }
+        macs_patcher = mock.patch.object(self.index, '_match_macs')
+        self.macs_mock = macs_patcher.start()
+        self.addCleanup(macs_patcher.stop)
+        self.macs_mock.return_value = []
+
+    def test_find_by_mac(self):
+        self.macs_mock.return_value = [('node-3', 'aa:bb:cc:dd:ee:ff')]
+
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'AA:BB:CC:DD:EE:FF')])
+        self.assertEqual('node-3', node_uuid)
+        self.macs_mock.assert_called_once_with(['aa:bb:cc:dd:ee:ff'])
+
+    def test_find_by_system_serial(self):
+        node_uuid = self.index.find_node_uuid(
+            [('system_serial', ' serial1 ')])
+        self.assertEqual('node-1', node_uuid)
+
+    def test_find_macs_single_query(self):
+        self.macs_mock.return_value = [('node-3', 'aa:bb:cc:dd:ee:01'),
+                                       ('node-3', 'aa:bb:cc:dd:ee:02')]
+
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'aa:bb:cc:dd:ee:01'),
+             ('mac_address', 'aa:bb:cc:dd:ee:02')])
+        self.assertEqual('node-3', node_uuid)
+        self.assertEqual(1, self.macs_mock.call_count)
+
+    def test_find_strongest_match_wins(self):
+        # A NIC moved from node-3 into node-1 still reports node-1's
+        # serial.
+        self.macs_mock.return_value = [('node-3', 'aa:bb:cc:dd:ee:ff')]
+
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'aa:bb:cc:dd:ee:ff'),
+             ('system_serial', 'SERIAL1')])
+        self.assertEqual('node-1', node_uuid)
+
+    def test_find_tie(self):
+        self.macs_mock.return_value = [('node-1', 'aa:bb:cc:dd:ee:01'),
+                                       ('node-3', 'aa:bb:cc:dd:ee:02')]
+
+        self.assertRaises(exceptions.MultipleChassisFound,
+                          self.index.find_node_uuid,
+                          [('mac_address', 'aa:bb:cc:dd:ee:01'),
+                           ('mac_address', 'aa:bb:cc:dd:ee:02')])
+
+    def test_find_disk_serial_alone_not_enough(self):
+        self.assertRaises(exception.NotFound,
+                          self.index.find_node_uuid,
+                          [('disk_serial', 'DISK1')])
+
+    def test_find_disk_serial_breaks_tie(self):
+        self.macs_mock.return_value = [('node-1', 'aa:bb:cc:dd:ee:01'),
+                                       ('node-3', 'aa:bb:cc:dd:ee:02')]
+
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'aa:bb:cc:dd:ee:01'),
+             ('mac_address', 'aa:bb:cc:dd:ee:02'),
+             ('disk_serial', 'DISK1')])
+        self.assertEqual('node-1', node_uuid)
+
+    def test_find_no_usable_keys(self):
+        self.assertRaises(exception.NotFound,
+                          self.index.find_node_uuid,
+                          [('memory_gb', '64')])
+        self.assertFalse(self.build_mock.called)
+
+    def test_find_miss_does_not_rebuild(self):
+        self.assertRaises(exception.NotFound,
+                          self.index.find_node_uuid,
+                          [('system_serial', 'SERIAL9')])
+        self.assertRaises(exception.NotFound,
+                          self.index.find_node_uuid,
+                          [('system_serial', 'SERIAL9')])
+        self.assertEqual(1, self.build_mock.call_count)
+
+    @mock.patch('eventlet.greenthread.spawn_n')
+    @mock.patch('time.time')
+    def test_stale_index_rebuilt_in_background(self, time_mock, spawn_mock):
+        time_mock.return_value = 1000
+        self.index.find_node_uuid([('system_serial', 'SERIAL1')])
+
+        # The node was enrolled meanwhile.
+        self.build_mock.return_value = {
+            ('system_serial', 'SERIAL9'): set(['node-9']),
+        }
+        time_mock.return_value = 2000
+        # The stale index answers until the rebuild is done.
+        self.assertRaises(exception.NotFound,
+                          self.index.find_node_uuid,
+                          [('system_serial', 'SERIAL9')])
+        self.index.find_node_uuid([('system_serial', 'SERIAL1')])
+        spawn_mock.assert_called_once_with(
+            self.index._refresh_in_background)
+        self.assertEqual(1, self.build_mock.call_count)
+
+        self.index._refresh_in_background()
+        node_uuid = self.index.find_node_uuid(
+            [('system_serial', 'SERIAL9')])
+        self.assertEqual('node-9', node_uuid)
+        self.assertEqual(2, self.build_mock.call_count)
+
+    @mock.patch('eventlet.greenthread.spawn_n')
+    @mock.patch('time.time')
+    def test_background_rebuild_failure(self, time_mock, spawn_mock):
+        time_mock.return_value = 1000
+        self.index.find_node_uuid([('system_serial', 'SERIAL1')])
+        self.build_mock.side_effect = RuntimeError('db gone')
+        time_mock.return_value = 2000
+        self.index.find_node_uuid([('system_serial', 'SERIAL1')])
+
+        self.index._refresh_in_background()
+        # The old index is kept, and the next lookup tries again.
+        self.index.find_node_uuid([('system_serial', 'SERIAL1')])
+        self.assertEqual(2, spawn_mock.call_count)
+
+    def test_find_primed_mac(self):
+        self.index.prime(ports=[('node-3', 'AA:BB:CC:DD:EE:FF')])
+
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'aa:bb:cc:dd:ee:ff')])
+        self.assertEqual('node-3', node_uuid)
+        # No MAC is left to query.
+        self.macs_mock.assert_called_once_with([])
+
+    def test_refresh_drops_primed_macs(self):
+        self.index.prime(ports=[('node-3', 'aa:bb:cc:dd:ee:ff')])
+        self.index.refresh()
+
+        self.macs_mock.return_value = [('node-4', 'aa:bb:cc:dd:ee:ff')]
+        node_uuid = self.index.find_node_uuid(
+            [('mac_address', 'aa:bb:cc:dd:ee:ff')])
+        self.assertEqual('node-4', node_uuid)
+        self.assertEqual(1, self.build_mock.call_count)
+
+    def test_prime_nodes(self):
+        node = FakeNode({'system_serial': 'serial9'}, uuid='node-9',
+                        driver_info={'ipmi_address': '10.0.0.9'})
+        self.index.prime([node], [('node-9', 'aa:bb:cc:dd:ee:09')])
+        self.assertFalse(self.build_mock.called)
+
+        # The first lookup builds the index, and keeps what was primed.
+        self.assertEqual('node-9', self.index.find_node_uuid(
+            [('system_serial', 'SERIAL9')]))
+        self.assertEqual('node-9', self.index.find_node_uuid(
+            [('bmc_address', '10.0.0.9')]))
+        self.assertEqual('node-1', self.index.find_node_uuid(
+            [('system_serial', 'SERIAL1')]))
+        self.assertEqual(1, self.build_mock.call_count)
+
+
+class FakeNode(object):
+    def __init__(self, properties=None, uuid='fake-uuid', driver_info=None):
+        self.uuid = uuid
+        self.properties = properties
+        self.driver_info = driver_info or {}
+
+
+class TestUpdateProperties(unittest.TestCase):
+    def test_update(self):
+        node = FakeNode({'memory_mb': 1024})
+        keys = [('mac_address', 'aa:bb:cc:dd:ee:ff'),
+                ('system_serial', 'SERIAL1'),
+                ('disk_serial', 'DISK2'),
+                ('disk_serial', 'DISK1')]
+
+        self.assertTrue(hardware_index.update_properties(node, keys))
+        self.assertEqual({'memory_mb': 1024,
+                          'system_serial': 'SERIAL1',
+                          'disk_serials': ['DISK1', 'DISK2']},
+                         node.properties)
+        self.assertFalse(hardware_index.update_properties(node, keys))
+
+    def test_no_serials(self):
+        node = FakeNode()
+        self.assertFalse(hardware_index.update_properties(
+            node, [('mac_address', 'aa:bb:cc:dd:ee:ff')]))
+        self.assertEqual(None, node.properties)
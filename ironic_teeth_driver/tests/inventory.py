@@ -0,0 +1,101 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from oslo.config import cfg
+
+from ironic_teeth_driver import inventory
+
+import unittest
+
+CONF = cfg.CONF
+
+NIC = {'id': 'aa:bb:cc:dd:ee:ff', 'type': 'mac_address'}
+DISK = {'id': 'DISK1', 'type': 'disk_serial', 'size': 1000}
+MEMORY = {'id': '64', 'type': 'memory_gb'}
+
+
+class FakeNode(object):
+    def __init__(self, uuid='fake-uuid'):
+        self.uuid = uuid
+        self.extra = {}
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeNode()
+
+    def tearDown(self):
+        CONF.clear_override('inventory_history_length',
+                            group='teeth_driver')
+
+    def test_serialize_order_independent(self):
+        body1, digest1 = inventory.serialize([NIC, DISK, MEMORY])
+        body2, digest2 = inventory.serialize([MEMORY, NIC, DISK, NIC])
+        self.assertEqual(body1, body2)
+        self.assertEqual(digest1, digest2)
+
+    def test_diff(self):
+        disk2 = dict(DISK, size=2000)
+        self.assertEqual({'added': [disk2], 'removed': [DISK]},
+                         inventory.diff([NIC, DISK], [NIC, disk2]))
+
+    def test_update_first(self):
+        self.assertTrue(inventory.update_inventory(self.node, [NIC, DISK]))
+        info = self.node.extra['inventory']
+        self.assertEqual(1, len(info['history']))
+        self.assertNotIn('added', info['history'][0])
+        self.assertEqual(info['digest'], info['history'][0]['digest'])
+        self.assertEqual(sorted([NIC, DISK], key=inventory._canonical),
+                         inventory.get_inventory(self.node))
+
+    def test_update_unchanged(self):
+        inventory.update_inventory(self.node, [NIC, DISK])
+        info = dict(self.node.extra['inventory'])
+        self.assertFalse(inventory.update_inventory(self.node, [DISK, NIC]))
+        self.assertEqual(info, self.node.extra['inventory'])
+
+    def test_update_changed(self):
+        inventory.update_inventory(self.node, [NIC, DISK])
+        old_digest = self.node.extra['inventory']['digest']
+
+        self.assertTrue(inventory.update_inventory(self.node, [NIC, MEMORY]))
+        info = self.node.extra['inventory']
+        self.assertEqual(2, len(info['history']))
+        self.assertEqual([MEMORY], info['history'][1]['added'])
+        self.assertEqual([DISK], info['history'][1]['removed'])
+        self.assertNotEqual(old_digest, info['digest'])
+        self.assertEqual(sorted([NIC, MEMORY], key=inventory._canonical),
+                         inventory.get_inventory(self.node))
+
+    def test_update_previous_missing(self):
+        # Inventories used to be kept in the conductor's blob store, and
+        # only their digest with the node.
+        self.node.extra['inventory'] = {'digest': 'abc', 'history': []}
+
+        self.assertTrue(inventory.update_inventory(self.node, [NIC, DISK]))
+        self.assertNotIn('added', self.node.extra['inventory']['history'][0])
+        self.assertEqual(2, len(inventory.get_inventory(self.node)))
+
+    def test_update_history_bounded(self):
+        CONF.set_override('inventory_history_length', 2,
+                          group='teeth_driver')
+        for size in range(5):
+            inventory.update_inventory(self.node, [dict(DISK, size=size)])
+        history = self.node.extra['inventory']['history']
+        self.assertEqual(2, len(history))
+        self.assertEqual([dict(DISK, size=4)], history[1]['added'])
+
+    def test_get_inventory_none(self):
+        self.assertEqual(None, inventory.get_inventory(self.node))
@@ -0,0 +1,95 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+
+from oslo.config import cfg
+
+from ironic_teeth_driver import log_utils
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class TestRateLimitedLogger(unittest.TestCase):
+    def setUp(self):
+        self.logger = mock.Mock()
+        self.logger.isEnabledFor.return_value = True
+        self.log = log_utils.RateLimitedLogger(self.logger)
+        CONF.set_override('log_rate_limit_interval', 60,
+                          group='teeth_driver')
+        CONF.set_override('log_rate_limit_burst', 2, group='teeth_driver')
+        log_utils._SUPPRESSED.clear()
+
+    def tearDown(self):
+        CONF.clear_override('log_rate_limit_interval', group='teeth_driver')
+        CONF.clear_override('log_rate_limit_burst', group='teeth_driver')
+
+    def test_disabled_level_not_formatted(self):
+        self.logger.isEnabledFor.return_value = False
+        func = mock.Mock()
+
+        self.log.debug('Node %s', log_utils.Deferred(func, 'node'))
+        self.assertFalse(self.logger.log.called)
+        self.assertFalse(func.called)
+
+    def test_deferred(self):
+        func = mock.Mock(return_value='url')
+        deferred = log_utils.Deferred(func, 'node', wait=True)
+
+        self.assertEqual('Node url', 'Node %s' % deferred)
+        func.assert_called_once_with('node', wait=True)
+
+    def test_no_key_not_limited(self):
+        for _ in range(5):
+            self.log.info('Node %s', 'node')
+        self.assertEqual(5, self.logger.log.call_count)
+        self.logger.log.assert_called_with(logging.INFO, 'Node %s', 'node',
+                                           exc_info=None)
+
+    @mock.patch('time.time')
+    def test_rate_limited(self, time_mock):
+        time_mock.return_value = 1000
+        for _ in range(5):
+            self.log.warning('Bad MAC %s', 'mac1', key='mac1')
+        self.log.warning('Bad MAC %s', 'mac2', key='mac2')
+        self.assertEqual(3, self.logger.log.call_count)
+        self.assertEqual({'Bad MAC %s': 3}, log_utils.get_suppressed())
+
+        time_mock.return_value = 1060
+        self.log.warning('Bad MAC %s', 'mac1', key='mac1')
+        self.logger.log.assert_called_with(
+            logging.WARNING, 'Bad MAC %s (3 similar messages suppressed)',
+            'mac1', exc_info=None)
+
+    def test_rate_limit_disabled(self):
+        CONF.set_override('log_rate_limit_interval', 0,
+                          group='teeth_driver')
+        for _ in range(5):
+            self.log.warning('Bad MAC %s', 'mac1', key='mac1')
+        self.assertEqual(5, self.logger.log.call_count)
+
+    @mock.patch.object(log_utils, 'MAX_KEYS', 2)
+    def test_keys_bounded(self):
+        for i in range(5):
+            self.log.warning('Bad MAC %s', i, key=i)
+        self.assertTrue(len(self.log._windows) <= 2)
+
+    def test_exception(self):
+        self.log.exception('Failed')
+        self.logger.log.assert_called_once_with(logging.ERROR, 'Failed',
+                                                exc_info=True)
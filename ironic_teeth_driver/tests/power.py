@@ -0,0 +1,284 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import datetime
+
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic.common import states
+from ironic_teeth_driver import power
+from ironic_teeth_driver import rest
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class FakeNode(object):
+    def __init__(self, uuid, bmc=None):
+        self.uuid = uuid
+        self.driver_info = {}
+        self.instance_info = {}
+        if bmc:
+            self.driver_info['ipmi_address'] = bmc
+
+
+class FakeTask(object):
+    def __init__(self):
+        self.context = {}
+
+
+@mock.patch('eventlet.greenthread.sleep')
+@mock.patch('ironic.conductor.utils.node_power_action')
+class TestNodePowerActions(unittest.TestCase):
+    def setUp(self):
+        self.task = FakeTask()
+        CONF.set_override('bmc_min_interval', 0, group='teeth_driver')
+        limiters_patcher = mock.patch.dict(power._LIMITERS, clear=True)
+        limiters_patcher.start()
+        self.addCleanup(limiters_patcher.stop)
+
+    def tearDown(self):
+        CONF.clear_override('bmc_min_interval', group='teeth_driver')
+
+    def test_all_succeed(self, power_mock, sleep_mock):
+        nodes = [FakeNode('node{0}'.format(i)) for i in range(10)]
+
+        results = power.node_power_actions(self.task, nodes, states.REBOOT)
+        self.assertEqual(dict((node.uuid, None) for node in nodes), results)
+        self.assertEqual(10, power_mock.call_count)
+        power_mock.assert_any_call(self.task, nodes[3], states.REBOOT)
+
+    def test_retry(self, power_mock, sleep_mock):
+        CONF.set_override('power_action_retries', 2, group='teeth_driver')
+        self.addCleanup(CONF.clear_override, 'power_action_retries',
+                        group='teeth_driver')
+        error = exception.IronicException('BMC busy')
+        power_mock.side_effect = [error, None]
+        node = FakeNode('node')
+
+        results = power.node_power_actions(self.task, [node],
+                                           states.POWER_OFF)
+        self.assertEqual({'node': None}, results)
+        self.assertEqual(2, power_mock.call_count)
+        self.assertEqual(1, sleep_mock.call_count)
+
+    def test_gives_up(self, power_mock, sleep_mock):
+        CONF.set_override('power_action_retries', 1, group='teeth_driver')
+        self.addCleanup(CONF.clear_override, 'power_action_retries',
+                        group='teeth_driver')
+        error = exception.IronicException('BMC gone')
+        ok_node = FakeNode('ok')
+        bad_node = FakeNode('bad')
+
+        def act(task, node, state):
+            if node is bad_node:
+                raise error
+        power_mock.side_effect = act
+
+        results = power.node_power_actions(self.task, [ok_node, bad_node],
+                                           states.REBOOT)
+        self.assertEqual({'ok': None, 'bad': error}, results)
+        self.assertEqual(3, power_mock.call_count)
+
+    def test_bmc_rate_limit(self, power_mock, sleep_mock):
+        CONF.set_override('bmc_min_interval', 60, group='teeth_driver')
+        nodes = [FakeNode('a', bmc='10.0.0.1'),
+                 FakeNode('b', bmc='10.0.0.1'),
+                 FakeNode('c', bmc='10.0.0.2')]
+
+        power.node_power_actions(self.task, nodes, states.REBOOT)
+        # Only the second action against 10.0.0.1 has to wait.
+        self.assertEqual(1, sleep_mock.call_count)
+
+    def test_bmc_rate_limit_across_calls(self, power_mock, sleep_mock):
+        CONF.set_override('bmc_min_interval', 60, group='teeth_driver')
+        # Single node tear downs each make their own call.
+        power.node_power_actions(self.task, [FakeNode('a', bmc='10.0.0.1')],
+                                 states.REBOOT)
+        power.node_power_actions(self.task, [FakeNode('b', bmc='10.0.0.1')],
+                                 states.REBOOT)
+        self.assertEqual(1, sleep_mock.call_count)
+
+
+@mock.patch('time.time')
+class TestPowerStateCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = power.PowerStateCache()
+        CONF.set_override('power_state_heartbeat_ttl', 300,
+                          group='teeth_driver')
+        CONF.set_override('power_state_heartbeat_grace', 60,
+                          group='teeth_driver')
+
+    def tearDown(self):
+        CONF.clear_override('power_state_heartbeat_ttl',
+                            group='teeth_driver')
+        CONF.clear_override('power_state_heartbeat_grace',
+                            group='teeth_driver')
+
+    def test_heartbeat(self, time_mock):
+        time_mock.return_value = 1000
+        self.assertEqual(None, self.cache.get('node'))
+        self.cache.heartbeat('node')
+        self.assertEqual(states.POWER_ON, self.cache.get('node'))
+
+        time_mock.return_value = 1300
+        self.assertEqual(None, self.cache.get('node'))
+        self.assertEqual({'hits': 1, 'misses': 2, 'nodes': 1},
+                         self.cache.get_stats())
+
+    def test_older_evidence_ignored(self, time_mock):
+        time_mock.return_value = 1000
+        self.cache.record('node', states.POWER_OFF, 60)
+        # A heartbeat sent before the node was powered off.
+        self.cache.heartbeat('node', observed_at=990)
+        self.assertEqual(states.POWER_OFF, self.cache.get('node'))
+
+    def test_invalidate(self, time_mock):
+        time_mock.return_value = 1000
+        self.cache.heartbeat('node')
+        self.cache.invalidate('node')
+        self.assertEqual(None, self.cache.get('node'))
+        self.cache.heartbeat('node', observed_at=999)
+        self.assertEqual(None, self.cache.get('node'))
+
+    def test_heartbeat_after_power_action(self, time_mock):
+        time_mock.return_value = 1000
+        self.cache.invalidate('node')
+        self.cache.record('node', states.POWER_OFF, 30)
+
+        # Handled after the power off, but maybe sent before it.
+        time_mock.return_value = 1010
+        self.cache.heartbeat('node')
+        self.assertEqual(states.POWER_OFF, self.cache.get('node'))
+
+        time_mock.return_value = 1060
+        self.cache.heartbeat('node')
+        self.assertEqual(states.POWER_ON, self.cache.get('node'))
+
+    def test_only_on_and_off_cached(self, time_mock):
+        time_mock.return_value = 1000
+        self.cache.record('node', states.ERROR, 60)
+        self.assertEqual(None, self.cache.get('node'))
+
+    def test_disabled(self, time_mock):
+        time_mock.return_value = 1000
+        CONF.set_override('power_state_heartbeat_ttl', 0,
+                          group='teeth_driver')
+        self.cache.heartbeat('node')
+        self.assertEqual(None, self.cache.get('node'))
+
+
+@mock.patch('ironic.openstack.common.importutils.import_module')
+class TestCachedPower(unittest.TestCase):
+    def setUp(self):
+        self.task = FakeTask()
+        self.node = FakeNode('node')
+        cache_patcher = mock.patch.object(power, '_POWER_CACHE',
+                                          power.PowerStateCache())
+        self.cache = cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def _get_ipmi(self, import_mock):
+        return import_mock.return_value.IPMIPower.return_value
+
+    def test_get_power_state_from_heartbeat(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+        self.cache.heartbeat('node')
+
+        driver = power.CachedPower()
+        self.assertEqual(states.POWER_ON,
+                         driver.get_power_state(self.task, self.node))
+        self.assertFalse(ipmi.get_power_state.called)
+
+    def test_get_power_state_from_last_heartbeat(self, import_mock):
+        # Recorded by a heartbeat handled on another conductor.
+        ipmi = self._get_ipmi(import_mock)
+        self.node.instance_info['last_heartbeat'] = (
+            datetime.datetime.now() - datetime.timedelta(seconds=10))
+
+        driver = power.CachedPower()
+        self.assertEqual(states.POWER_ON,
+                         driver.get_power_state(self.task, self.node))
+        self.assertFalse(ipmi.get_power_state.called)
+
+    def test_get_power_state_stale_last_heartbeat(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+        ipmi.get_power_state.return_value = states.POWER_OFF
+        self.node.instance_info['last_heartbeat'] = (
+            datetime.datetime.now() - datetime.timedelta(days=1)
+        ).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+        driver = power.CachedPower()
+        self.assertEqual(states.POWER_OFF,
+                         driver.get_power_state(self.task, self.node))
+        self.assertEqual({'hits': 0, 'misses': 1, 'nodes': 1},
+                         self.cache.get_stats())
+
+    def test_get_power_state_cached(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+        ipmi.get_power_state.return_value = states.POWER_OFF
+
+        driver = power.CachedPower()
+        for _ in range(3):
+            self.assertEqual(states.POWER_OFF,
+                             driver.get_power_state(self.task, self.node))
+        ipmi.get_power_state.assert_called_once_with(self.task, self.node)
+
+    def test_set_power_state(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+        self.cache.heartbeat('node')
+
+        driver = power.CachedPower()
+        driver.set_power_state(self.task, self.node, states.POWER_OFF)
+        ipmi.set_power_state.assert_called_once_with(self.task, self.node,
+                                                     states.POWER_OFF)
+        self.assertEqual(states.POWER_OFF,
+                         driver.get_power_state(self.task, self.node))
+        self.assertFalse(ipmi.get_power_state.called)
+
+    def test_set_power_state_failed(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+        ipmi.set_power_state.side_effect = exception.IronicException('BMC')
+        ipmi.get_power_state.return_value = states.POWER_ON
+        self.cache.heartbeat('node')
+
+        driver = power.CachedPower()
+        self.assertRaises(exception.IronicException,
+                          driver.set_power_state, self.task, self.node,
+                          states.POWER_OFF)
+        # The state is unknown, so the BMC is asked.
+        self.assertEqual(states.POWER_ON,
+                         driver.get_power_state(self.task, self.node))
+        ipmi.get_power_state.assert_called_once_with(self.task, self.node)
+
+    def test_reboot(self, import_mock):
+        ipmi = self._get_ipmi(import_mock)
+
+        driver = power.CachedPower()
+        driver.reboot(self.task, self.node)
+        ipmi.reboot.assert_called_once_with(self.task, self.node)
+        self.assertEqual(states.POWER_ON,
+                         driver.get_power_state(self.task, self.node))
+
+    def test_power_actions_forget_agent(self, import_mock):
+        self.node.driver_info['agent_url'] = 'http://10.0.0.1:9999'
+        driver = power.CachedPower()
+        with mock.patch.dict(rest._CAPABILITIES,
+                             {'http://10.0.0.1:9999': mock.Mock()}):
+            driver.reboot(self.task, self.node)
+            self.assertFalse(rest.has_capabilities('http://10.0.0.1:9999'))
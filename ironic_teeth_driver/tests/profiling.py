@@ -0,0 +1,101 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import pstats
+import shutil
+import tempfile
+
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic_teeth_driver import profiling
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+def work(n):
+    return sum(range(n))
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.profiler = profiling.Profiler()
+        patcher = mock.patch.object(profiling, '_PROFILER', self.profiler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        CONF.clear_override('profiling_sample_rate', group='teeth_driver')
+
+    def test_call_disabled(self):
+        with mock.patch.object(self.profiler, 'run') as run_mock:
+            self.assertEqual(45, profiling.call('work', work, 10))
+        self.assertFalse(run_mock.called)
+
+    @mock.patch('random.random')
+    def test_call_sampled(self, random_mock):
+        CONF.set_override('profiling_sample_rate', 0.5,
+                          group='teeth_driver')
+        random_mock.side_effect = [0.1, 0.9, 0.2]
+
+        for _ in range(3):
+            self.assertEqual(45, profiling.call('work', work, 10))
+        report = self.profiler.get_report()
+        self.assertEqual(2, report['work']['calls'])
+        self.assertIn('work', report['work']['report'])
+
+    def test_profiled(self):
+        CONF.set_override('profiling_sample_rate', 1.0,
+                          group='teeth_driver')
+        profiled_work = profiling.profiled('work')(work)
+
+        self.assertEqual(45, profiled_work(10))
+        self.assertEqual('work', profiled_work.__name__)
+        self.assertEqual(1, self.profiler.get_report()['work']['calls'])
+
+    def test_run_exception(self):
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, self.profiler.run, 'fail', fail)
+        self.assertEqual(1, self.profiler.get_report()['fail']['calls'])
+        self.assertFalse(self.profiler._busy)
+
+    def test_run_nested_not_profiled(self):
+        def outer():
+            return self.profiler.run('inner', work, 10)
+
+        self.assertEqual(45, self.profiler.run('outer', outer))
+        self.assertEqual(['outer'], list(self.profiler.get_report()))
+
+    def test_get_report_bad_sort(self):
+        self.assertRaises(exception.InvalidParameterValue,
+                          self.profiler.get_report, sort='bogus')
+
+    def test_dump_and_reset(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.profiler.run('work', work, 10)
+
+        paths = self.profiler.dump(os.path.join(tempdir, 'profiles'))
+        self.assertEqual(1, len(paths))
+        self.assertTrue(pstats.Stats(paths[0]).total_calls > 0)
+
+        self.profiler.reset()
+        self.assertEqual({}, self.profiler.get_report())
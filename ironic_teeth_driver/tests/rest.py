@@ -17,14 +17,19 @@ limitations under the License.
 import json
 import mock
 import requests
+import threading
+import time
+import zlib
 
+from ironic_teeth_driver import exceptions
 from ironic_teeth_driver import rest as agent_client
 from ironic_teeth_driver import tests
 
 
 class MockResponse(object):
-    def __init__(self, data):
+    def __init__(self, data, status_code=200):
         self.text = json.dumps(data)
+        self.status_code = status_code
 
 
 class MockNode(object):
@@ -40,6 +45,10 @@ class TestRESTAgentClient(tests.TeethMockTestUtilities):
         self.client = agent_client.RESTAgentClient()
         self.client.session = mock.Mock(autospec=requests.Session)
         self.node = MockNode()
+        self.capabilities = agent_client.AgentCapabilities()
+        agent_client._CAPABILITIES.clear()
+        agent_client._CAPABILITIES[self.node.driver_info['agent_url']] = \
+            self.capabilities
 
     @mock.patch('uuid.uuid4', mock.MagicMock(return_value='uuid'))
     def test_cache_image(self):
@@ -112,8 +121,21 @@ class TestRESTAgentClient(tests.TeethMockTestUtilities):
                                          params=params,
                                          wait=False)
 
+    def test_erase_drives_resume(self):
+        _command = self._mock_attr(self.client, '_command')
+        key = 'lol'
+        drives = ['/dev/sda']
+        progress = {'/dev/sda': 1024}
+        params = {'key': key, 'drives': drives, 'progress': progress}
+
+        self.client.erase_drives(self.node, drives, key, progress=progress)
+        _command.assert_called_once_with(node=self.node,
+                                         method='decom.erase_drives',
+                                         params=params,
+                                         wait=False)
+
     def test_command(self):
-        response_data = {'status': 'ok'}
+        response_data = {'id': 'abc', 'command_status': 'RUNNING'}
         self.client.session.post.return_value = MockResponse(response_data)
         method = 'standby.run_image'
         image_info = {'image_id': 'test_image'}
@@ -124,9 +146,324 @@ class TestRESTAgentClient(tests.TeethMockTestUtilities):
         headers = {'Content-Type': 'application/json'}
 
         response = self.client._command(self.node, method, params)
-        self.assertEqual(response, response_data)
+        self.assertEqual('abc', response.id)
+        self.assertTrue(response.running)
         self.client.session.post.assert_called_once_with(
             url,
             data=body,
             headers=headers,
             params={'wait': 'false'})
+
+    def test_get_command_status(self):
+        response_data = {'id': 'abc', 'command_status': 'RUNNING'}
+        self.client.session.get.return_value = MockResponse(response_data)
+
+        response = self.client.get_command_status(self.node, 'abc')
+        self.assertEqual('abc', response.id)
+        self.assertEqual('RUNNING', response.status)
+        self.client.session.get.assert_called_once_with(
+            'http://127.0.0.1:9999/v1.0/commands/abc')
+
+    def test_command_rejected(self):
+        self.client.session.post.return_value = MockResponse(
+            {'type': 'InvalidCommandError', 'code': 400,
+             'message': 'Unknown command'}, 400)
+
+        self.assertRaises(exceptions.AgentExecutionError,
+                          self.client._command,
+                          self.node, 'standby.run_image', {})
+
+    def test_get_command_status_unknown(self):
+        self.client.session.get.return_value = MockResponse({}, 404)
+
+        response = self.client.get_command_status(self.node, 'abc')
+        self.assertEqual(None, response)
+
+    def test_batch(self):
+        self.capabilities.capabilities.add('batch')
+        results = [{'id': 'a', 'command_status': 'RUNNING'},
+                   {'id': 'b', 'command_status': 'RUNNING'}]
+        self.client.session.post.return_value = MockResponse(
+            {'results': results})
+        commands = [('decom.secure_drives', {'drives': ['/dev/sda']}),
+                    ('decom.erase_drives', {'drives': ['/dev/sda']})]
+
+        response = self.client.batch(self.node, commands)
+        self.assertEqual(['a', 'b'], [r.id for r in response])
+        self.assertEqual(1, self.client.session.post.call_count)
+        args, kwargs = self.client.session.post.call_args
+        self.assertEqual('http://127.0.0.1:9999/v1.0/commands/batch', args[0])
+        body = json.loads(kwargs['data'])
+        self.assertTrue(body['stop_on_error'])
+        self.assertEqual(['decom.secure_drives', 'decom.erase_drives'],
+                         [c['name'] for c in body['commands']])
+
+    def test_command_scheduled(self):
+        self.client.scheduler = mock.MagicMock()
+        self.client.session.post.return_value = MockResponse(
+            {'id': 'a', 'command_status': 'RUNNING'})
+
+        self.client.run_image(self.node)
+        self.client.scheduler.slot.assert_called_once_with('interactive')
+        self.client.scheduler.slot.reset_mock()
+
+        self.capabilities.capabilities.add('batch')
+        self.client.session.post.return_value = MockResponse(
+            {'results': [{'id': 'a', 'command_status': 'RUNNING'}]})
+        self.client.secure_and_erase_drives(self.node, ['/dev/sda'], 'key')
+        self.client.scheduler.slot.assert_called_once_with('normal')
+
+    def test_batch_fallback(self):
+        self.capabilities.capabilities.add('batch')
+        self.client.session.post.return_value = MockResponse({}, 404)
+        _command = self._mock_attr(self.client, '_command')
+        _command.return_value = agent_client.CommandResult(id='a',
+                                                           status='RUNNING')
+        commands = [('standby.prepare_image', {}),
+                    ('standby.run_image', {})]
+
+        response = self.client.batch(self.node, commands)
+        # Only the first command is sent, without waiting for it.
+        self.assertEqual(['a'], [r.id for r in response])
+        _command.assert_called_once_with(node=self.node,
+                                         method='standby.prepare_image',
+                                         params={},
+                                         wait=False)
+        self.assertFalse(self.client.supports_batch(self.node))
+
+        # Later batches go straight to single commands.
+        self.client.batch(self.node, commands)
+        self.assertEqual(1, self.client.session.post.call_count)
+        self.assertEqual(2, _command.call_count)
+
+    def test_prepare_and_run_image(self):
+        batch = self._mock_attr(self.client, 'batch')
+        image_info = {'image_id': 'image'}
+        params = {
+            'image_info': image_info,
+            'metadata': {},
+            'files': {},
+        }
+
+        self.client.prepare_and_run_image(self.node, image_info, {}, {})
+        batch.assert_called_once_with(self.node,
+                                      [('standby.prepare_image', params),
+                                       ('standby.run_image', {})],
+                                      wait=False)
+
+    def test_secure_and_erase_drives(self):
+        batch = self._mock_attr(self.client, 'batch')
+        params = {'drives': ['/dev/sda'], 'key': 'lol'}
+
+        self.client.secure_and_erase_drives(self.node, ['/dev/sda'], 'lol')
+        batch.assert_called_once_with(self.node,
+                                      [('decom.secure_drives', params),
+                                       ('decom.erase_drives', params)],
+                                      wait=False)
+
+    def test_get_capabilities_discovery(self):
+        agent_client._CAPABILITIES.clear()
+        self.client.session.get.return_value = MockResponse({
+            'versions': [{'id': 'v1.0'}, {'id': 'v9.9'}],
+            'capabilities': ['batch', 'gzip'],
+        })
+
+        capabilities = self.client.get_capabilities(self.node)
+        self.assertEqual('v1.0', capabilities.version)
+        self.assertTrue(capabilities.supports('batch'))
+        self.assertTrue(self.client.supports_batch(self.node))
+
+        # Cached until the agent restarts.
+        agent_url = self.node.driver_info['agent_url']
+        self.client.get_capabilities(self.node)
+        self.assertEqual(1, self.client.session.get.call_count)
+        self.assertTrue(agent_client.has_capabilities(agent_url))
+        agent_client.invalidate_capabilities(agent_url)
+        self.assertFalse(agent_client.has_capabilities(agent_url))
+        self.client.get_capabilities(self.node)
+        self.assertEqual(2, self.client.session.get.call_count)
+
+    def test_get_capabilities_old_agent(self):
+        agent_client._CAPABILITIES.clear()
+        self.client.session.get.return_value = MockResponse({}, 404)
+
+        capabilities = self.client.get_capabilities(self.node)
+        self.assertEqual('v1.0', capabilities.version)
+        self.assertFalse(self.client.supports_batch(self.node))
+        self.assertTrue(agent_client.has_capabilities(
+            self.node.driver_info['agent_url']))
+
+    def test_get_capabilities_unreachable(self):
+        agent_client._CAPABILITIES.clear()
+        self.client.session.get.side_effect = requests.ConnectionError()
+
+        capabilities = self.client.get_capabilities(self.node)
+        self.assertEqual('v1.0', capabilities.version)
+        self.assertEqual(set(), capabilities.capabilities)
+        # Asked again once it can be reached.
+        agent_url = self.node.driver_info['agent_url']
+        self.assertFalse(agent_client.has_capabilities(agent_url))
+
+    def test_command_gzip(self):
+        self.capabilities.capabilities.add('gzip')
+        self.client.session.post.return_value = MockResponse({})
+        params = {'data': 'x' * agent_client.GZIP_MIN_SIZE}
+
+        self.client._command(self.node, 'standby.prepare_image', params)
+        args, kwargs = self.client.session.post.call_args
+        self.assertEqual('gzip', kwargs['headers']['Content-Encoding'])
+        body = zlib.decompress(kwargs['data'], 31)
+        self.assertEqual(params, json.loads(body.decode('utf-8'))['params'])
+
+    def test_command_small_body_not_compressed(self):
+        self.capabilities.capabilities.add('gzip')
+        self.client.session.post.return_value = MockResponse({})
+
+        self.client._command(self.node, 'standby.run_image', {})
+        args, kwargs = self.client.session.post.call_args
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+
+    def test_command_coalesces_concurrent_duplicates(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def post(*args, **kwargs):
+            calls.append(args)
+            started.set()
+            release.wait()
+            return MockResponse({'id': 'abc'})
+        self.client.session.post.side_effect = post
+        params = {'image_info': {'image_id': 'image'}, 'force': False}
+        results = []
+
+        def command():
+            results.append(self.client._command(self.node,
+                                                'standby.cache_image',
+                                                params))
+        first = threading.Thread(target=command)
+        first.start()
+        started.wait()
+        second = threading.Thread(target=command)
+        second.start()
+        # Give the second caller time to attach to the pending command.
+        time.sleep(0.1)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['abc', 'abc'], [r.id for r in results])
+        self.assertTrue(results[0] is results[1])
+
+    def test_command_leader_killed(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        class Killed(BaseException):
+            pass
+
+        def post(*args, **kwargs):
+            started.set()
+            release.wait()
+            raise Killed()
+        self.client.session.post.side_effect = post
+        params = {'image_info': {'image_id': 'image'}, 'force': False}
+        errors = []
+
+        def command():
+            try:
+                self.client._command(self.node, 'standby.cache_image',
+                                     params)
+            except BaseException as e:
+                errors.append(e)
+        first = threading.Thread(target=command)
+        first.start()
+        started.wait()
+        second = threading.Thread(target=command)
+        second.start()
+        time.sleep(0.1)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(2, len(errors))
+        self.assertTrue(isinstance(errors[0], Killed))
+        self.assertTrue(isinstance(errors[1],
+                                   exceptions.AgentConnectionLostError))
+
+    def test_command_reuses_idempotent_result(self):
+        self.client.session.post.return_value = MockResponse({'id': 'abc'})
+        params = {'image_info': {'image_id': 'image'}, 'force': False}
+
+        first = self.client._command(self.node, 'standby.cache_image',
+                                     params)
+        peer_params = {'image_info': {'image_id': 'image',
+                                      'peers': [{'node': 'peer'}]},
+                       'force': False}
+        second = self.client._command(self.node, 'standby.cache_image',
+                                      peer_params)
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.client.session.post.call_count)
+
+    @mock.patch('time.time')
+    def test_command_reuse_window_expires(self, time_mock):
+        time_mock.return_value = 1000.0
+        self.client.session.post.return_value = MockResponse({'id': 'abc'})
+        params = {'image_info': {'image_id': 'image'}, 'force': False}
+
+        self.client._command(self.node, 'standby.cache_image', params)
+        time_mock.return_value = 2000.0
+        self.client._command(self.node, 'standby.cache_image', params)
+        self.assertEqual(2, self.client.session.post.call_count)
+
+    def test_command_not_idempotent_not_reused(self):
+        self.client.session.post.return_value = MockResponse({'id': 'abc'})
+
+        self.client._command(self.node, 'standby.run_image', {})
+        self.client._command(self.node, 'standby.run_image', {})
+        self.assertEqual(2, self.client.session.post.call_count)
+
+    def test_command_error_not_reused(self):
+        self.client.session.post.side_effect = [requests.ConnectionError(),
+                                                MockResponse({'id': 'abc'})]
+        params = {'image_info': {'image_id': 'image'}, 'force': False}
+
+        self.assertRaises(requests.ConnectionError,
+                          self.client._command,
+                          self.node, 'standby.cache_image', params)
+        result = self.client._command(self.node, 'standby.cache_image',
+                                      params)
+        self.assertEqual('abc', result.id)
+
+
+class TestCommandResult(tests.TeethMockTestUtilities):
+    def test_from_dict(self):
+        result = agent_client.CommandResult.from_dict({
+            'id': 'abc',
+            'command_name': 'decom.erase_drives',
+            'command_status': 'RUNNING',
+            'command_error': None,
+            'command_result': {'progress': {'/dev/sda': 0.5}},
+        })
+        self.assertEqual('abc', result.id)
+        self.assertEqual('decom.erase_drives', result.name)
+        self.assertTrue(result.running)
+        self.assertFalse(result.failed)
+        self.assertEqual({'progress': {'/dev/sda': 0.5}}, result.result)
+
+    def test_result_parsed_lazily(self):
+        result = agent_client.CommandResult(result='{"progress": {}}')
+        self.assertEqual('{"progress": {}}', result._result)
+        self.assertEqual({'progress': {}}, result.result)
+
+    def test_slots(self):
+        result = agent_client.CommandResult()
+        self.assertRaises(AttributeError, setattr, result, 'extra', 1)
+
+    def test_raise_for_status(self):
+        agent_client.CommandResult(status='SUCCEEDED').raise_for_status()
+        result = agent_client.CommandResult(name='standby.run_image',
+                                            status='FAILED', error='boom')
+        self.assertRaises(exceptions.AgentExecutionError,
+                          result.raise_for_status)
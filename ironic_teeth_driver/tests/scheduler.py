@@ -0,0 +1,155 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from oslo.config import cfg
+
+from ironic_teeth_driver import scheduler
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class Killed(BaseException):
+    pass
+
+
+class TestGetPriority(unittest.TestCase):
+    def test_get_priority(self):
+        self.assertEqual(scheduler.INTERACTIVE,
+                         scheduler.get_priority(['standby.run_image']))
+        self.assertEqual(scheduler.BACKGROUND,
+                         scheduler.get_priority(['decom.erase_drives']))
+        self.assertEqual(scheduler.NORMAL,
+                         scheduler.get_priority(['decom.secure_drives']))
+
+    def test_get_priority_batch(self):
+        self.assertEqual(scheduler.NORMAL, scheduler.get_priority(
+            ['decom.secure_drives', 'decom.erase_drives']))
+        self.assertEqual(scheduler.INTERACTIVE, scheduler.get_priority(
+            ['standby.prepare_image', 'standby.run_image']))
+
+
+@mock.patch('time.time')
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler()
+        CONF.set_override('agent_request_slots', 1, group='teeth_driver')
+        CONF.set_override('agent_request_max_wait', 60,
+                          group='teeth_driver')
+
+    def tearDown(self):
+        CONF.clear_override('agent_request_slots', group='teeth_driver')
+        CONF.clear_override('agent_request_max_wait', group='teeth_driver')
+        CONF.clear_override('agent_request_quota_background',
+                            group='teeth_driver')
+
+    def _queue(self, priority):
+        # Queues a request without blocking on it.
+        waiter = scheduler._Waiter(priority)
+        with self.scheduler._lock:
+            self.scheduler._queues[priority].append(waiter)
+            self.scheduler._dispatch()
+        return waiter
+
+    def _acquire_killed(self, priority):
+        # Acquires, killing the caller while it waits for its slot.
+        real_waiter = scheduler._Waiter
+
+        def killed_waiter(priority):
+            waiter = real_waiter(priority)
+            waiter.ready.wait = mock.Mock(side_effect=Killed())
+            return waiter
+
+        with mock.patch.object(scheduler, '_Waiter',
+                               side_effect=killed_waiter):
+            self.assertRaises(Killed, self.scheduler.acquire, priority)
+
+    def test_killed_while_queued(self, time_mock):
+        time_mock.return_value = 1000
+        self.scheduler.acquire(scheduler.NORMAL)
+        self._acquire_killed(scheduler.NORMAL)
+        background = self._queue(scheduler.BACKGROUND)
+
+        stats = self.scheduler.get_stats()[scheduler.NORMAL]
+        self.assertEqual(0, stats['queued'])
+        self.scheduler.release(scheduler.NORMAL)
+        self.assertTrue(background.ready.is_set())
+
+    def test_killed_once_granted(self, time_mock):
+        time_mock.return_value = 1000
+        self._acquire_killed(scheduler.NORMAL)
+
+        stats = self.scheduler.get_stats()[scheduler.NORMAL]
+        self.assertEqual(0, stats['running'])
+        self.assertTrue(self._queue(scheduler.NORMAL).ready.is_set())
+
+    def test_slot(self, time_mock):
+        time_mock.return_value = 1000
+        with self.scheduler.slot(scheduler.NORMAL):
+            stats = self.scheduler.get_stats()[scheduler.NORMAL]
+            self.assertEqual(1, stats['running'])
+        stats = self.scheduler.get_stats()[scheduler.NORMAL]
+        self.assertEqual(0, stats['running'])
+        self.assertEqual(1, stats['sent'])
+
+    def test_interactive_first(self, time_mock):
+        time_mock.return_value = 1000
+        self.scheduler.acquire(scheduler.BACKGROUND)
+        background = self._queue(scheduler.BACKGROUND)
+        normal = self._queue(scheduler.NORMAL)
+        interactive = self._queue(scheduler.INTERACTIVE)
+        self.assertFalse(interactive.ready.is_set())
+
+        time_mock.return_value = 1005
+        self.scheduler.release(scheduler.BACKGROUND)
+        self.assertTrue(interactive.ready.is_set())
+        self.assertFalse(normal.ready.is_set())
+        self.assertFalse(background.ready.is_set())
+
+        stats = self.scheduler.get_stats()
+        self.assertEqual(1, stats[scheduler.BACKGROUND]['queued'])
+        self.assertEqual(5, stats[scheduler.INTERACTIVE]['wait_max'])
+
+        self.scheduler.release(scheduler.INTERACTIVE)
+        self.assertTrue(normal.ready.is_set())
+        self.assertFalse(background.ready.is_set())
+
+    def test_quota(self, time_mock):
+        time_mock.return_value = 1000
+        CONF.set_override('agent_request_slots', 3, group='teeth_driver')
+        CONF.set_override('agent_request_quota_background', 1,
+                          group='teeth_driver')
+        self.scheduler.acquire(scheduler.BACKGROUND)
+        background = self._queue(scheduler.BACKGROUND)
+        self.assertFalse(background.ready.is_set())
+        # Slots are left for other priorities.
+        interactive = self._queue(scheduler.INTERACTIVE)
+        self.assertTrue(interactive.ready.is_set())
+
+        self.scheduler.release(scheduler.BACKGROUND)
+        self.assertTrue(background.ready.is_set())
+
+    def test_starvation(self, time_mock):
+        time_mock.return_value = 1000
+        self.scheduler.acquire(scheduler.INTERACTIVE)
+        background = self._queue(scheduler.BACKGROUND)
+
+        time_mock.return_value = 1061
+        interactive = self._queue(scheduler.INTERACTIVE)
+        self.scheduler.release(scheduler.INTERACTIVE)
+        self.assertTrue(background.ready.is_set())
+        self.assertFalse(interactive.ready.is_set())
@@ -0,0 +1,127 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from oslo.config import cfg
+
+from ironic_teeth_driver import swarm
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+CONF.import_opt('heartbeat_timeout', 'ironic_teeth_driver.vendor',
+                group='teeth_driver')
+
+
+class FakeNode(object):
+    def __init__(self, uuid, rack=None):
+        self.uuid = uuid
+        self.properties = {'rack': rack}
+        self.driver_info = {}
+        self.instance_info = {
+            'agent_url': 'http://{0}:9999'.format(uuid)
+        }
+
+
+class TestPeerRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = swarm.PeerRegistry()
+        CONF.set_override('image_peers', 3, group='teeth_driver')
+        CONF.set_override('image_peer_uploads', 2, group='teeth_driver')
+
+    def tearDown(self):
+        CONF.clear_override('image_peers', group='teeth_driver')
+        CONF.clear_override('image_peer_uploads', group='teeth_driver')
+
+    def _peer_ids(self, peers):
+        return [peer['node'] for peer in peers]
+
+    def test_no_holders(self):
+        node = FakeNode('downloader', rack='r1')
+        self.assertEqual([], self.registry.get_peers(node, 'image'))
+
+    def test_same_rack_first(self):
+        self.registry.update_holder(FakeNode('far', rack='r2'), ['image'])
+        self.registry.update_holder(FakeNode('near', rack='r1'), ['image'])
+
+        peers = self.registry.get_peers(FakeNode('downloader', rack='r1'),
+                                        'image')
+        self.assertEqual(['near', 'far'], self._peer_ids(peers))
+        self.assertEqual('http://near:9999', peers[0]['agent_url'])
+
+    def test_excludes_self_and_other_images(self):
+        self.registry.update_holder(FakeNode('downloader'), ['image'])
+        self.registry.update_holder(FakeNode('other'), ['other-image'])
+
+        peers = self.registry.get_peers(FakeNode('downloader'), 'image')
+        self.assertEqual([], peers)
+
+    def test_peer_upload_limit(self):
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+
+        for i in range(2):
+            peers = self.registry.get_peers(FakeNode('d{0}'.format(i)),
+                                            'image')
+            self.assertEqual(['peer'], self._peer_ids(peers))
+        self.assertEqual([], self.registry.get_peers(FakeNode('d2'), 'image'))
+
+    def test_finished_download_frees_peer_and_adds_holder(self):
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+        self.registry.get_peers(FakeNode('d0'), 'image')
+        self.registry.get_peers(FakeNode('d1'), 'image')
+
+        self.registry.update_holder(FakeNode('d0'), ['image'])
+        peers = self.registry.get_peers(FakeNode('d2'), 'image')
+        self.assertEqual(['d0', 'peer'], self._peer_ids(peers))
+
+    def test_update_holder_drops_evicted_images(self):
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+        self.registry.update_holder(FakeNode('peer'), [])
+
+        self.assertEqual([], self.registry.get_peers(FakeNode('d'), 'image'))
+
+    def test_remove_node(self):
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+        self.registry.remove_node('peer')
+
+        self.assertEqual([], self.registry.get_peers(FakeNode('d'), 'image'))
+
+    @mock.patch('time.time')
+    def test_stale_holder_skipped(self, time_mock):
+        time_mock.return_value = 1000.0
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+
+        time_mock.return_value = 1000.0 + CONF.teeth_driver.heartbeat_timeout
+        time_mock.return_value += 1
+        self.assertEqual([], self.registry.get_peers(FakeNode('d'), 'image'))
+
+    def test_disabled(self):
+        CONF.set_override('image_peers', 0, group='teeth_driver')
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+
+        self.assertEqual([], self.registry.get_peers(FakeNode('d'), 'image'))
+
+    def test_add_peers(self):
+        self.registry.update_holder(FakeNode('peer'), ['image'])
+        image_info = {'image_id': 'image'}
+
+        result = self.registry.add_peers(FakeNode('d'), image_info)
+        self.assertEqual(['peer'], self._peer_ids(result['peers']))
+        self.assertNotIn('peers', image_info)
+
+    def test_add_peers_none(self):
+        image_info = {'image_id': 'image'}
+        result = self.registry.add_peers(FakeNode('d'), image_info)
+        self.assertEqual(image_info, result)
@@ -13,19 +13,29 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+from oslo.config import cfg
+
 from ironic.common import exception
 from ironic.common import states
+from ironic_teeth_driver import exceptions
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import swarm
 from ironic_teeth_driver import teeth
+from ironic_teeth_driver import watchdog
 
 import mock
 import unittest
 
+CONF = cfg.CONF
+
 
 class FakeNode(object):
     provision_state = states.NOSTATE
     target_provision_state = states.NOSTATE
+    last_error = None
 
     def __init__(self):
+        self.uuid = 'fake-uuid'
         self.driver_info = {
             'agent_url': 'http://127.0.0.1/foo'
         }
@@ -50,6 +60,13 @@ class FakeTask(object):
 
 class TestTeethDeploy(unittest.TestCase):
     def setUp(self):
+        spawn_patcher = mock.patch('eventlet.greenthread.spawn_after')
+        spawn_patcher.start()
+        self.addCleanup(spawn_patcher.stop)
+        time_patcher = mock.patch('time.time')
+        self.time_mock = time_patcher.start()
+        self.time_mock.return_value = 1000
+        self.addCleanup(time_patcher.stop)
         self.driver = teeth.TeethDeploy()
         self.task = FakeTask()
 
@@ -70,8 +87,9 @@ class TestTeethDeploy(unittest.TestCase):
 
         client_mock = mock.Mock()
 
-        client_mock.prepare_image.return_value = None
-        client_mock.run_image.return_value = None
+        client_mock.supports_batch.return_value = False
+        client_mock.prepare_image.return_value = rest.CommandResult(
+            id='prepare-id', status='RUNNING')
 
         get_client_mock.return_value = client_mock
 
@@ -80,9 +98,199 @@ class TestTeethDeploy(unittest.TestCase):
                                                      info['image_info'],
                                                      info['metadata'],
                                                      info['files'],
-                                                     wait=True)
-        client_mock.run_image.assert_called_with(node, wait=True)
-        self.assertEqual(driver_return, states.DEPLOYDONE)
+                                                     wait=False)
+        self.assertFalse(client_mock.run_image.called)
+        self.assertEqual(driver_return, states.DEPLOYING)
+        self.assertEqual({'phase': teeth.DEPLOY_PHASE_PREPARE_IMAGE,
+                          'command_id': 'prepare-id',
+                          'progress_at': 1000},
+                         info['deploy_state'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_deploy_batch(self, get_client_mock):
+        node = FakeNode()
+        info = node.instance_info
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+        client_mock.prepare_and_run_image.return_value = [
+            rest.CommandResult(id='prep', status='RUNNING'),
+            rest.CommandResult(id='run', status='RUNNING')]
+
+        driver_return = self.driver.deploy(self.task, node)
+        client_mock.prepare_and_run_image.assert_called_once_with(
+            node, info['image_info'], info['metadata'], info['files'],
+            wait=False)
+        self.assertFalse(client_mock.prepare_image.called)
+        self.assertEqual(driver_return, states.DEPLOYING)
+        self.assertEqual({'phase': teeth.DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE,
+                          'command_id': 'run',
+                          'progress_at': 1000},
+                         info['deploy_state'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_deploy_batch_frees_peers(self, get_client_mock):
+        registry = swarm.PeerRegistry()
+        peer = FakeNode()
+        peer.uuid = 'peer-uuid'
+        registry.update_holder(peer, ['test'])
+        node = FakeNode()
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+
+        def prepare_and_run_image(node, image_info, metadata, files, wait):
+            # As RESTAgentClient does when building the request.
+            image_info = registry.add_peers(node, image_info)
+            self.assertEqual(1, len(image_info['peers']))
+            return [rest.CommandResult(id='prep', status='RUNNING'),
+                    rest.CommandResult(id='run', status='RUNNING')]
+        client_mock.prepare_and_run_image.side_effect = prepare_and_run_image
+
+        with mock.patch.object(swarm, '_REGISTRY', registry):
+            self.driver.deploy(self.task, node)
+        self.assertEqual({}, registry._uploads.get('peer-uuid', {}))
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_deploy_rejected(self, get_client_mock):
+        node = FakeNode()
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+        client_mock.prepare_and_run_image.return_value = [
+            rest.CommandResult(name='standby.prepare_image',
+                               status='FAILED', error='bad image'),
+            rest.CommandResult(name='standby.run_image', status='FAILED',
+                               error='Not run, an earlier command failed.')]
+
+        self.assertRaises(exceptions.AgentExecutionError,
+                          self.driver.deploy, self.task, node)
+        self.assertNotIn('deploy_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_deploy_batch_fallback(self, get_client_mock):
+        node = FakeNode()
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+        # Agents which reject batches only get prepare_image.
+        client_mock.prepare_and_run_image.return_value = [
+            rest.CommandResult(id='prep', status='RUNNING')]
+
+        self.driver.deploy(self.task, node)
+        self.assertEqual({'phase': teeth.DEPLOY_PHASE_PREPARE_IMAGE,
+                          'command_id': 'prep',
+                          'progress_at': 1000},
+                         node.instance_info['deploy_state'])
+
+    @mock.patch('ironic_teeth_driver.swarm.get_registry')
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_next_phase_rejected(self, get_client_mock,
+                                                 registry_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.run_image.side_effect = exceptions.AgentExecutionError(
+            'Agent rejected standby.run_image')
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+        commands = [{'id': 'id1', 'command_status': 'SUCCEEDED'}]
+
+        self.driver.continue_deploy(self.task, node, commands=commands)
+        self.assertEqual(states.DEPLOYFAIL, node.provision_state)
+        self.assertIn('run_image', node.last_error)
+        self.assertNotIn('deploy_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_batch_done(self, get_client_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_AND_RUN_IMAGE,
+                                    'run')
+        commands = [{'id': 'run', 'command_status': 'SUCCEEDED'}]
+
+        self.driver.continue_deploy(self.task, node, commands=commands)
+        self.assertEqual(states.ACTIVE, node.provision_state)
+        self.assertFalse(get_client_mock.return_value.run_image.called)
+
+    def _deploying_node(self, phase, command_id):
+        node = FakeNode()
+        node.provision_state = states.DEPLOYING
+        node.target_provision_state = states.ACTIVE
+        node.instance_info['deploy_state'] = {
+            'phase': phase,
+            'command_id': command_id,
+        }
+        return node
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_running(self, get_client_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+        commands = [{'id': 'id1', 'command_status': 'RUNNING'}]
+
+        self.driver.continue_deploy(self.task, node, commands=commands)
+        self.assertEqual(states.DEPLOYING, node.provision_state)
+        self.assertFalse(get_client_mock.return_value.run_image.called)
+        self.assertFalse(
+            get_client_mock.return_value.get_command_status.called)
+
+    @mock.patch('ironic_teeth_driver.swarm.get_registry')
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_next_phase(self, get_client_mock,
+                                        registry_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.get_command_status.return_value = rest.CommandResult(
+            id='id1', status='SUCCEEDED')
+        client_mock.run_image.return_value = rest.CommandResult(id='id2')
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+
+        self.driver.continue_deploy(self.task, node)
+        client_mock.get_command_status.assert_called_once_with(node, 'id1')
+        client_mock.run_image.assert_called_once_with(node, wait=False)
+        registry_mock.return_value.remove_node.assert_called_once_with(
+            node.uuid)
+        self.assertEqual(states.DEPLOYING, node.provision_state)
+        self.assertEqual({'phase': teeth.DEPLOY_PHASE_RUN_IMAGE,
+                          'command_id': 'id2',
+                          'progress_at': 1000},
+                         node.instance_info['deploy_state'])
+
+    @mock.patch('ironic_teeth_driver.swarm.get_registry')
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_done(self, get_client_mock, registry_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_RUN_IMAGE, 'id2')
+        commands = [{'id': 'id2', 'command_status': 'SUCCEEDED'}]
+
+        self.driver.continue_deploy(self.task, node, commands=commands)
+        self.assertEqual(states.ACTIVE, node.provision_state)
+        self.assertEqual(states.NOSTATE, node.target_provision_state)
+        self.assertNotIn('deploy_state', node.instance_info)
+        registry_mock.return_value.remove_node.assert_called_once_with(
+            node.uuid)
+
+    @mock.patch('ironic_teeth_driver.swarm.get_registry')
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_failed(self, get_client_mock, registry_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+        commands = [{'id': 'id1',
+                     'command_status': 'FAILED',
+                     'command_error': 'disk full'}]
+
+        self.driver.continue_deploy(self.task, node, commands=commands)
+        self.assertEqual(states.DEPLOYFAIL, node.provision_state)
+        self.assertIn('disk full', node.last_error)
+        self.assertFalse(get_client_mock.return_value.run_image.called)
+        registry_mock.return_value.remove_node.assert_called_once_with(
+            node.uuid)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_command_lost(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.get_command_status.return_value = None
+        client_mock.prepare_image.return_value = rest.CommandResult(id='id3')
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+
+        self.driver.continue_deploy(self.task, node)
+        self.assertTrue(client_mock.prepare_image.called)
+        self.assertEqual('id3',
+                         node.instance_info['deploy_state']['command_id'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_deploy_not_deploying(self, get_client_mock):
+        node = FakeNode()
+        self.driver.continue_deploy(self.task, node)
+        self.assertFalse(get_client_mock.called)
 
     @mock.patch('ironic.conductor.utils.node_power_action')
     def test_tear_down(self, power_mock):
@@ -92,6 +300,365 @@ class TestTeethDeploy(unittest.TestCase):
         power_mock.assert_called_with(self.task, node, states.REBOOT)
 
         self.assertEqual(driver_return, states.DELETING)
+        self.assertEqual({'phase': teeth.DECOM_PHASE_REBOOT,
+                          'progress_at': 1000},
+                         node.instance_info['decom_state'])
+
+    @mock.patch('ironic.conductor.utils.node_power_action')
+    def test_tear_down_power_failure(self, power_mock):
+        error = exception.IronicException('BMC gone')
+        power_mock.side_effect = error
+        node = FakeNode()
+
+        with mock.patch('eventlet.greenthread.sleep'):
+            self.assertRaises(exception.IronicException,
+                              self.driver.tear_down,
+                              self.task,
+                              node)
+        self.assertNotIn('decom_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.power.node_power_actions')
+    def test_tear_down_nodes(self, power_mock):
+        node1 = FakeNode()
+        node2 = FakeNode()
+        node2.uuid = 'other-uuid'
+        error = exception.IronicException('BMC gone')
+        power_mock.return_value = {node1.uuid: None, node2.uuid: error}
+
+        results = self.driver.tear_down_nodes(self.task, [node1, node2])
+        power_mock.assert_called_once_with(self.task, [node1, node2],
+                                           states.REBOOT)
+        self.assertEqual({node1.uuid: states.DELETING,
+                          node2.uuid: error}, results)
+        self.assertIn('decom_state', node1.instance_info)
+        self.assertNotIn('decom_state', node2.instance_info)
+
+    def _deleting_node(self, decom_state):
+        node = FakeNode()
+        node.provision_state = states.DELETING
+        node.instance_info['decom_state'] = decom_state
+        return node
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_waits_for_drives(self, get_client_mock):
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node)
+        self.assertFalse(get_client_mock.return_value.secure_drives.called)
+        self.assertEqual(teeth.DECOM_PHASE_REBOOT,
+                         node.instance_info['decom_state']['phase'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_secures_all_drives(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = False
+        client_mock.secure_drives.side_effect = [
+            rest.CommandResult(id='sec-a'), rest.CommandResult(id='sec-b')]
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node,
+                                   drives=['/dev/sda', '/dev/sdb'])
+        decom_state = node.instance_info['decom_state']
+        self.assertEqual(teeth.DECOM_PHASE_DRIVES, decom_state['phase'])
+        self.assertEqual(2, client_mock.secure_drives.call_count)
+        client_mock.secure_drives.assert_any_call(node, ['/dev/sda'],
+                                                  decom_state['key'],
+                                                  wait=False)
+        for drive_state in decom_state['drives'].values():
+            self.assertEqual(teeth.DRIVE_SECURING, drive_state['status'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_batch(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+        client_mock.secure_and_erase_drives.return_value = [
+            rest.CommandResult(id='sec'), rest.CommandResult(id='erase')]
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node, drives=['/dev/sda'])
+        decom_state = node.instance_info['decom_state']
+        client_mock.secure_and_erase_drives.assert_called_once_with(
+            node, ['/dev/sda'], decom_state['key'], wait=False)
+        self.assertFalse(client_mock.secure_drives.called)
+        # The drive is only erasing once secure_drives is done.
+        self.assertEqual({'status': teeth.DRIVE_SECURING,
+                          'command_id': 'sec',
+                          'erase_command_id': 'erase',
+                          'progress': None},
+                         decom_state['drives']['/dev/sda'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_batch_secured(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        node = self._batch_securing_node()
+        commands = [{'id': 'sec', 'command_status': 'SUCCEEDED'}]
+
+        self.driver.continue_decom(self.task, node, commands=commands)
+        self.assertFalse(client_mock.erase_drives.called)
+        self.assertEqual({'status': teeth.DRIVE_ERASING,
+                          'command_id': 'erase',
+                          'progress': None},
+                         node.instance_info['decom_state']['drives']
+                         ['/dev/sda'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_batch_secure_lost(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.get_command_status.return_value = None
+        client_mock.supports_batch.return_value = True
+        client_mock.secure_and_erase_drives.return_value = [
+            rest.CommandResult(id='sec2'), rest.CommandResult(id='erase2')]
+        node = self._batch_securing_node()
+
+        self.driver.continue_decom(self.task, node)
+        client_mock.get_command_status.assert_called_once_with(node, 'sec')
+        # Securing starts over, the drive is never erased unsecured.
+        client_mock.secure_and_erase_drives.assert_called_once_with(
+            node, ['/dev/sda'], 'key', wait=False)
+        self.assertFalse(client_mock.erase_drives.called)
+        self.assertEqual({'status': teeth.DRIVE_SECURING,
+                          'command_id': 'sec2',
+                          'erase_command_id': 'erase2',
+                          'progress': None},
+                         node.instance_info['decom_state']['drives']
+                         ['/dev/sda'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_batch_secure_failed(self, get_client_mock):
+        node = self._batch_securing_node()
+        commands = [{'id': 'sec', 'command_status': 'FAILED',
+                     'command_error': 'frozen'},
+                    {'id': 'erase', 'command_status': 'FAILED',
+                     'command_error': 'Not run'}]
+
+        self.driver.continue_decom(self.task, node, commands=commands)
+        self.assertEqual(states.ERROR, node.provision_state)
+        self.assertIn('frozen', node.last_error)
+        self.assertFalse(get_client_mock.return_value.erase_drives.called)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_batch_fallback(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = True
+        # Agents which reject batches only get secure_drives.
+        client_mock.secure_and_erase_drives.return_value = [
+            rest.CommandResult(id='sec')]
+        client_mock.erase_drives.return_value = rest.CommandResult(id='erase')
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node, drives=['/dev/sda'])
+        drive_state = node.instance_info['decom_state']['drives']['/dev/sda']
+        self.assertEqual({'status': teeth.DRIVE_SECURING,
+                          'command_id': 'sec',
+                          'progress': None}, drive_state)
+
+        commands = [{'id': 'sec', 'command_status': 'SUCCEEDED'}]
+        self.driver.continue_decom(self.task, node, commands=commands)
+        self.assertEqual(1, client_mock.erase_drives.call_count)
+        self.assertEqual(teeth.DRIVE_ERASING, drive_state['status'])
+        self.assertEqual('erase', drive_state['command_id'])
+
+    def _batch_securing_node(self):
+        return self._deleting_node({
+            'phase': teeth.DECOM_PHASE_DRIVES,
+            'key': 'key',
+            'drives': {
+                '/dev/sda': {'status': teeth.DRIVE_SECURING,
+                             'command_id': 'sec',
+                             'erase_command_id': 'erase',
+                             'progress': None},
+            },
+        })
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_saves_key_first(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = False
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+        node.save = mock.Mock()
+
+        def secure(node, drives, key, wait):
+            node.save.assert_called_once_with(self.task)
+            self.assertEqual(key, node.instance_info['decom_state']['key'])
+            return rest.CommandResult(id='sec-a')
+        client_mock.secure_drives.side_effect = secure
+
+        self.driver.continue_decom(self.task, node, drives=['/dev/sda'])
+        self.assertEqual(1, client_mock.secure_drives.call_count)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_secure_rejected(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = False
+        client_mock.secure_drives.side_effect = [
+            rest.CommandResult(id='sec-a'),
+            rest.CommandResult(status='FAILED', error='frozen')]
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node,
+                                   drives=['/dev/sda', '/dev/sdb'])
+        self.assertEqual(states.ERROR, node.provision_state)
+        self.assertIn('frozen', node.last_error)
+        decom_state = node.instance_info['decom_state']
+        self.assertIn('key', decom_state)
+        self.assertEqual('sec-a',
+                         decom_state['drives']['/dev/sda']['command_id'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_send_error_retried(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = False
+        client_mock.secure_drives.side_effect = [
+            IOError('connection refused'), rest.CommandResult(id='sec-a')]
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node, drives=['/dev/sda'])
+        decom_state = node.instance_info['decom_state']
+        self.assertEqual(states.DELETING, node.provision_state)
+        self.assertEqual(None,
+                         decom_state['drives']['/dev/sda']['command_id'])
+
+        # The next heartbeat sends it again, with the same key.
+        self.driver.continue_decom(self.task, node)
+        self.assertFalse(client_mock.get_command_status.called)
+        self.assertEqual(
+            [mock.call(node, ['/dev/sda'], decom_state['key'], wait=False)] *
+            2, client_mock.secure_drives.call_args_list)
+        self.assertEqual('sec-a',
+                         decom_state['drives']['/dev/sda']['command_id'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_key_derived_from_secret(self, get_client_mock):
+        CONF.set_override('decom_key_secret', 'secret', group='teeth_driver')
+        self.addCleanup(CONF.clear_override, 'decom_key_secret',
+                        group='teeth_driver')
+        client_mock = get_client_mock.return_value
+        client_mock.supports_batch.return_value = False
+        client_mock.secure_drives.return_value = rest.CommandResult(id='sec')
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node, drives=['/dev/sda'])
+        decom_state = node.instance_info['decom_state']
+        self.assertNotIn('key', decom_state)
+        key = client_mock.secure_drives.call_args[0][2]
+        self.assertEqual(32, len(key))
+        self.assertNotIn(key, str(node.instance_info))
+        self.assertEqual(key, self.driver._get_decom_key(node, decom_state))
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_no_drives_waits(self, get_client_mock):
+        # The agent may not have found its drives yet.
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+
+        self.driver.continue_decom(self.task, node, drives=[])
+        self.assertEqual(states.DELETING, node.provision_state)
+        self.assertEqual(teeth.DECOM_PHASE_REBOOT,
+                         node.instance_info['decom_state']['phase'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_diskless(self, get_client_mock):
+        node = self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT})
+        node.properties = {'local_gb': 0}
+
+        self.driver.continue_decom(self.task, node, drives=[])
+        self.assertEqual(states.NOSTATE, node.provision_state)
+        self.assertNotIn('decom_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_erases_secured_drive(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.erase_drives.return_value = rest.CommandResult(
+            id='erase-a')
+        node = self._deleting_node({
+            'phase': teeth.DECOM_PHASE_DRIVES,
+            'key': 'key',
+            'drives': {
+                '/dev/sda': {'status': teeth.DRIVE_SECURING,
+                             'command_id': 'sec-a',
+                             'progress': None},
+                '/dev/sdb': {'status': teeth.DRIVE_SECURING,
+                             'command_id': 'sec-b',
+                             'progress': None},
+            },
+        })
+        commands = [{'id': 'sec-a', 'command_status': 'SUCCEEDED'},
+                    {'id': 'sec-b', 'command_status': 'RUNNING'}]
+
+        self.driver.continue_decom(self.task, node, commands=commands)
+        client_mock.erase_drives.assert_called_once_with(
+            node, ['/dev/sda'], 'key', progress=None, wait=False)
+        drives = node.instance_info['decom_state']['drives']
+        self.assertEqual(teeth.DRIVE_ERASING, drives['/dev/sda']['status'])
+        self.assertEqual('erase-a', drives['/dev/sda']['command_id'])
+        self.assertEqual(teeth.DRIVE_SECURING, drives['/dev/sdb']['status'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_resumes_lost_erase(self, get_client_mock):
+        client_mock = get_client_mock.return_value
+        client_mock.get_command_status.return_value = None
+        client_mock.erase_drives.return_value = rest.CommandResult(
+            id='erase-a2')
+        node = self._deleting_node({
+            'phase': teeth.DECOM_PHASE_DRIVES,
+            'key': 'key',
+            'drives': {
+                '/dev/sda': {'status': teeth.DRIVE_ERASING,
+                             'command_id': 'erase-a',
+                             'progress': 4096},
+            },
+        })
+
+        self.driver.continue_decom(self.task, node)
+        client_mock.erase_drives.assert_called_once_with(
+            node, ['/dev/sda'], 'key', progress={'/dev/sda': 4096},
+            wait=False)
+        drives = node.instance_info['decom_state']['drives']
+        self.assertEqual('erase-a2', drives['/dev/sda']['command_id'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_tracks_progress_and_finishes(self,
+                                                         get_client_mock):
+        node = self._deleting_node({
+            'phase': teeth.DECOM_PHASE_DRIVES,
+            'key': 'key',
+            'drives': {
+                '/dev/sda': {'status': teeth.DRIVE_ERASING,
+                             'command_id': 'erase-a',
+                             'progress': None},
+            },
+        })
+        running = [{'id': 'erase-a',
+                    'command_status': 'RUNNING',
+                    'command_result': {'progress': {'/dev/sda': 512}}}]
+
+        self.driver.continue_decom(self.task, node, commands=running)
+        decom_state = node.instance_info['decom_state']
+        self.assertEqual(512, decom_state['drives']['/dev/sda']['progress'])
+        self.assertEqual(1000, decom_state['progress_at'])
+
+        done = [{'id': 'erase-a', 'command_status': 'SUCCEEDED'}]
+        self.driver.continue_decom(self.task, node, commands=done)
+        self.assertEqual(states.NOSTATE, node.provision_state)
+        self.assertNotIn('decom_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_continue_decom_failed(self, get_client_mock):
+        node = self._deleting_node({
+            'phase': teeth.DECOM_PHASE_DRIVES,
+            'key': 'key',
+            'drives': {
+                '/dev/sda': {'status': teeth.DRIVE_SECURING,
+                             'command_id': 'sec-a',
+                             'progress': None},
+            },
+        })
+        commands = [{'id': 'sec-a',
+                     'command_status': 'FAILED',
+                     'command_error': 'frozen'}]
+
+        self.driver.continue_decom(self.task, node, commands=commands)
+        self.assertEqual(states.ERROR, node.provision_state)
+        self.assertIn('frozen', node.last_error)
 
     @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
     def test_prepare(self, get_client_mock):
@@ -105,3 +672,81 @@ class TestTeethDeploy(unittest.TestCase):
         self.assertRaises(exception.InvalidParameterValue,
             self.driver.validate,
             node)
+
+    def _stalled_node(self, node):
+        node.instance_info[watchdog.STATE_KEYS[node.provision_state]][
+            'progress_at'] = 1000
+        self.time_mock.return_value = 1000 + 3601
+        return node
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_not_stalled(self, get_client_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+        node.instance_info['deploy_state']['progress_at'] = 1000
+        self.time_mock.return_value = 1000 + 3599
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.DEPLOYING, node.provision_state)
+        self.assertFalse(get_client_mock.called)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_records_missing_progress(self, get_client_mock):
+        node = self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1')
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.DEPLOYING, node.provision_state)
+        self.assertEqual(1000,
+                         node.instance_info['deploy_state']['progress_at'])
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_deploy_running(self, get_client_mock):
+        get_client_mock.return_value.get_command_status.return_value = \
+            rest.CommandResult(id='id1', status='RUNNING')
+        node = self._stalled_node(
+            self._deploying_node(teeth.DEPLOY_PHASE_PREPARE_IMAGE, 'id1'))
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.DEPLOYFAIL, node.provision_state)
+        self.assertIn('prepare_image', node.last_error)
+        self.assertNotIn('deploy_state', node.instance_info)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_run_image_reported(self, get_client_mock):
+        # The agent rebooted into the instance without a heartbeat
+        # reporting run_image, but still answers for it.
+        get_client_mock.return_value.get_command_status.return_value = \
+            rest.CommandResult(id='id2', status='SUCCEEDED')
+        node = self._stalled_node(
+            self._deploying_node(teeth.DEPLOY_PHASE_RUN_IMAGE, 'id2'))
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.ACTIVE, node.provision_state)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_run_image_agent_gone(self, get_client_mock):
+        get_client_mock.return_value.get_command_status.side_effect = \
+            IOError('connection refused')
+        node = self._stalled_node(
+            self._deploying_node(teeth.DEPLOY_PHASE_RUN_IMAGE, 'id2'))
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.DEPLOYFAIL, node.provision_state)
+        self.assertIn('run_image', node.last_error)
+
+    @mock.patch('ironic_teeth_driver.teeth.TeethDeploy._get_client')
+    def test_check_timeout_decom(self, get_client_mock):
+        # The agent never came back from the tear down reboot.
+        node = self._stalled_node(
+            self._deleting_node({'phase': teeth.DECOM_PHASE_REBOOT}))
+
+        self.driver.check_timeout(self.task, node)
+        self.assertEqual(states.ERROR, node.provision_state)
+        self.assertIn('reboot', node.last_error)
+
+    @mock.patch('ironic_teeth_driver.warmup.get_warmer')
+    def test_take_over(self, get_warmer_mock):
+        node = FakeNode()
+        self.task.driver = mock.Mock()
+        self.driver.take_over(self.task, node)
+        get_warmer_mock.return_value.add.assert_called_once_with(
+            self.task.driver, 'fake-uuid')
@@ -0,0 +1,97 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from ironic_teeth_driver import timeline
+
+import mock
+import unittest
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        self.timeline = timeline.Timeline(max_events=3,
+                                          max_nodes=2,
+                                          max_samples=100)
+
+    def test_record(self):
+        self.timeline.record('node1', 'lookup', foo='bar')
+        events = self.timeline.get_events('node1')
+        self.assertEqual(1, len(events))
+        self.assertEqual('lookup', events[0]['event'])
+        self.assertEqual('bar', events[0]['foo'])
+
+    def test_record_bounded_events(self):
+        for i in range(5):
+            self.timeline.record('node1', 'heartbeat', count=i)
+        events = self.timeline.get_events('node1')
+        self.assertEqual([2, 3, 4], [e['count'] for e in events])
+
+    def test_record_bounded_nodes(self):
+        self.timeline.record('node1', 'lookup')
+        self.timeline.record('node2', 'lookup')
+        self.timeline.record('node3', 'lookup')
+        self.assertEqual([], self.timeline.get_events('node1'))
+        self.assertEqual(1, len(self.timeline.get_events('node3')))
+
+    @mock.patch('time.time')
+    def test_span(self, time_mock):
+        time_mock.side_effect = [10.0, 10.0, 12.5, 12.5]
+        with self.timeline.span('node1', 'power.reboot'):
+            pass
+        events = self.timeline.get_events('node1')
+        self.assertEqual(['power.reboot.start', 'power.reboot.end'],
+                         [e['event'] for e in events])
+        self.assertEqual(2.5, events[1]['duration'])
+        self.assertEqual('ok', events[1]['status'])
+
+    def test_span_error(self):
+        def fail():
+            with self.timeline.span('node1', 'power.reboot'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        events = self.timeline.get_events('node1')
+        self.assertEqual('error', events[1]['status'])
+        stats = self.timeline.get_phase_stats()
+        self.assertEqual(1, stats['power.reboot']['count'])
+
+    @mock.patch('time.time')
+    def test_start_end_phase(self, time_mock):
+        time_mock.side_effect = [1.0, 1.0, 4.0, 4.0]
+        self.timeline.start_phase('node1', 'agent_boot')
+        self.timeline.end_phase('node1', 'agent_boot')
+        events = self.timeline.get_events('node1')
+        self.assertEqual(3.0, events[1]['duration'])
+        self.assertEqual(1, self.timeline.get_phase_stats()[
+            'agent_boot']['count'])
+
+    def test_end_phase_without_start(self):
+        self.timeline.end_phase('node1', 'agent_boot')
+        events = self.timeline.get_events('node1')
+        self.assertEqual('agent_boot.end', events[0]['event'])
+        self.assertNotIn('duration', events[0])
+        self.assertEqual({}, self.timeline.get_phase_stats())
+
+    def test_get_phase_stats(self):
+        for i in range(1, 101):
+            self.timeline.add_sample('deploy', float(i))
+        stats = self.timeline.get_phase_stats()['deploy']
+        self.assertEqual(100, stats['count'])
+        self.assertEqual(50.0, stats['p50'])
+        self.assertEqual(90.0, stats['p90'])
+        self.assertEqual(99.0, stats['p99'])
+        self.assertEqual(100.0, stats['max'])
+
+    def test_percentile_empty(self):
+        self.assertEqual(None, timeline.percentile([], 50))
@@ -17,6 +17,7 @@ import datetime
 
 from ironic.common import exception
 from ironic.common import states
+from ironic_teeth_driver import exceptions
 from ironic_teeth_driver import tests
 from ironic_teeth_driver import vendor
 
@@ -29,7 +30,8 @@ class FakeNode(object):
     provision_state = states.NOSTATE
     target_provision_state = states.NOSTATE
 
-    def __init__(self, driver_info=None, instance_info=None, uuid=None):
+    def __init__(self, driver_info=None, instance_info=None, uuid=None,
+                 extra=None):
         if instance_info:
             self.instance_info = instance_info
         else:
@@ -38,6 +40,8 @@ class FakeNode(object):
             }
         self.driver_info = driver_info or {}
         self.uuid = uuid or 'fake-uuid'
+        self.extra = extra or {}
+        self.properties = {}
 
     def save(self, context):
         pass
@@ -47,27 +51,18 @@ class FakeTask(object):
     def __init__(self):
         self.drivername = "fake"
         self.context = {}
-
-
-class FakePort(object):
-    def __init__(self, uuid=None, node_id=None):
-        self.uuid = uuid or 'fake-uuid'
-        self.node_id = node_id or 'fake-node'
-
-    def save(self, context):
-        pass
+        self.driver = mock.Mock()
 
 
 class TestTeethVendor(unittest.TestCase):
     def setUp(self):
         self.vendor = vendor.TeethVendorInterface()
-        self.vendor.db_connection = mock.Mock(autospec=True)
-        port_patcher = mock.patch.object(self.vendor.db_connection,
-                                        'get_port')
-        self.port_mock = port_patcher.start()
-        node_patcher = mock.patch.object(self.vendor.db_connection,
-                                         'get_node')
-        self.node_mock = node_patcher.start()
+        self.vendor.hardware_index = mock.Mock()
+        inventory_patcher = mock.patch(
+            'ironic_teeth_driver.inventory.update_inventory')
+        self.inventory_mock = inventory_patcher.start()
+        self.addCleanup(inventory_patcher.stop)
+        self.inventory_mock.return_value = False
         self.task = FakeTask()
         self.fake_datetime = datetime.datetime(2011, 2, 3, 10, 11)
 
@@ -83,7 +78,7 @@ class TestTeethVendor(unittest.TestCase):
                           node)
 
     @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
-                '._find_node_by_macs')
+                '._find_node_by_hardware')
     def test_heartbeat_no_uuid(self, find_mock):
         kwargs = {
             'hardware': [
@@ -105,75 +100,150 @@ class TestTeethVendor(unittest.TestCase):
             node = self.vendor._heartbeat_no_uuid(FakeTask(), **kwargs)
         self.assertEqual(expected_node, node['node'])
 
+    @mock.patch('ironic.conductor.task_manager.acquire')
+    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
+                '._find_node_by_hardware')
+    def test_heartbeat_no_uuid_inventory(self, find_mock, acquire_mock):
+        hardware = [{'id': 'aa:bb:cc:dd:ee:ff', 'type': 'mac_address'},
+                    {'id': '64', 'type': 'memory_gb'}]
+        fake_node = FakeNode()
+        find_mock.return_value = fake_node
+        locked_node = acquire_mock.return_value.__enter__.return_value.node
+        context = FakeTask()
+
+        self.vendor._heartbeat_no_uuid(context, hardware=hardware)
+        self.inventory_mock.assert_called_once_with(fake_node, hardware)
+        # Nothing changed, so the node isn't locked.
+        self.assertFalse(acquire_mock.called)
+
+        self.inventory_mock.return_value = True
+        self.vendor._heartbeat_no_uuid(context, hardware=hardware)
+        acquire_mock.assert_called_once_with(context, fake_node.uuid)
+        self.inventory_mock.assert_called_with(locked_node, hardware)
+        locked_node.save.assert_called_once_with(context)
+
+    @mock.patch('ironic.conductor.task_manager.acquire')
+    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
+                '._find_node_by_hardware')
+    def test_heartbeat_no_uuid_inventory_locked(self, find_mock,
+                                                acquire_mock):
+        find_mock.return_value = FakeNode()
+        self.inventory_mock.return_value = True
+        acquire_mock.side_effect = exception.NodeLocked(node='fake-uuid',
+                                                        host='other')
+
+        result = self.vendor._heartbeat_no_uuid(
+            FakeTask(), hardware=[{'id': '64', 'type': 'memory_gb'}])
+        self.assertEqual(find_mock.return_value, result['node'])
+
+    @mock.patch('ironic_teeth_driver.vendor.LOG')
+    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
+                '._find_node_by_hardware')
+    def test_heartbeat_no_uuid_not_found(self, find_mock, log_mock):
+        find_mock.side_effect = exception.NotFound()
+
+        self.assertRaises(exception.NotFound,
+                          self.vendor._heartbeat_no_uuid,
+                          FakeTask(),
+                          hardware=[{'id': 'aa:bb:cc:dd:ee:ff',
+                                     'type': 'mac_address'}])
+        args, kwargs = log_mock.warning.call_args
+        self.assertEqual((('mac_address', 'aa:bb:cc:dd:ee:ff'),),
+                         kwargs['key'])
+
     def test_heartbeat_no_uuid_bad_kwargs(self):
         self.assertRaises(exception.InvalidParameterValue,
                           self.vendor._heartbeat_no_uuid,
                           FakeTask())
 
-    def test_find_ports_by_macs(self):
-        fake_port = FakePort()
-        self.port_mock.return_value = fake_port
-
-        macs = ['aa:bb:cc:dd:ee:ff']
-        ports = self.vendor._find_ports_by_macs(macs)
-        self.assertEqual(1, len(ports))
-        self.assertEqual(fake_port.uuid, ports[0].uuid)
-        self.assertEqual(fake_port.node_id, ports[0].node_id)
-
-    def test_find_ports_by_macs_bad_params(self):
-        self.port_mock.side_effect = db_exc.NoResultFound
+    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
+                '._find_node_by_hardware')
+    def test_heartbeat_no_uuid_hardware_keys(self, find_mock):
+        kwargs = {
+            'hardware': [
+                {
+                    'id': 'aa:bb:cc:dd:ee:ff',
+                    'type': 'mac_address'
+                },
+                {
+                    'id': 'not-a-mac',
+                    'type': 'mac_address'
+                },
+                {
+                    'id': 'SERIAL1',
+                    'type': 'system_serial'
+                },
+                {
+                    'id': '10.0.0.1',
+                    'type': 'bmc_address'
+                },
+                {
+                    'id': 'DISK1',
+                    'type': 'disk_serial'
+                },
+                {
+                    'id': '64',
+                    'type': 'memory_gb'
+                },
+                {
+                    'type': 'mac_address'
+                }
+            ]
+        }
+        fake_node = FakeNode()
+        find_mock.return_value = fake_node
+        task = FakeTask()
 
-        macs = ['aa:bb:cc:dd:ee:ff']
-        self.assertRaises(exception.NotFound,
-                          self.vendor._find_ports_by_macs,
-                          macs)
+        with mock.patch('ironic.conductor.task_manager.acquire') as \
+                acquire_mock:
+            locked_node = FakeNode()
+            locked_node.save = mock.Mock()
+            acquire_mock.return_value.__enter__.return_value.node = \
+                locked_node
+            self.vendor._heartbeat_no_uuid(task, **kwargs)
+        find_mock.assert_called_once_with(task, [
+            ('mac_address', 'aa:bb:cc:dd:ee:ff'),
+            ('system_serial', 'SERIAL1'),
+            ('bmc_address', '10.0.0.1'),
+            ('disk_serial', 'DISK1'),
+        ])
+        # The serials are recorded for later lookups.
+        self.assertEqual({'system_serial': 'SERIAL1',
+                          'disk_serials': ['DISK1']},
+                         locked_node.properties)
+        locked_node.save.assert_called_once_with(task)
 
     @mock.patch('ironic.objects.node.Node.get_by_uuid')
-    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
-                '._get_node_id')
-    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
-                '._find_ports_by_macs')
-    def test_find_node_by_macs(self, ports_mock, node_id_mock, node_mock):
-        ports_mock.return_value = [FakePort()]
-        node_id_mock.return_value = 'c3e83a6a-f094-4c55-8480-760a44efffc6'
+    def test_find_node_by_hardware(self, node_mock):
+        self.vendor.hardware_index.find_node_uuid.return_value = 'node-uuid'
         fake_node = FakeNode()
         node_mock.return_value = fake_node
+        keys = [('mac_address', 'aa:bb:cc:dd:ee:ff')]
 
-        macs = ['aa:bb:cc:dd:ee:ff']
-        node = self.vendor._find_node_by_macs(FakeTask(), macs)
+        node = self.vendor._find_node_by_hardware(self.task, keys)
         self.assertEqual(fake_node, node)
+        self.vendor.hardware_index.find_node_uuid.assert_called_once_with(
+            keys)
+        node_mock.assert_called_once_with(self.task, 'node-uuid')
 
     @mock.patch('ironic.objects.node.Node.get_by_uuid')
-    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
-                '._get_node_id')
-    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
-                '._find_ports_by_macs')
-    def test_find_node_by_macs_bad_params(self, ports_mock, node_id_mock,
-                                          node_mock):
-        ports_mock.return_value = []
-        node_id_mock.return_value = 'fake-uuid'
+    def test_find_node_by_hardware_deleted_node(self, node_mock):
+        self.vendor.hardware_index.find_node_uuid.return_value = 'node-uuid'
         node_mock.side_effect = db_exc.NoResultFound()
 
-        macs = ['aa:bb:cc:dd:ee:ff']
         self.assertRaises(exception.NotFound,
-                          self.vendor._find_node_by_macs,
-                          FakeTask(),
-                          macs)
-
-    def test_get_node_id(self):
-        fake_port1 = FakePort(node_id='fake-uuid')
-        fake_port2 = FakePort(node_id='fake-uuid')
+                          self.vendor._find_node_by_hardware,
+                          self.task,
+                          [('mac_address', 'aa:bb:cc:dd:ee:ff')])
 
-        node_id = self.vendor._get_node_id([fake_port1, fake_port2])
-        self.assertEqual(fake_port2.uuid, node_id)
+    def test_find_node_by_hardware_ambiguous(self):
+        self.vendor.hardware_index.find_node_uuid.side_effect = \
+            exceptions.MultipleChassisFound()
 
-    def test_get_node_id_exception(self):
-        fake_port1 = FakePort(node_id='fake-uuid')
-        fake_port2 = FakePort(node_id='other-fake-uuid')
-
-        self.assertRaises(exception.NotFound,
-                          self.vendor._get_node_id,
-                          [fake_port1, fake_port2])
+        self.assertRaises(exceptions.MultipleChassisFound,
+                          self.vendor._find_node_by_hardware,
+                          self.task,
+                          [('system_serial', 'SERIAL1')])
 
     def test_heartbeat(self):
         task = FakeTask()
@@ -187,6 +257,174 @@ class TestTeethVendor(unittest.TestCase):
                          node.instance_info['last_heartbeat'])
         self.assertEqual('http://127.0.0.1:9999/bar',
                          node.instance_info['agent_url'])
+        task.driver.deploy.continue_deploy.assert_called_once_with(
+            task, fake_node, commands=None)
+
+    @mock.patch('ironic_teeth_driver.power.get_power_cache')
+    def test_heartbeat_marks_powered_on(self, cache_mock):
+        self.vendor._heartbeat(FakeTask(), FakeNode(),
+                               agent_url='http://127.0.0.1:9999/bar')
+        cache_mock.return_value.heartbeat.assert_called_once_with(
+            'fake-uuid')
+
+    def test_heartbeat_with_commands(self):
+        task = FakeTask()
+        fake_node = FakeNode()
+        commands = [{'id': 'id1', 'command_status': 'SUCCEEDED'}]
+        kwargs = {
+            'agent_url': 'http://127.0.0.1:9999/bar',
+            'commands': commands
+        }
+        self.vendor._heartbeat(task, fake_node, **kwargs)
+        task.driver.deploy.continue_deploy.assert_called_once_with(
+            task, fake_node, commands=commands)
+        task.driver.deploy.continue_decom.assert_called_once_with(
+            task, fake_node, commands=commands, drives=None)
+
+    @mock.patch('ironic_teeth_driver.swarm.get_registry')
+    def test_heartbeat_cached_images(self, registry_mock):
+        task = FakeTask()
+        fake_node = FakeNode()
+        kwargs = {
+            'agent_url': 'http://127.0.0.1:9999/bar',
+            'cached_images': ['image']
+        }
+        self.vendor._heartbeat(task, fake_node, **kwargs)
+        registry_mock.return_value.update_holder.assert_called_once_with(
+            fake_node, ['image'])
+
+    def test_heartbeat_cached_manifests(self):
+        task = FakeTask()
+        fake_node = FakeNode()
+        kwargs = {
+            'agent_url': 'http://127.0.0.1:9999/bar',
+            'cached_manifests': ['abc']
+        }
+        node = self.vendor._heartbeat(task, fake_node, **kwargs)
+        self.assertEqual(['abc'], node.instance_info['cached_manifests'])
+
+    @mock.patch('ironic_teeth_driver.blobstore.get_store')
+    def test_get_blob(self, store_mock):
+        store_mock.return_value.get.return_value = b'\x00\xffcontent'
+        node = FakeNode(instance_info={'blobs': ['abc']})
+
+        result = self.vendor.vendor_passthru(self.task, node,
+                                             method='get_blob', digest='abc')
+        store_mock.return_value.get.assert_called_once_with('abc')
+        self.assertEqual({'node': node.uuid,
+                          'digest': 'abc',
+                          'content': 'AP9jb250ZW50'}, result)
+
+    @mock.patch('ironic_teeth_driver.blobstore.get_store')
+    def test_get_blob_of_other_node(self, store_mock):
+        node = FakeNode(instance_info={'blobs': ['abc']})
+
+        self.assertRaises(exception.NotFound,
+                          self.vendor.vendor_passthru,
+                          self.task, node, method='get_blob', digest='def')
+        self.assertFalse(store_mock.return_value.get.called)
+
+    def test_get_blob_no_digest(self):
+        self.assertRaises(exception.InvalidParameterValue,
+                          self.vendor.vendor_passthru,
+                          self.task,
+                          FakeNode(),
+                          method='get_blob')
+
+    @mock.patch('ironic_teeth_driver.inventory.get_inventory')
+    def test_get_inventory(self, get_mock):
+        hardware = [{'id': '64', 'type': 'memory_gb'}]
+        get_mock.return_value = hardware
+        history = [{'digest': 'abc', 'at': '2014-01-01T00:00:00'}]
+        node = FakeNode(extra={'inventory': {
+            'digest': 'abc',
+            'updated_at': '2014-01-01T00:00:00',
+            'history': history}})
+
+        result = self.vendor.vendor_passthru(self.task, node,
+                                             method='get_inventory')
+        get_mock.assert_called_once_with(node)
+        self.assertEqual({'node': node.uuid,
+                          'hardware': hardware,
+                          'updated_at': '2014-01-01T00:00:00',
+                          'history': history}, result)
+
+    @mock.patch('ironic_teeth_driver.timeline.get_timeline')
+    def test_get_timeline(self, timeline_mock):
+        events = [{'time': 1.0, 'event': 'lookup'}]
+        timeline_mock.return_value.get_events.return_value = events
+        node = FakeNode()
+
+        result = self.vendor.vendor_passthru(self.task, node,
+                                             method='get_timeline')
+        timeline_mock.return_value.get_events.assert_called_once_with(
+            node.uuid)
+        self.assertEqual({'node': node.uuid, 'events': events}, result)
+
+    @mock.patch('ironic_teeth_driver.profiling.get_profiler')
+    def test_get_profile(self, profiler_mock):
+        report = {'vendor_passthru.heartbeat': {'calls': 1}}
+        profiler_mock.return_value.get_report.return_value = report
+        profiler_mock.return_value.dump.return_value = ['/tmp/x.pstats']
+
+        result = self.vendor.driver_vendor_passthru(
+            self.task, 'get_profile', sort='time', limit='5', dump=True,
+            reset=True)
+        profiler_mock.return_value.get_report.assert_called_once_with(
+            sort='time', limit=5)
+        self.assertEqual(report, result['entry_points'])
+        self.assertEqual(['/tmp/x.pstats'], result['files'])
+        profiler_mock.return_value.reset.assert_called_once_with()
+
+    @mock.patch('ironic_teeth_driver.profiling.call')
+    def test_vendor_passthru_profiled(self, call_mock):
+        node = FakeNode()
+
+        self.vendor.vendor_passthru(self.task, node, method='get_timeline')
+        call_mock.assert_called_once_with('vendor_passthru.get_timeline',
+                                          self.vendor._get_timeline,
+                                          self.task, node,
+                                          method='get_timeline')
+
+    @mock.patch('ironic_teeth_driver.timeline.get_timeline')
+    def test_get_stats(self, timeline_mock):
+        phases = {'deploy': {'count': 1}}
+        timeline_mock.return_value.get_phase_stats.return_value = phases
+
+        result = self.vendor.driver_vendor_passthru(self.task, 'get_stats')
+        self.assertEqual(phases, result['phases'])
+
+    @mock.patch('ironic_teeth_driver.rest.invalidate_capabilities')
+    def test_heartbeat_new_agent_url(self, invalidate_mock):
+        task = FakeTask()
+        fake_node = FakeNode(driver_info={'agent_url': 'http://driver'})
+        kwargs = {
+            'agent_url': 'http://127.0.0.1:9999/bar'
+        }
+        self.vendor._heartbeat(task, fake_node, **kwargs)
+        invalidate_mock.assert_any_call('http://127.0.0.1/foo')
+        invalidate_mock.assert_any_call('http://driver')
+
+        invalidate_mock.reset_mock()
+        self.vendor._heartbeat(task, fake_node, **kwargs)
+        self.assertFalse(invalidate_mock.called)
+
+    @mock.patch('ironic_teeth_driver.rest.invalidate_capabilities')
+    @mock.patch('ironic_teeth_driver.vendor.TeethVendorInterface'
+                '._find_node_by_hardware')
+    def test_heartbeat_no_uuid_invalidates_capabilities(self, find_mock,
+                                                        invalidate_mock):
+        find_mock.return_value = FakeNode()
+        kwargs = {
+            'hardware': [
+                {
+                    'id': 'aa:bb:cc:dd:ee:ff',
+                    'type': 'mac_address'
+                }
+            ]
+        }
+        self.vendor._heartbeat_no_uuid(FakeTask(), **kwargs)
+        invalidate_mock.assert_called_once_with('http://127.0.0.1/foo')
 
     def test_heartbeat_bad_params(self):
         task = FakeTask()
@@ -195,3 +433,121 @@ class TestTeethVendor(unittest.TestCase):
                           self.vendor._heartbeat,
                           task=task,
                           node=node)
+
+
+class FakeRow(object):
+    def __init__(self, id, uuid, provision_state=states.ACTIVE,
+                 reservation=None):
+        self.id = id
+        self.uuid = uuid
+        self.provision_state = provision_state
+        self.reservation = reservation
+        self.driver_info = {}
+        self.instance_info = {'agent_url': 'http://{0}:9999'.format(uuid)}
+
+
+class TestBulkHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.vendor = vendor.TeethVendorInterface()
+        self.task = FakeTask()
+        session_patcher = mock.patch('ironic.db.sqlalchemy.api.get_session')
+        session_mock = session_patcher.start()
+        self.addCleanup(session_patcher.stop)
+        self.session = mock.MagicMock()
+        session_mock.return_value = self.session
+        query_patcher = mock.patch('ironic.db.sqlalchemy.api.model_query')
+        self.query_mock = query_patcher.start()
+        self.addCleanup(query_patcher.stop)
+        self.rows = []
+        query = self.query_mock.return_value.filter.return_value
+        query.with_lockmode.return_value = self.rows
+
+    def _heartbeat(self, node_uuid, **kwargs):
+        heartbeat = {'node_uuid': node_uuid,
+                     'agent_url': 'http://{0}:9999'.format(node_uuid)}
+        heartbeat.update(kwargs)
+        return heartbeat
+
+    @mock.patch('ironic_teeth_driver.power.get_power_cache')
+    @mock.patch('ironic_teeth_driver.rest.invalidate_capabilities')
+    def test_bulk_heartbeat(self, invalidate_mock, cache_mock):
+        self.rows.extend([
+            FakeRow(1, 'node-1'),
+            FakeRow(2, 'node-2', provision_state=states.DEPLOYING),
+            FakeRow(3, 'node-3', reservation='conductor-1'),
+        ])
+        heartbeats = [self._heartbeat('node-1', timestamp=1000),
+                      self._heartbeat('node-2'),
+                      self._heartbeat('node-3'),
+                      self._heartbeat('node-4')]
+
+        result = self.vendor.driver_vendor_passthru(
+            self.task, 'bulk_heartbeat', heartbeats=heartbeats)
+        self.assertEqual(['node-1'], result['applied'])
+        self.assertEqual(['node-2'], result['full_heartbeat'])
+        self.assertEqual(['node-3'], result['reserved'])
+        self.assertEqual(['node-4'], result['not_found'])
+        self.assertEqual(1, self.query_mock.call_count)
+
+        # All the nodes are written with one statement.
+        self.assertEqual(1, self.session.execute.call_count)
+        updates = self.session.execute.call_args[0][1]
+        self.assertEqual(1, len(updates))
+        self.assertEqual(1, updates[0]['node_id'])
+        info = updates[0]['new_instance_info']
+        self.assertEqual(datetime.datetime.fromtimestamp(1000),
+                         info['last_heartbeat'])
+        self.assertEqual('http://node-1:9999', info['agent_url'])
+        self.assertFalse(invalidate_mock.called)
+        # Every agent heard from is on, whether its heartbeat was applied.
+        self.assertEqual(3, cache_mock.return_value.heartbeat.call_count)
+
+    @mock.patch('ironic_teeth_driver.rest.invalidate_capabilities')
+    def test_bulk_heartbeat_latest_wins(self, invalidate_mock):
+        self.rows.append(FakeRow(1, 'node-1'))
+        heartbeats = [self._heartbeat('node-1', timestamp=2000,
+                                      agent_url='http://new:9999'),
+                      self._heartbeat('node-1', timestamp=1000)]
+
+        result = self.vendor._bulk_heartbeat(self.task,
+                                             heartbeats=heartbeats)
+        self.assertEqual(['node-1'], result['applied'])
+        info = self.session.execute.call_args[0][1][0]['new_instance_info']
+        self.assertEqual('http://new:9999', info['agent_url'])
+        invalidate_mock.assert_called_once_with('http://node-1:9999')
+
+    @mock.patch('ironic_teeth_driver.rest.invalidate_capabilities')
+    def test_bulk_heartbeat_null_columns(self, invalidate_mock):
+        row = FakeRow(1, 'node-1')
+        row.instance_info = None
+        row.driver_info = None
+        self.rows.append(row)
+
+        result = self.vendor._bulk_heartbeat(
+            self.task, heartbeats=[self._heartbeat('node-1')])
+        self.assertEqual(['node-1'], result['applied'])
+        info = self.session.execute.call_args[0][1][0]['new_instance_info']
+        self.assertEqual('http://node-1:9999', info['agent_url'])
+        self.assertFalse(invalidate_mock.called)
+
+    def test_bulk_heartbeat_nothing_to_write(self):
+        self.rows.append(FakeRow(1, 'node-1', reservation='conductor-1'))
+
+        self.vendor._bulk_heartbeat(self.task,
+                                    heartbeats=[self._heartbeat('node-1')])
+        self.assertFalse(self.session.execute.called)
+
+    def test_bulk_heartbeat_bad_params(self):
+        for heartbeats in (None, [], [{'node_uuid': 'node-1'}],
+                           [self._heartbeat('node-1', timestamp='never')]):
+            self.assertRaises(exception.InvalidParameterValue,
+                              self.vendor._bulk_heartbeat,
+                              self.task, heartbeats=heartbeats)
+        self.assertFalse(self.query_mock.called)
+
+    def test_bulk_heartbeat_too_many(self):
+        heartbeats = [self._heartbeat('node-{0}'.format(i))
+                      for i in range(1001)]
+        self.assertRaises(exception.InvalidParameterValue,
+                          self.vendor._bulk_heartbeat,
+                          self.task, heartbeats=heartbeats)
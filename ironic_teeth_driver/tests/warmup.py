@@ -0,0 +1,136 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import datetime
+
+from oslo.config import cfg
+
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import warmup
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class FakeNode(object):
+    def __init__(self, uuid, heartbeat_age=None):
+        self.uuid = uuid
+        self.driver_info = {'agent_url': 'http://{0}:9999'.format(uuid)}
+        self.instance_info = {}
+        if heartbeat_age is not None:
+            self.instance_info['last_heartbeat'] = (
+                datetime.datetime.now() -
+                datetime.timedelta(seconds=heartbeat_age))
+
+
+class TestWarmer(unittest.TestCase):
+    def setUp(self):
+        self.warmer = warmup.Warmer()
+        self.driver = mock.Mock()
+        client_patcher = mock.patch('ironic_teeth_driver.rest.get_client')
+        self.client = client_patcher.start().return_value
+        self.addCleanup(client_patcher.stop)
+        capabilities_patcher = mock.patch.dict(rest._CAPABILITIES, clear=True)
+        capabilities_patcher.start()
+        self.addCleanup(capabilities_patcher.stop)
+        CONF.set_override('heartbeat_timeout', 300, group='teeth_driver')
+        CONF.set_override('warmup_batch_size', 2, group='teeth_driver')
+        CONF.set_override('warmup_connect_rate', 0, group='teeth_driver')
+
+    def tearDown(self):
+        CONF.clear_override('heartbeat_timeout', group='teeth_driver')
+        CONF.clear_override('warmup_batch_size', group='teeth_driver')
+        CONF.clear_override('warmup_connect_rate', group='teeth_driver')
+
+    @mock.patch('eventlet.greenthread.spawn_after')
+    def test_add_debounced(self, spawn_mock):
+        self.warmer.add(self.driver, 'node-1')
+        self.warmer.add(self.driver, 'node-2')
+        spawn_mock.assert_called_once_with(
+            CONF.teeth_driver.warmup_delay, self.warmer.run, self.driver)
+
+        with mock.patch.object(self.warmer, '_prefetch') as prefetch_mock:
+            prefetch_mock.return_value = ([], [])
+            self.warmer.run(self.driver)
+            prefetch_mock.assert_called_once_with(['node-1', 'node-2'])
+
+        # Nodes taken over later are warmed up by another run.
+        self.warmer.add(self.driver, 'node-3')
+        self.assertEqual(2, spawn_mock.call_count)
+
+    @mock.patch('ironic.db.sqlalchemy.api.model_query')
+    def test_prefetch_batched(self, query_mock):
+        query = query_mock.return_value.filter.return_value
+        query.all.return_value = ['node']
+        query.filter.return_value.all.return_value = [('node', 'mac')]
+
+        nodes, ports = self.warmer._prefetch(['node-1', 'node-2', 'node-3'])
+        # Two batches of a node and a port query each.
+        self.assertEqual(4, query_mock.call_count)
+        self.assertEqual(['node', 'node'], nodes)
+        self.assertEqual([('node', 'mac'), ('node', 'mac')], ports)
+
+    @mock.patch('ironic_teeth_driver.timeline.get_timeline')
+    def test_run(self, timeline_mock):
+        nodes = [FakeNode('node-1', heartbeat_age=10),
+                 FakeNode('node-2', heartbeat_age=1000),
+                 FakeNode('node-3')]
+        ports = [('node-1', 'aa:bb:cc:dd:ee:01')]
+        self.warmer._pending = set(['node-1', 'node-2', 'node-3'])
+
+        with mock.patch.object(self.warmer, '_prefetch') as prefetch_mock:
+            prefetch_mock.return_value = (nodes, ports)
+            self.warmer.run(self.driver)
+
+        index = self.driver.vendor.hardware_index
+        # The loaded rows are primed, the index is not rebuilt.
+        index.prime.assert_called_once_with(nodes, ports)
+        self.assertFalse(index.refresh.called)
+        # Only the agent which heartbeated recently is contacted.
+        self.client.get_capabilities.assert_called_once_with(nodes[0])
+        timeline_mock.return_value.add_sample.assert_called_once_with(
+            'takeover_warmup', mock.ANY)
+
+    def test_connect_skips_known_agents(self):
+        node = FakeNode('node-1', heartbeat_age=10)
+        rest._CAPABILITIES[node.driver_info['agent_url']] = mock.Mock()
+        self.assertTrue(rest.has_capabilities(node.driver_info['agent_url']))
+
+        self.assertEqual(0, self.warmer._connect(self.client, [node]))
+        self.assertFalse(self.client.get_capabilities.called)
+
+    def test_run_failure_logged(self):
+        self.warmer._pending = set(['node-1'])
+        with mock.patch.object(self.warmer, '_prefetch') as prefetch_mock:
+            prefetch_mock.side_effect = RuntimeError('db gone')
+            self.warmer.run(self.driver)
+        self.assertFalse(self.client.get_capabilities.called)
+
+
+class TestRateLimiter(unittest.TestCase):
+    @mock.patch('eventlet.greenthread.sleep')
+    @mock.patch('time.time')
+    def test_spacing(self, time_mock, sleep_mock):
+        time_mock.return_value = 1000
+        limiter = warmup._RateLimiter(4)
+
+        limiter.wait()
+        self.assertFalse(sleep_mock.called)
+        limiter.wait()
+        sleep_mock.assert_called_once_with(0.25)
+        limiter.wait()
+        sleep_mock.assert_called_with(0.5)
@@ -0,0 +1,90 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic.common import states
+from ironic_teeth_driver import watchdog
+
+import mock
+import unittest
+
+CONF = cfg.CONF
+
+
+class FakeRow(object):
+    def __init__(self, uuid, provision_state, instance_info):
+        self.uuid = uuid
+        self.provision_state = provision_state
+        self.instance_info = instance_info
+
+
+@mock.patch('time.time')
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = watchdog.Watchdog()
+        CONF.set_override('provision_timeout', 3600, group='teeth_driver')
+        self.addCleanup(CONF.clear_override, 'provision_timeout',
+                        group='teeth_driver')
+
+    @mock.patch('eventlet.greenthread.spawn_after')
+    def test_start_once(self, spawn_mock, time_mock):
+        self.watchdog.start()
+        self.watchdog.start()
+        spawn_mock.assert_called_once_with(
+            CONF.teeth_driver.provision_check_interval, self.watchdog.run)
+
+    @mock.patch('ironic.conductor.task_manager.acquire')
+    @mock.patch('ironic.db.sqlalchemy.api.model_query')
+    def test_check(self, query_mock, acquire_mock, time_mock):
+        time_mock.return_value = 10000
+        query = query_mock.return_value.filter.return_value
+        query.__iter__.return_value = iter([
+            FakeRow('stalled', states.DEPLOYING,
+                    {'deploy_state': {'progress_at': 1000}}),
+            FakeRow('busy', states.DELETING,
+                    {'decom_state': {'progress_at': 1000}}),
+            FakeRow('recent', states.DELETING,
+                    {'decom_state': {'progress_at': 9000}}),
+            FakeRow('other-driver', states.DEPLOYING, {}),
+        ])
+        task = acquire_mock.return_value.__enter__.return_value
+
+        def acquire(context, node_uuid):
+            if node_uuid == 'busy':
+                raise exception.NodeLocked(node=node_uuid, host='other')
+            return acquire_mock.return_value
+        acquire_mock.side_effect = acquire
+
+        self.assertEqual(['stalled'], self.watchdog.check())
+        self.assertEqual(2, acquire_mock.call_count)
+        task.driver.deploy.check_timeout.assert_called_once_with(task,
+                                                                 task.node)
+        self.assertTrue(task.node.save.called)
+
+    @mock.patch('ironic.db.sqlalchemy.api.model_query')
+    def test_check_disabled(self, query_mock, time_mock):
+        CONF.set_override('provision_timeout', 0, group='teeth_driver')
+        self.assertEqual([], self.watchdog.check())
+        self.assertFalse(query_mock.called)
+
+    @mock.patch('eventlet.greenthread.spawn_after')
+    def test_run_reschedules_after_failure(self, spawn_mock, time_mock):
+        with mock.patch.object(self.watchdog, 'check') as check_mock:
+            check_mock.side_effect = RuntimeError('db gone')
+            self.watchdog.run()
+        spawn_mock.assert_called_once_with(
+            CONF.teeth_driver.provision_check_interval, self.watchdog.run)
@@ -0,0 +1,175 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import collections
+import contextlib
+import math
+import threading
+import time
+
+from oslo.config import cfg
+
+timeline_opts = [
+    cfg.IntOpt('timeline_max_events',
+               default=200,
+               help='Number of timeline events kept in memory per node. '
+                    'Older events are dropped.'),
+    cfg.IntOpt('timeline_max_nodes',
+               default=5000,
+               help='Number of nodes to keep timelines for. Once reached, '
+                    'the oldest timeline is dropped.'),
+    cfg.IntOpt('timeline_max_samples',
+               default=1000,
+               help='Number of duration samples kept per phase for '
+                    'computing percentiles.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(timeline_opts, group='teeth_driver')
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return None
+    rank = int(math.ceil(pct * len(sorted_samples) / 100.0)) - 1
+    rank = min(max(rank, 0), len(sorted_samples) - 1)
+    return sorted_samples[rank]
+
+
+class Timeline(object):
+    """In-memory record of what happened to each node, and how long each
+    phase of its deploy or decom took.
+
+    Events are kept in a bounded ring buffer per node, and timelines are
+    dropped oldest first once too many nodes are tracked. Phase durations
+    are kept in a bounded buffer per phase name so percentiles can be
+    computed.
+
+    A phase can be timed within a single call with `span`, or across calls
+    (eg. from sending an agent command until a heartbeat reports it done)
+    with `start_phase` and `end_phase`.
+    """
+    def __init__(self, max_events, max_nodes, max_samples):
+        self.max_events = max_events
+        self.max_nodes = max_nodes
+        self.max_samples = max_samples
+        self._events = {}
+        self._node_order = collections.deque()
+        self._phase_starts = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, node_uuid, event, **details):
+        """Record that event happened to a node just now."""
+        entry = {'time': time.time(), 'event': event}
+        entry.update(details)
+        with self._lock:
+            events = self._events.get(node_uuid)
+            if events is None:
+                events = collections.deque(maxlen=self.max_events)
+                self._events[node_uuid] = events
+                self._node_order.append(node_uuid)
+                self._evict()
+            events.append(entry)
+
+    def _evict(self):
+        while len(self._node_order) > self.max_nodes:
+            node_uuid = self._node_order.popleft()
+            self._events.pop(node_uuid, None)
+            self._phase_starts.pop(node_uuid, None)
+
+    def add_sample(self, phase, duration):
+        """Add a duration, in seconds, to the samples for phase."""
+        with self._lock:
+            samples = self._samples.get(phase)
+            if samples is None:
+                samples = collections.deque(maxlen=self.max_samples)
+                self._samples[phase] = samples
+            samples.append(duration)
+
+    @contextlib.contextmanager
+    def span(self, node_uuid, phase, **details):
+        """Context manager which records the start and end of phase, and
+        its duration.
+        """
+        self.record(node_uuid, phase + '.start', **details)
+        start = time.time()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            duration = time.time() - start
+            self.record(node_uuid, phase + '.end', duration=duration,
+                        status=status)
+            self.add_sample(phase, duration)
+
+    def start_phase(self, node_uuid, phase, **details):
+        """Record the start of a phase which will end in a later call."""
+        self.record(node_uuid, phase + '.start', **details)
+        with self._lock:
+            self._phase_starts.setdefault(node_uuid, {})[phase] = time.time()
+
+    def end_phase(self, node_uuid, phase, **details):
+        """Record the end of a phase started with `start_phase`.
+
+        If the start was not seen by this process (eg. the conductor
+        restarted in between) only the event is recorded.
+        """
+        with self._lock:
+            start = self._phase_starts.get(node_uuid, {}).pop(phase, None)
+        if start is None:
+            self.record(node_uuid, phase + '.end', **details)
+            return
+        duration = time.time() - start
+        self.record(node_uuid, phase + '.end', duration=duration, **details)
+        self.add_sample(phase, duration)
+
+    def get_events(self, node_uuid):
+        """Return the recorded events for a node, oldest first."""
+        with self._lock:
+            return list(self._events.get(node_uuid, []))
+
+    def get_phase_stats(self):
+        """Return count and percentiles of the duration of each phase."""
+        with self._lock:
+            samples = dict((phase, sorted(durations))
+                           for phase, durations in self._samples.items())
+        stats = {}
+        for phase, durations in samples.items():
+            phase_stats = {
+                'count': len(durations),
+                'max': durations[-1] if durations else None,
+            }
+            for pct in PERCENTILES:
+                phase_stats['p{0}'.format(pct)] = percentile(durations, pct)
+            stats[phase] = phase_stats
+        return stats
+
+
+_TIMELINE = None
+
+
+def get_timeline():
+    """Return the timeline shared by the whole driver."""
+    global _TIMELINE
+    if _TIMELINE is None:
+        _TIMELINE = Timeline(CONF.teeth_driver.timeline_max_events,
+                             CONF.teeth_driver.timeline_max_nodes,
+                             CONF.teeth_driver.timeline_max_samples)
+    return _TIMELINE
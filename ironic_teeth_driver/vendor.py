@@ -13,19 +13,35 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import base64
 import datetime
+import time
 
 from oslo.config import cfg
+import sqlalchemy
 from sqlalchemy.orm import exc
 
 from ironic.common import exception
+from ironic.common import states
 from ironic.common import utils
+from ironic.conductor import task_manager
 from ironic.db.sqlalchemy import api as dbapi
+from ironic.db.sqlalchemy import models
 from ironic.drivers import base
 from ironic.objects import node
 #TODO(pcsforeducation) drop this when we move into Ironic
 from ironic.openstack.common.gettextutils import _
-from ironic.openstack.common import log
+from ironic_teeth_driver import blobstore
+from ironic_teeth_driver import exceptions
+from ironic_teeth_driver import hardware_index
+from ironic_teeth_driver import inventory
+from ironic_teeth_driver import log_utils
+from ironic_teeth_driver import power
+from ironic_teeth_driver import profiling
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import scheduler
+from ironic_teeth_driver import swarm
+from ironic_teeth_driver import timeline
 
 teeth_driver_opts = [
     cfg.IntOpt('heartbeat_timeout',
@@ -35,23 +51,34 @@ teeth_driver_opts = [
                      'contact Ironic at some set fraction of this time '
                      '(defaulting to 2/3 the max time).'
                      'Defaults to 5 minutes.'),
+    cfg.IntOpt('bulk_heartbeat_max_size',
+               default=1000,
+               help='Maximum number of heartbeats accepted in one '
+                    'bulk_heartbeat call.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(teeth_driver_opts, group='teeth_driver')
 
+LOG = log_utils.getLogger(__name__)
+
 
 class TeethVendorInterface(base.VendorInterface):
     #TODO(pcsforeducation) use MixingVendorInterface when merged
     def __init__(self):
         self.vendor_routes = {
-            'heartbeat': self._heartbeat
+            'heartbeat': self._heartbeat,
+            'get_timeline': self._get_timeline,
+            'get_inventory': self._get_inventory,
+            'get_blob': self._get_blob,
         }
         self.driver_routes = {
-            'lookup': self._heartbeat_no_uuid
+            'lookup': self._heartbeat_no_uuid,
+            'bulk_heartbeat': self._bulk_heartbeat,
+            'get_stats': self._get_stats,
+            'get_profile': self._get_profile,
         }
-        self.db_connection = dbapi.get_backend()
-        self.LOG = log.getLogger(__name__)
+        self.hardware_index = hardware_index.HardwareIndex()
 
     def validate(self, node, **kwargs):
         """Validate the driver-specific Node deployment info.
@@ -74,7 +101,8 @@ class TeethVendorInterface(base.VendorInterface):
         if method not in self.driver_routes:
             raise ValueError('No handler for method {0}'.format(method))
         func = self.driver_routes[method]
-        return func(task, **kwargs)
+        return profiling.call('driver_vendor_passthru.' + method, func, task,
+                              **kwargs)
 
     def vendor_passthru(self, task, node, **kwargs):
         """A node that knows its UUID should heartbeat to this passthru. It
@@ -87,7 +115,8 @@ class TeethVendorInterface(base.VendorInterface):
         if method not in self.vendor_routes:
             raise ValueError('No handler for method {0}'.format(method))
         func = self.vendor_routes[method]
-        return func(task, node, **kwargs)
+        return profiling.call('vendor_passthru.' + method, func, task, node,
+                              **kwargs)
 
     def _heartbeat(self, task, node, **kwargs):
         """Method for agent to periodically check in. The agent should be
@@ -95,22 +124,276 @@ class TeethVendorInterface(base.VendorInterface):
 
         kwargs should have the following format:
         {
-            'agent_url': 'http://AGENT_HOST:AGENT_PORT'
+            'agent_url': 'http://AGENT_HOST:AGENT_PORT',
+            'commands': [
+                {
+                    'id': 'COMMAND_ID',
+                    'command_name': 'standby.prepare_image',
+                    'command_status': 'RUNNING',
+                    'command_error': None,
+                    'command_result': None
+                }
+            ],
+            'drives': ['/dev/sda', '/dev/sdb'],
+            'cached_images': ['IMAGE_ID'],
+            'cached_manifests': ['MANIFEST_DIGEST']
         }
                 AGENT_PORT defaults to 9999.
+
+        'commands' is optional, and lists the status of commands the agent
+        has run recently. It is used to advance in-flight deploys and decoms
+        without having to ask the agent.
+
+        'drives' is only required while the node is being decommissioned,
+        and lists the drives the agent will erase.
+
+        'cached_images' is optional, and lists the images the agent holds
+        and can serve to its peers.
+
+        'cached_manifests' is optional, and lists the chunk manifests of the
+        images the agent holds, so deploys only send the chunks it lacks.
         """
         if 'agent_url' not in kwargs:
             raise exception.InvalidParameterValue('"agent_url" is a required'
                                                   ' parameter')
+        timeline.get_timeline().record(node.uuid, 'heartbeat',
+                                       agent_url=kwargs['agent_url'])
+        if node.instance_info.get('agent_url') != kwargs['agent_url']:
+            # A new agent_url means a new agent process.
+            self._agent_restarted(node)
         node.instance_info['last_heartbeat'] = datetime.datetime.now()
         node.instance_info['agent_url'] = kwargs['agent_url']
+        power.get_power_cache().heartbeat(node.uuid)
+        if 'cached_images' in kwargs:
+            swarm.get_registry().update_holder(node,
+                                               kwargs['cached_images'])
+        if 'cached_manifests' in kwargs:
+            node.instance_info['cached_manifests'] = \
+                kwargs['cached_manifests']
+        task.driver.deploy.continue_deploy(task, node,
+                                           commands=kwargs.get('commands'))
+        task.driver.deploy.continue_decom(task, node,
+                                          commands=kwargs.get('commands'),
+                                          drives=kwargs.get('drives'))
         node.save(task)
         return node
 
+    def _bulk_heartbeat(self, context, **kwargs):
+        """Record the heartbeats of many agents at once, for relays
+        aggregating the heartbeats of a rack.
+
+        kwargs should have the following format:
+        {
+            'heartbeats': [
+                {
+                    'node_uuid': 'NODE_UUID',
+                    'agent_url': 'http://AGENT_HOST:AGENT_PORT',
+                    'timestamp': 1400000000.0
+                }
+            ]
+        }
+        'timestamp' is optional, and is the time.time() at which the agent
+        heartbeated; it defaults to now.
+
+        The nodes are read and written with one query each, in a single
+        transaction. Only the last heartbeat time and agent_url are
+        recorded, so heartbeats of nodes being deployed or decommissioned,
+        which carry command statuses, are not applied: they are returned
+        in 'full_heartbeat' and must be sent through the node's heartbeat
+        vendor passthru. Nodes locked by a conductor are returned in
+        'reserved', and the relay should send their heartbeat again later.
+        Either way, the heartbeats of known nodes are recorded in this
+        conductor's power state cache. The conductor which owns a node
+        learns of them from its last_heartbeat, see `power.CachedPower`.
+        """
+        heartbeats = kwargs.get('heartbeats')
+        if not heartbeats or not isinstance(heartbeats, list):
+            raise exception.InvalidParameterValue('"heartbeats" is a '
+                                                  'required parameter and '
+                                                  'must be a non-empty list')
+        if len(heartbeats) > CONF.teeth_driver.bulk_heartbeat_max_size:
+            raise exception.InvalidParameterValue(
+                'At most {0} heartbeats can be sent at once'.format(
+                    CONF.teeth_driver.bulk_heartbeat_max_size))
+        now = datetime.datetime.now()
+        # node uuid -> (agent_url, time of heartbeat), keeping the latest.
+        latest = {}
+        for heartbeat in heartbeats:
+            if 'node_uuid' not in heartbeat or 'agent_url' not in heartbeat:
+                raise exception.InvalidParameterValue(
+                    'Heartbeats require "node_uuid" and "agent_url": '
+                    '{0}'.format(heartbeat))
+            when = now
+            if heartbeat.get('timestamp') is not None:
+                try:
+                    when = min(now, datetime.datetime.fromtimestamp(
+                        float(heartbeat['timestamp'])))
+                except (TypeError, ValueError):
+                    raise exception.InvalidParameterValue(
+                        'Invalid heartbeat timestamp: {0}'.format(heartbeat))
+            node_uuid = heartbeat['node_uuid']
+            if node_uuid not in latest or latest[node_uuid][1] < when:
+                latest[node_uuid] = (heartbeat['agent_url'], when)
+
+        result = {
+            'heartbeat_timeout': CONF.teeth_driver.heartbeat_timeout,
+            'applied': [],
+            'full_heartbeat': [],
+            'reserved': [],
+            'not_found': [],
+        }
+        tl = timeline.get_timeline()
+        power_cache = power.get_power_cache()
+        updates = []
+        session = dbapi.get_session()
+        with session.begin():
+            query = dbapi.model_query(models.Node.id, models.Node.uuid,
+                                      models.Node.reservation,
+                                      models.Node.provision_state,
+                                      models.Node.driver_info,
+                                      models.Node.instance_info,
+                                      session=session)
+            query = query.filter(models.Node.uuid.in_(list(latest)))
+            found = set()
+            for row in query.with_lockmode('update'):
+                found.add(row.uuid)
+                agent_url, when = latest[row.uuid]
+                power_cache.heartbeat(row.uuid,
+                                      observed_at=time.mktime(
+                                          when.timetuple()))
+                if row.reservation is not None:
+                    result['reserved'].append(row.uuid)
+                    continue
+                if row.provision_state in (states.DEPLOYING, states.DELETING):
+                    result['full_heartbeat'].append(row.uuid)
+                    continue
+                instance_info = dict(row.instance_info or {})
+                if instance_info.get('agent_url') != agent_url:
+                    self._agent_restarted(row)
+                instance_info['last_heartbeat'] = when
+                instance_info['agent_url'] = agent_url
+                updates.append({'node_id': row.id,
+                                'new_instance_info': instance_info})
+                tl.record(row.uuid, 'heartbeat', agent_url=agent_url)
+                result['applied'].append(row.uuid)
+            if updates:
+                table = models.Node.__table__
+                statement = table.update().where(
+                    table.c.id == sqlalchemy.bindparam('node_id')).values(
+                        instance_info=sqlalchemy.bindparam(
+                            'new_instance_info'))
+                session.execute(statement, updates)
+        result['not_found'] = sorted(set(latest) - found)
+        return result
+
+    def _agent_restarted(self, node):
+        """Drop what is cached about the node's agent, since it may now be
+        a different version.
+        """
+        rest.invalidate_node_capabilities(node)
+
+    def _get_timeline(self, task, node, **kwargs):
+        """Return the events recorded for this node by this conductor,
+        oldest first.
+        """
+        return {
+            'node': node.uuid,
+            'events': timeline.get_timeline().get_events(node.uuid)
+        }
+
+    def _get_inventory(self, task, node, **kwargs):
+        """Return the hardware the node's agent last reported on lookup,
+        and the recent changes to it.
+        """
+        info = node.extra.get('inventory') or {}
+        return {
+            'node': node.uuid,
+            'hardware': inventory.get_inventory(node),
+            'updated_at': info.get('updated_at'),
+            'history': info.get('history') or []
+        }
+
+    def _get_blob(self, task, node, **kwargs):
+        """Return the content of one of the node's instance files which was
+        moved to the blob store, base64 encoded. Agents call this for files
+        in prepare_image which are given as {'blob': DIGEST, 'size': SIZE}
+        references.
+
+        kwargs should have the following format:
+        {
+            'digest': 'SHA256_HEX_DIGEST'
+        }
+        """
+        if 'digest' not in kwargs:
+            raise exception.InvalidParameterValue('"digest" is a required'
+                                                  ' parameter')
+        digest = kwargs['digest']
+        # Only serve the node its own files, not any blob it can name.
+        if digest not in (node.instance_info.get('blobs') or []):
+            raise exception.NotFound(
+                'Blob {0} not found for node {1}'.format(digest, node.uuid))
+        data = blobstore.get_store().get(digest)
+        return {
+            'node': node.uuid,
+            'digest': digest,
+            'content': base64.b64encode(data).decode('ascii')
+        }
+
+    def _get_stats(self, context, **kwargs):
+        """Return runtime statistics for the driver on this conductor.
+
+        'phases' has the count and 50th, 90th and 99th percentile
+        durations in seconds of each timed phase. 'log_suppressed' has the
+        number of times each rate limited log message was suppressed.
+        'power_cache' has the number of power state reads answered from
+        the power state cache and the number which went to the BMC.
+        'agent_requests' has, per priority, the requests to agents queued,
+        in flight and sent, and how long they waited in the queue.
+        """
+        return {
+            'phases': timeline.get_timeline().get_phase_stats(),
+            'log_suppressed': log_utils.get_suppressed(),
+            'power_cache': power.get_power_cache().get_stats(),
+            'agent_requests': scheduler.get_scheduler().get_stats()
+        }
+
+    def _get_profile(self, context, **kwargs):
+        """Return the profiles of the calls sampled when profiling_sample_rate
+        is set, aggregated per entry point.
+
+        kwargs may have the following format:
+        {
+            'sort': 'cumulative',
+            'limit': 20,
+            'dump': False,
+            'reset': False
+        }
+        'sort' is one of 'cumulative', 'time' and 'calls', and 'limit' the
+        number of functions listed per entry point. With 'dump', the stats
+        are also written to profiling_dump_dir as pstats files, whose paths
+        are returned. With 'reset', the stats are cleared afterwards.
+
+        The stats of a call include the other green threads which ran while
+        it waited; see `profiling.Profiler`.
+        """
+        profiler = profiling.get_profiler()
+        result = {
+            'sample_rate': CONF.teeth_driver.profiling_sample_rate,
+            'entry_points': profiler.get_report(
+                sort=kwargs.get('sort', 'cumulative'),
+                limit=int(kwargs.get('limit', 20)))
+        }
+        if kwargs.get('dump'):
+            result['files'] = profiler.dump(
+                CONF.teeth_driver.profiling_dump_dir)
+        if kwargs.get('reset'):
+            profiler.reset()
+        return result
+
     def _heartbeat_no_uuid(self, context, **kwargs):
         """Method to be called the first time a ramdisk agent checks in. This
         can be because this is a node just entering decom or a node that
-        rebooted for some reason. We will use the mac addresses listed in the
+        rebooted for some reason. We will use the hardware listed in the
         kwargs to find the matching node, then return the node object to the
         agent. The agent can that use that UUID to use the normal vendor
         passthru method.
@@ -135,7 +418,12 @@ class TeethVendorInterface(base.VendorInterface):
         hardware is a list of dicts with id being the actual mac address,
         with type 'mac_address' for the non-IPMI ports in the
         server, (the normal network ports). They should be in the format
-        "aa:bb:cc:dd:ee:ff".
+        "aa:bb:cc:dd:ee:ff". Entries of type 'system_serial', 'bmc_address'
+        and 'disk_serial' also help identify the node, so it can be found
+        even if its NICs were swapped; see `hardware_index.HardwareIndex`
+        for how they are weighed. Entries of other types are ignored for
+        lookup, but the whole list is stored as the node's inventory; see
+        `inventory.update_inventory`.
 
         This method will also return the timeout for heartbeats. The driver
         will expect the agent to heartbeat before that timeout, or it will be
@@ -147,82 +435,81 @@ class TeethVendorInterface(base.VendorInterface):
                                                   'required parameter and must'
                                                   ' not be empty')
 
-        # Find the address from the hardware list
-        mac_addresses = []
+        keys = []
         for hardware in kwargs['hardware']:
             if 'id' not in hardware or 'type' not in hardware:
-                self.LOG.warning(_('Malformed hardware entry %s') % hardware)
+                LOG.warning(_('Malformed hardware entry %s'), hardware,
+                            key='malformed')
+                continue
+            if hardware['type'] not in hardware_index.KEY_WEIGHTS:
                 continue
-            if hardware['type'] == 'mac_address':
+            if hardware['type'] == hardware_index.MAC_ADDRESS:
                 try:
-                    mac = utils.validate_and_normalize_mac(hardware['id'])
+                    utils.validate_and_normalize_mac(hardware['id'])
                 except exception.InvalidMAC:
-                    self.LOG.warning(_('Malformed MAC in hardware entry %s.')
-                                     % hardware)
+                    LOG.warning(_('Malformed MAC in hardware entry %s.'),
+                                hardware, key=hardware['id'])
                     continue
-                mac_addresses.append(mac)
+            keys.append((hardware['type'], hardware['id']))
 
-        node_object = self._find_node_by_macs(context, mac_addresses)
+        try:
+            node_object = self._find_node_by_hardware(context, keys)
+        except (exception.NotFound, exceptions.MultipleChassisFound) as e:
+            # Unenrolled machines retry lookup forever, so log each at most
+            # a few times per window, and without a traceback.
+            LOG.warning(_('Lookup failed for hardware %(keys)s: %(error)s'),
+                        {'keys': keys, 'error': e}, key=tuple(keys))
+            raise
+        self._record_hardware(context, node_object, keys, kwargs['hardware'])
+        # Agents look their node up when they start.
+        self._agent_restarted(node_object)
+        power.get_power_cache().heartbeat(node_object.uuid)
+        tl = timeline.get_timeline()
+        tl.record(node_object.uuid, 'lookup')
+        tl.end_phase(node_object.uuid, 'agent_boot')
         return {
             'heartbeat_timeout': CONF.teeth_driver.heartbeat_timeout,
             'node': node_object
         }
 
-    def _find_node_by_macs(self, context, mac_addresses):
-        """Given a list of MAC addresses, find the ports that match the MACs
-        and return the node they are all connected to.
+    def _record_hardware(self, context, node_object, keys, hardware):
+        """Record the serials the agent reported, so later lookups find the
+        node even if its NICs are swapped, and its inventory.
 
-        raises NotFound if the ports point to multiple nodes or no
-        nodes.
+        Lookups don't hold the node lock, so the changes are worked out on
+        the node read by the lookup, and only if there are any, made again
+        on the node locked and saved. A concurrent update of the node, such
+        as an operator's, is not overwritten.
         """
-        ports = self._find_ports_by_macs(mac_addresses)
-        node_id = self._get_node_id(ports)
+        changed = hardware_index.update_properties(node_object, keys)
+        if inventory.update_inventory(node_object, hardware):
+            changed = True
+        if not changed:
+            return
         try:
-            node_object = node.Node.get_by_uuid(context, node_id)
-        except exc.NoResultFound:
-            self.LOG.exception(_('Could not find matching node for the '
-                                 'provided MACs.'))
-            raise exception.NotFound(_('Could not find matching node for the '
-                                       'provided MACs.'))
-        return node_object
+            with task_manager.acquire(context, node_object.uuid) as task:
+                changed = hardware_index.update_properties(task.node, keys)
+                if inventory.update_inventory(task.node, hardware):
+                    changed = True
+                if changed:
+                    task.node.save(context)
+        except exception.NodeLocked:
+            # The agent looks the node up again when it next starts.
+            LOG.info(_('Node %s is locked, its hardware is not recorded.'),
+                     node_object.uuid)
 
-    def _find_ports_by_macs(self, mac_addresses):
-        """Given a list of MAC addresses, find the ports that match the MACs
-        and return them as a list of Port objects.
+    def _find_node_by_hardware(self, context, keys):
+        """Given a list of (type, id) hardware keys, return the node they
+        identify.
 
-        raises NotFound if the no matching ports are found.
+        raises NotFound if no node matches, and MultipleChassisFound if the
+        keys match several nodes equally well.
         """
-        ports = []
-        for mac in mac_addresses:
-            # Will do a search by mac if the mac isn't malformed
-            try:
-                # TODO(pcsforeducation) add port.get_by_mac() to Ironic
-                # port.get_by_uuid() would technically work but shouldn't.
-                port = self.db_connection.get_port(port_id=mac)
-                ports.append(port)
-
-            except exc.NoResultFound:
-                # TODO(pcsforeducation) is this the right log level?
-                self.LOG.exception(_('MAC address %s attached to node not in '
-                                     'database') % mac)
-
-        if not ports:
-            raise exception.NotFound(_('None of the provided MAC addresses '
-                                       'match a port.'))
-        return ports
-
-    def _get_node_id(self, ports):
-        """Given a list of ports, either return the node_id they all share or
-        raise a NotFound if there are multiple node_ids (indicating these
-        ports are connected to multiple nodes)
-        """
-        # See if all the ports point to the same node
-        node_ids = set(port.node_id for port in ports)
-        if len(node_ids) == 0:
-            raise exception.NotFound(_('No MAC addresses given match an '
-                                       'existing node.'))
-        if len(node_ids) > 1:
-            raise exception.NotFound(_('Ports matching mac addresses '
-                                       'match multiple nodes.'))
-        # There is only one item left in the set. Pop and return it.
-        return node_ids.pop()
+        node_uuid = self.hardware_index.find_node_uuid(keys)
+        try:
+            node_object = node.Node.get_by_uuid(context, node_uuid)
+        except exc.NoResultFound:
+            # The node was deleted since it was indexed.
+            raise exception.NotFound(_('Could not find matching node for the '
+                                       'provided hardware.'))
+        return node_object
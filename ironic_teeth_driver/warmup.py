@@ -0,0 +1,180 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+
+from eventlet import greenpool
+from eventlet import greenthread
+from oslo.config import cfg
+
+from ironic.db.sqlalchemy import api as dbapi
+from ironic.db.sqlalchemy import models
+from ironic.openstack.common import log
+from ironic_teeth_driver import power
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import timeline
+
+warmup_opts = [
+    cfg.FloatOpt('warmup_delay',
+                 default=2.0,
+                 help='Seconds to wait after a node is taken over before '
+                      'warming up, so the nodes taken over together are '
+                      'warmed up together.'),
+    cfg.IntOpt('warmup_batch_size',
+               default=500,
+               help='Number of nodes prefetched per database query when '
+                    'warming up.'),
+    cfg.FloatOpt('warmup_connect_rate',
+                 default=20.0,
+                 help='Maximum number of agents contacted per second when '
+                      'warming up.'),
+    cfg.IntOpt('warmup_connect_workers',
+               default=10,
+               help='Maximum number of agents contacted at once when '
+                    'warming up.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(warmup_opts, group='teeth_driver')
+CONF.import_opt('heartbeat_timeout', 'ironic_teeth_driver.vendor',
+                group='teeth_driver')
+
+LOG = log.getLogger(__name__)
+
+
+def _heartbeat_age(node):
+    """Seconds since the node's agent last heartbeated, or None."""
+    last = power.get_last_heartbeat(node)
+    if last is None:
+        return None
+    return time.time() - last
+
+
+class _RateLimiter(object):
+    """Spaces calls at least 1/rate seconds apart."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_start = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            greenthread.sleep(start - now)
+
+
+class Warmer(object):
+    """Warms up the caches of a conductor taking over nodes.
+
+    When a conductor dies, each node it managed is taken over separately,
+    so `add` only queues the node; warmup_delay later all the queued nodes
+    are warmed up together:
+
+    - the nodes and their ports are read in a few batched queries,
+    - the nodes and the ports' MACs are primed into the hardware index, so
+      the lookups of rebooting agents don't each query the database,
+    - agents which heartbeated recently are contacted, at most
+      warmup_connect_rate per second, which caches their capabilities
+      and opens pooled connections to them.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._scheduled = False
+
+    def add(self, driver, node_uuid):
+        """Queue node_uuid to be warmed up with driver."""
+        with self._lock:
+            self._pending.add(node_uuid)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        greenthread.spawn_after(CONF.teeth_driver.warmup_delay, self.run,
+                                driver)
+
+    def run(self, driver):
+        with self._lock:
+            uuids = sorted(self._pending)
+            self._pending = set()
+            self._scheduled = False
+        if not uuids:
+            return
+        start = time.time()
+        try:
+            nodes, ports = self._prefetch(uuids)
+            driver.vendor.hardware_index.prime(nodes, ports)
+            connected = self._connect(rest.get_client(), nodes)
+        except Exception as e:
+            # Warming up is an optimization, the nodes work without it.
+            LOG.warning('Warm-up of %(count)d taken over nodes failed: '
+                        '%(error)s', {'count': len(uuids), 'error': e})
+            return
+        elapsed = time.time() - start
+        timeline.get_timeline().add_sample('takeover_warmup', elapsed)
+        LOG.info('Warmed up %(count)d taken over nodes in %(elapsed).1fs, '
+                 'contacted %(connected)d agents.',
+                 {'count': len(uuids), 'elapsed': elapsed,
+                  'connected': connected})
+
+    def _prefetch(self, uuids):
+        """Read the nodes and their ports, two queries per batch."""
+        nodes = []
+        ports = []
+        size = CONF.teeth_driver.warmup_batch_size
+        for offset in range(0, len(uuids), size):
+            batch = uuids[offset:offset + size]
+            query = dbapi.model_query(models.Node)
+            nodes.extend(query.filter(models.Node.uuid.in_(batch)).all())
+            query = dbapi.model_query(models.Node.uuid, models.Port.address)
+            query = query.filter(models.Port.node_id == models.Node.id)
+            ports.extend(query.filter(models.Node.uuid.in_(batch)).all())
+        return nodes, ports
+
+    def _connect(self, client, nodes):
+        """Contact the agents of nodes which heartbeated recently.
+
+        :returns: the number of agents contacted.
+        """
+        timeout = CONF.teeth_driver.heartbeat_timeout
+        alive = []
+        for node in nodes:
+            agent_url = (node.driver_info or {}).get('agent_url')
+            if not agent_url or rest.has_capabilities(agent_url):
+                continue
+            age = _heartbeat_age(node)
+            if age is not None and age < timeout:
+                alive.append(node)
+
+        limiter = _RateLimiter(CONF.teeth_driver.warmup_connect_rate)
+
+        def connect(node):
+            limiter.wait()
+            client.get_capabilities(node)
+
+        pool = greenpool.GreenPool(CONF.teeth_driver.warmup_connect_workers)
+        for _ in pool.imap(connect, alive):
+            pass
+        return len(alive)
+
+
+_WARMER = Warmer()
+
+
+def get_warmer():
+    return _WARMER
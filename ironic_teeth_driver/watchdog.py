@@ -0,0 +1,149 @@
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import threading
+import time
+
+from eventlet import greenthread
+from oslo.config import cfg
+
+from ironic.common import context as ironic_context
+from ironic.common import exception
+from ironic.common import states
+from ironic.conductor import task_manager
+from ironic.db.sqlalchemy import api as dbapi
+from ironic.db.sqlalchemy import models
+from ironic.openstack.common import log
+
+watchdog_opts = [
+    cfg.IntOpt('provision_timeout',
+               default=3600,
+               help='Seconds a deploy or decommission may go without '
+                    'progress before the node is failed. Progress is a '
+                    'deploy phase starting, or a drive being secured, '
+                    'erased or reporting erase progress. 0 disables it.'),
+    cfg.IntOpt('provision_check_interval',
+               default=60,
+               help='Seconds between two checks for deploys and '
+                    'decommissions which stopped making progress.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(watchdog_opts, group='teeth_driver')
+
+LOG = log.getLogger(__name__)
+
+# The instance_info key holding the state of each provision state driven
+# by agent heartbeats, see teeth.TeethDeploy.
+STATE_KEYS = {
+    states.DEPLOYING: 'deploy_state',
+    states.DELETING: 'decom_state',
+}
+
+
+def record_progress(state):
+    """Record in a deploy_state or decom_state that the node progressed."""
+    state['progress_at'] = time.time()
+
+
+def is_stalled(state):
+    """Whether a deploy_state or decom_state recorded no progress for
+    provision_timeout seconds.
+    """
+    timeout = CONF.teeth_driver.provision_timeout
+    if timeout <= 0:
+        return False
+    return state.get('progress_at', 0) < time.time() - timeout
+
+
+class Watchdog(object):
+    """Fails the deploys and decommissions whose agent stopped reporting.
+
+    They only advance when the node's agent heartbeats, so without this a
+    node whose agent died, or rebooted before reporting its last command,
+    would stay DEPLOYING or DELETING forever. Every
+    provision_check_interval seconds, the nodes which made no progress for
+    provision_timeout seconds are locked and handed to their deploy
+    interface's check_timeout, see `teeth.TeethDeploy.check_timeout`.
+
+    Every conductor running the driver checks all the nodes; the node lock
+    keeps two of them from handling the same node at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Start checking periodically, unless already started."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        greenthread.spawn_after(CONF.teeth_driver.provision_check_interval,
+                                self.run)
+
+    def run(self):
+        try:
+            self.check()
+        except Exception as e:
+            LOG.warning('Checking for stalled deploys and decommissions '
+                        'failed: %s', e)
+        greenthread.spawn_after(CONF.teeth_driver.provision_check_interval,
+                                self.run)
+
+    def check(self):
+        """Check the nodes which made no progress for provision_timeout.
+
+        :returns: the uuids of the nodes checked.
+        """
+        if CONF.teeth_driver.provision_timeout <= 0:
+            return []
+        query = dbapi.model_query(models.Node.uuid,
+                                  models.Node.provision_state,
+                                  models.Node.instance_info)
+        query = query.filter(
+            models.Node.provision_state.in_(list(STATE_KEYS)))
+        stalled = []
+        for row in query:
+            key = STATE_KEYS[row.provision_state]
+            state = (row.instance_info or {}).get(key)
+            if state and is_stalled(state):
+                stalled.append(row.uuid)
+
+        context = ironic_context.get_admin_context()
+        checked = []
+        for node_uuid in stalled:
+            try:
+                with task_manager.acquire(context, node_uuid) as task:
+                    check_timeout = getattr(task.driver.deploy,
+                                            'check_timeout', None)
+                    if check_timeout is None:
+                        # Not a node of this driver.
+                        continue
+                    check_timeout(task, task.node)
+                    task.node.save(context)
+                    checked.append(node_uuid)
+            except (exception.NodeLocked, exception.NodeNotFound):
+                # Busy with a heartbeat, or deleted: the next check will
+                # tell.
+                continue
+        return checked
+
+
+_WATCHDOG = Watchdog()
+
+
+def get_watchdog():
+    return _WATCHDOG
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Measure how long loading the teeth driver takes, the way Ironic services
+load it: import the entry point and construct the driver. Each run is a
+fresh interpreter, so nothing is already imported.
+
+    python tools/benchmark_load.py --runs 20
+    python tools/benchmark_load.py --max-construct-ms 50
+
+With --max-import-ms or --max-construct-ms the script exits non-zero if
+the median is slower, so it can guard against regressions.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# Run in the child interpreter. Modules already imported by the
+# interpreter itself are subtracted from the counts.
+_CHILD = '''
+import json
+import sys
+import time
+
+baseline = set(sys.modules)
+start = time.time()
+import ironic_teeth_driver
+imported = time.time()
+driver = ironic_teeth_driver.TeethDriver()
+constructed = time.time()
+constructed_modules = set(sys.modules)
+driver.deploy
+driver.vendor
+driver.power
+used = time.time()
+print(json.dumps({
+    'import': imported - start,
+    'construct': constructed - imported,
+    'first_use': used - constructed,
+    'modules': len(constructed_modules - baseline),
+    'modules_after_use': len(set(sys.modules) - baseline),
+    'requests_loaded': 'requests' in constructed_modules,
+}))
+'''
+
+
+def run_once():
+    output = subprocess.check_output([sys.executable, '-c', _CHILD])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark importing and constructing the teeth driver.')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of fresh interpreters to time.')
+    parser.add_argument('--max-import-ms', type=float,
+                        help='Fail if the median import time is slower.')
+    parser.add_argument('--max-construct-ms', type=float,
+                        help='Fail if the median construction time is '
+                             'slower.')
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    import_ms = median([r['import'] for r in results]) * 1000
+    construct_ms = median([r['construct'] for r in results]) * 1000
+    first_use_ms = median([r['first_use'] for r in results]) * 1000
+    print('runs:                 {0}'.format(args.runs))
+    print('import (median):      {0:.1f} ms'.format(import_ms))
+    print('construct (median):   {0:.1f} ms'.format(construct_ms))
+    print('first use (median):   {0:.1f} ms'.format(first_use_ms))
+    print('modules at startup:   {0}'.format(results[-1]['modules']))
+    print('modules after use:    {0}'.format(
+        results[-1]['modules_after_use']))
+    print('requests at startup:  {0}'.format(
+        results[-1]['requests_loaded']))
+
+    failed = False
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print('FAIL: import slower than {0} ms'.format(args.max_import_ms))
+        failed = True
+    if (args.max_construct_ms is not None and
+            construct_ms > args.max_construct_ms):
+        print('FAIL: construction slower than {0} ms'.format(
+            args.max_construct_ms))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
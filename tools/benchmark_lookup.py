@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Benchmark the lookup and heartbeat vendor passthru methods against a real
+Ironic database: a SQLite file filled with a synthetic fleet of nodes with
+one to several NICs each. A mix of calls is replayed against it through
+the real vendor interface, and calls per second, latency percentiles and
+SQL statements per call are reported for each kind of call.
+
+    python tools/benchmark_lookup.py --nodes 10000 --calls 5000
+    python tools/benchmark_lookup.py --nodes 100000 \\
+        --mix lookup_mac=60,lookup_serial=10,lookup_unknown=10,heartbeat=20
+
+The kinds of calls are:
+    lookup_mac      lookup with all the MACs of a (possibly multi-NIC) node
+    lookup_serial   lookup with a node's system serial and one MAC
+    lookup_unknown  lookup with MACs no node has
+    heartbeat       heartbeat of a node, which saves it
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from oslo.config import cfg
+import sqlalchemy
+
+from ironic.common import context as ironic_context
+from ironic.common import exception
+from ironic.common import states
+from ironic.db.sqlalchemy import models
+from ironic.objects import node as node_object
+from ironic.openstack.common.db.sqlalchemy import session as db_session
+
+import ironic_teeth_driver
+from ironic_teeth_driver import timeline
+
+CONF = cfg.CONF
+
+KINDS = ('lookup_mac', 'lookup_serial', 'lookup_unknown', 'heartbeat')
+DEFAULT_MIX = 'lookup_mac=50,lookup_serial=10,lookup_unknown=10,heartbeat=30'
+INSERT_BATCH = 1000
+
+
+class BenchTask(ironic_context.RequestContext):
+    """Stands in for the TaskManager the conductor passes to passthrus.
+
+    Ironic objects accept it as their context.
+    """
+    def __init__(self, driver):
+        super(BenchTask, self).__init__(is_admin=True)
+        self.driver = driver
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+
+def _mac(n):
+    return ':'.join('{0:02x}'.format((n >> shift) & 0xff)
+                    for shift in (40, 32, 24, 16, 8, 0))
+
+
+def build_fleet(engine, nodes, max_nics, rng):
+    """Insert nodes and their ports, and return, per node, its uuid,
+    serial and MACs.
+    """
+    models.Base.metadata.create_all(engine)
+    fleet = []
+    node_rows = []
+    port_rows = []
+    mac = 0x0200000000
+    for node_id in range(1, nodes + 1):
+        node_uuid = str(uuid.uuid4())
+        serial = 'SN{0:08d}'.format(node_id)
+        macs = []
+        for _ in range(rng.randint(1, max_nics)):
+            mac += 1
+            macs.append(_mac(mac))
+            port_rows.append({'uuid': str(uuid.uuid4()),
+                              'address': macs[-1],
+                              'node_id': node_id,
+                              'extra': {}})
+        node_rows.append({
+            'id': node_id,
+            'uuid': node_uuid,
+            'driver': 'teeth',
+            'power_state': states.POWER_ON,
+            'provision_state': states.NOSTATE,
+            'driver_info': {
+                'ipmi_address': '10.{0}.{1}.{2}'.format(
+                    node_id >> 16 & 0xff, node_id >> 8 & 0xff,
+                    node_id & 0xff),
+                'agent_url': 'http://agent-{0}:9999'.format(node_id),
+            },
+            'instance_info': {},
+            'properties': {'system_serial': serial},
+            'extra': {},
+        })
+        fleet.append({'uuid': node_uuid, 'serial': serial, 'macs': macs,
+                      'agent_url': 'http://agent-{0}:9999'.format(node_id)})
+        if len(node_rows) >= INSERT_BATCH:
+            engine.execute(models.Node.__table__.insert(), node_rows)
+            node_rows = []
+    if node_rows:
+        engine.execute(models.Node.__table__.insert(), node_rows)
+    for start in range(0, len(port_rows), INSERT_BATCH):
+        engine.execute(models.Port.__table__.insert(),
+                       port_rows[start:start + INSERT_BATCH])
+    return fleet
+
+
+def _hardware(macs, serial=None):
+    hardware = [{'type': 'mac_address', 'id': m} for m in macs]
+    if serial:
+        hardware.append({'type': 'system_serial', 'id': serial})
+    hardware.append({'type': 'memory_gb', 'id': '64'})
+    return hardware
+
+
+def make_call(kind, fleet, driver, context, rng):
+    vendor = driver.vendor
+    member = rng.choice(fleet)
+    if kind == 'lookup_mac':
+        return lambda: vendor.driver_vendor_passthru(
+            context, 'lookup', hardware=_hardware(member['macs']))
+    if kind == 'lookup_serial':
+        return lambda: vendor.driver_vendor_passthru(
+            context, 'lookup',
+            hardware=_hardware(member['macs'][:1], member['serial']))
+    if kind == 'lookup_unknown':
+        macs = [_mac(0x0400000000 + rng.randint(0, 1 << 24))
+                for _ in range(rng.randint(1, 4))]
+
+        def lookup_unknown():
+            try:
+                vendor.driver_vendor_passthru(context, 'lookup',
+                                              hardware=_hardware(macs))
+            except exception.NotFound:
+                pass
+        return lookup_unknown
+
+    def heartbeat():
+        node = node_object.Node.get_by_uuid(context, member['uuid'])
+        vendor.vendor_passthru(context, node, method='heartbeat',
+                               agent_url=member['agent_url'])
+    return heartbeat
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in KINDS:
+            raise ValueError('Unknown call kind {0}'.format(kind))
+        weights[kind] = int(weight)
+    return weights
+
+
+def report(name, latencies, queries, elapsed):
+    latencies.sort()
+    count = len(latencies)
+    print('{0:<16} {1:>7} {2:>9.1f} {3:>8.2f} {4:>8.2f} {5:>8.2f} '
+          '{6:>9.2f}'.format(
+              name, count, count / elapsed if elapsed else 0,
+              timeline.percentile(latencies, 50) * 1000,
+              timeline.percentile(latencies, 90) * 1000,
+              timeline.percentile(latencies, 99) * 1000,
+              float(queries) / count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark lookup and heartbeat against a synthetic '
+                    'fleet in SQLite.')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--max-nics', type=int, default=4,
+                        help='Nodes have between 1 and this many NICs.')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Relative weights of each kind of call.')
+    parser.add_argument('--db', help='SQLite file to use. Reused if it '
+                                     'exists; a temporary one by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    weights = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp()
+    try:
+        db = args.db or os.path.join(workdir, 'ironic.sqlite')
+        exists = os.path.exists(db)
+        CONF.set_override('connection', 'sqlite:///' + db, group='database')
+        CONF.set_override('blob_store_dir', os.path.join(workdir, 'blobs'),
+                          group='teeth_driver')
+        engine = db_session.get_engine()
+
+        start = time.time()
+        if exists:
+            print('Reusing {0}; --nodes and --max-nics are ignored.'.format(
+                db))
+            fleet = [{'uuid': row.uuid,
+                      'serial': row.properties.get('system_serial'),
+                      'agent_url': row.driver_info.get('agent_url'),
+                      'macs': []}
+                     for row in db_session.get_session().query(models.Node)]
+            by_id = {}
+            for node_uuid, address in engine.execute(
+                    'SELECT nodes.uuid, ports.address FROM ports JOIN nodes '
+                    'ON ports.node_id = nodes.id'):
+                by_id.setdefault(node_uuid, []).append(address)
+            for member in fleet:
+                member['macs'] = by_id.get(member['uuid'], [])
+            fleet = [member for member in fleet if member['macs']]
+        else:
+            fleet = build_fleet(engine, args.nodes, args.max_nics, rng)
+        print('Fleet of {0} nodes ready in {1:.1f}s'.format(
+            len(fleet), time.time() - start))
+
+        driver = ironic_teeth_driver.TeethDriver()
+        context = BenchTask(driver)
+        counter = QueryCounter(engine)
+
+        # The first lookup builds the in-memory hardware index.
+        counter.count = 0
+        start = time.time()
+        make_call('lookup_serial', fleet, driver, context, rng)()
+        print('Warm-up lookup: {0:.1f} ms, {1} queries'.format(
+            (time.time() - start) * 1000, counter.count))
+
+        kinds = []
+        for kind, weight in sorted(weights.items()):
+            kinds.extend([kind] * weight)
+        latencies = dict((kind, []) for kind in weights)
+        queries = dict((kind, 0) for kind in weights)
+        busy = dict((kind, 0.0) for kind in weights)
+        start = time.time()
+        for _ in range(args.calls):
+            kind = rng.choice(kinds)
+            call = make_call(kind, fleet, driver, context, rng)
+            before = counter.count
+            call_start = time.time()
+            call()
+            latency = time.time() - call_start
+            latencies[kind].append(latency)
+            busy[kind] += latency
+            queries[kind] += counter.count - before
+        elapsed = time.time() - start
+
+        print('{0:<16} {1:>7} {2:>9} {3:>8} {4:>8} {5:>8} {6:>9}'.format(
+            'call', 'count', 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms',
+            'queries'))
+        for kind in KINDS:
+            if latencies.get(kind):
+                # Per kind rates are over the time spent in that kind.
+                report(kind, latencies[kind], queries[kind], busy[kind])
+        all_latencies = []
+        for kind_latencies in latencies.values():
+            all_latencies.extend(kind_latencies)
+        report('all', all_latencies, sum(queries.values()), elapsed)
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
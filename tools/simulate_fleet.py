@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""
+Copyright 2014 Rackspace, Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Simulate one conductor running the teeth driver for a fleet of nodes
+which are deployed, kept active, torn down, decommissioned and returned
+to standby, over and over.
+
+The real TeethDriver code runs for every deploy, tear_down, lookup and
+heartbeat. Fake agents answer its HTTP requests and a fake power interface
+stands in for IPMIPower. Time is simulated: agent commands, reboots and
+dwell times take as long as configured, and the driver's caches expire
+on the simulated clock. Each driver call occupies one
+of the conductor's workers for the CPU time it really took plus the
+configured agent round trips and power action time. Calls queue for a
+free worker, and calls on the same node wait for each other, as they
+would for the node lock.
+
+    python tools/simulate_fleet.py --nodes 2000 --hours 24 --workers 64
+
+Reports deploys per hour, worker utilization and queueing, and database
+and agent operations per node lifecycle. Database operations are modeled
+as what Ironic does for these calls: one node read and two writes
+(reserve, release) per locked task, plus each save and lookup.
+"""
+import argparse
+import heapq
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+from oslo.config import cfg
+
+from ironic.common import exception
+from ironic.common import states
+
+import ironic_teeth_driver
+from ironic_teeth_driver import power
+from ironic_teeth_driver import rest
+from ironic_teeth_driver import swarm
+from ironic_teeth_driver import timeline
+
+CONF = cfg.CONF
+
+# What the simulated clock reads at the start of the simulation.
+EPOCH = 1400000000.0
+
+COMMAND_DURATIONS = {
+    'standby.prepare_image': 'prepare_time',
+    'standby.run_image': 'run_time',
+    'decom.secure_drives': 'secure_time',
+    'decom.erase_drives': 'erase_time',
+}
+
+
+class SimClock(object):
+    """Stands in for the time module of the driver modules whose caches
+    expire, so their TTLs follow simulated time.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+
+    def time(self):
+        return EPOCH + self.sim.now
+
+    def sleep(self, seconds):
+        self.sim.charge(seconds)
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200):
+        self.text = json.dumps(data)
+        self.status_code = status_code
+
+
+class FakeAgent(object):
+    """An agent, as seen through its REST API."""
+    def __init__(self, sim, node):
+        self.sim = sim
+        self.node = node
+        self.commands = {}
+        self.next_id = 0
+
+    def reboot(self):
+        self.commands = {}
+
+    def _start(self, name, start):
+        self.next_id += 1
+        duration = getattr(self.sim.args, COMMAND_DURATIONS[name])
+        failed = self.sim.rng.random() < self.sim.args.command_failure_rate
+        command = {
+            'id': '{0}-{1}'.format(self.node.uuid, self.next_id),
+            'command_name': name,
+            'start': start,
+            'done_at': start + duration,
+            'failed': failed,
+        }
+        self.commands[command['id']] = command
+        return command
+
+    def _result(self, command):
+        now = self.sim.now
+        result = {
+            'id': command['id'],
+            'command_name': command['command_name'],
+            'command_status': 'RUNNING',
+            'command_error': None,
+            'command_result': None,
+        }
+        if now >= command['done_at']:
+            if command['failed']:
+                result['command_status'] = 'FAILED'
+                result['command_error'] = 'Simulated failure'
+            else:
+                result['command_status'] = 'SUCCEEDED'
+        elif (command['command_name'] == 'decom.erase_drives' and
+                command['done_at'] > command['start']):
+            span = command['done_at'] - command['start']
+            done = max(now - command['start'], 0.0) / span
+            result['command_result'] = {'progress': dict(
+                (drive, done) for drive in self.sim.drives)}
+        return result
+
+    def results(self):
+        return [self._result(command) for command in self.commands.values()]
+
+    def handle(self, method, path, data):
+        if method == 'GET' and path == '/':
+            return FakeResponse({'versions': [{'id': 'v1.0'}],
+                                 'capabilities': ['batch']})
+        if method == 'GET' and path.startswith('/v1.0/commands/'):
+            command = self.commands.get(path.rsplit('/', 1)[-1])
+            if command is None:
+                return FakeResponse({}, 404)
+            return FakeResponse(self._result(command))
+        if method == 'POST' and path == '/v1.0/commands':
+            body = json.loads(data)
+            return FakeResponse(self._result(self._start(body['name'],
+                                                         self.sim.now)))
+        if method == 'POST' and path == '/v1.0/commands/batch':
+            body = json.loads(data)
+            results = []
+            start = self.sim.now
+            failed = False
+            for item in body['commands']:
+                command = self._start(item['name'], start)
+                if failed:
+                    command['failed'] = True
+                    command['done_at'] = start
+                failed = failed or command['failed']
+                start = command['done_at']
+                results.append(self._result(command))
+            return FakeResponse({'results': results})
+        return FakeResponse({}, 404)
+
+
+class FakeSession(object):
+    """Routes the REST client's requests to the fake agents."""
+    def __init__(self, sim):
+        self.sim = sim
+
+    def _request(self, method, url, data=None):
+        self.sim.charge(self.sim.args.agent_rtt / 1000.0)
+        self.sim.counters['agent_requests'] += 1
+        host = url.split('://', 1)[1].split('/', 1)
+        agent = self.sim.agents[host[0]]
+        return agent.handle(method, '/' + (host[1] if len(host) > 1 else ''),
+                            data)
+
+    def get(self, url, **kwargs):
+        return self._request('GET', url)
+
+    def post(self, url, data=None, **kwargs):
+        return self._request('POST', url, data)
+
+
+class FakePower(object):
+    """Stands in for ipmitool.IPMIPower."""
+    def __init__(self, sim):
+        self.sim = sim
+
+    def reboot(self, task, node):
+        self.sim.charge(self.sim.args.power_time)
+        self.sim.counters['power_actions'] += 1
+        if self.sim.rng.random() < self.sim.args.power_failure_rate:
+            self.sim.counters['power_failures'] += 1
+            raise exception.IronicException('Simulated power failure')
+        self.sim.agents[self.sim.hosts[node.uuid]].reboot()
+        # The running agent, if any, stops heartbeating.
+        node.boots += 1
+        self.sim.schedule(self.sim.args.boot_time, 'lookup', node)
+
+
+class SimNode(object):
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.uuid = 'node-{0:06d}'.format(index)
+        self.provision_state = states.NOSTATE
+        self.target_provision_state = states.NOSTATE
+        self.last_error = None
+        self.driver_info = {'agent_url': 'http://agent-{0}:9999'.format(
+            index)}
+        self.instance_info = {}
+        self.properties = {}
+        self.extra = {}
+        self.macs = ['02:00:{0:02x}:{1:02x}:{2:02x}:01'.format(
+            index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff)]
+        self.busy_until = 0.0
+        # Heartbeats are only sent by the agent of the current boot.
+        self.boots = 0
+
+    def save(self, context=None):
+        self.sim.counters['db_writes'] += 1
+
+
+class SimTask(object):
+    def __init__(self, driver, node):
+        self.driver = driver
+        self.node = node
+        self.context = {}
+
+
+class Simulation(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.workers = [0.0] * args.workers
+        self.io_cost = 0.0
+        self.clock = SimClock(self)
+        self.drives = ['/dev/sd{0}'.format(chr(ord('a') + i))
+                       for i in range(args.drives)]
+        self.counters = dict((name, 0) for name in (
+            'deploys', 'deploy_failures', 'decoms', 'decom_failures',
+            'power_actions', 'power_failures', 'agent_requests',
+            'db_reads', 'db_writes', 'lifecycles'))
+        self.jobs = {}
+        self.waits = []
+        self.busy = 0.0
+
+        self.driver = ironic_teeth_driver.TeethDriver()
+        self.driver.power = FakePower(self)
+        rest.get_client().session = FakeSession(self)
+        self.driver.vendor._find_node_by_hardware = self._find_node
+
+        self.nodes = [SimNode(self, i) for i in range(args.nodes)]
+        self.by_mac = {}
+        self.agents = {}
+        self.hosts = {}
+        for node in self.nodes:
+            host = node.driver_info['agent_url'].split('://', 1)[1]
+            self.agents[host] = FakeAgent(self, node)
+            self.hosts[node.uuid] = host
+            for mac in node.macs:
+                self.by_mac[mac] = node
+            # Nodes start in standby, and are deployed at random times.
+            self.schedule(self.rng.uniform(0, args.idle_time), 'deploy',
+                          node)
+            self.schedule(self.rng.uniform(0, args.heartbeat_interval),
+                          'heartbeat', node)
+
+    def charge(self, seconds):
+        """Account for time the current call spends waiting on I/O."""
+        self.io_cost += seconds
+
+    def schedule(self, delay, kind, node):
+        self.seq += 1
+        heapq.heappush(self.events, (self.now + delay, self.seq, kind, node,
+                                     node.boots))
+
+    def _find_node(self, context, keys):
+        self.counters['db_reads'] += 1
+        for key_type, value in keys:
+            if value in self.by_mac:
+                return self.by_mac[value]
+        raise exception.NotFound('No node with those MACs')
+
+    def run(self):
+        end = self.args.hours * 3600
+        while self.events and self.events[0][0] < end:
+            at, _, kind, node, boots = heapq.heappop(self.events)
+            if kind == 'heartbeat' and boots != node.boots:
+                continue
+            worker = self.workers.index(min(self.workers))
+            start = max(at, self.workers[worker], node.busy_until)
+            self.now = start
+            self.io_cost = 0.0
+            real_start = time.time()
+            getattr(self, '_' + kind)(node)
+            cost = time.time() - real_start + self.io_cost
+            self.workers[worker] = start + cost
+            node.busy_until = start + cost
+            self.busy += cost
+            self.waits.append(start - at)
+            stats = self.jobs.setdefault(kind, [0, 0.0])
+            stats[0] += 1
+            stats[1] += cost
+        return end
+
+    def _task(self, node):
+        # Acquiring a task reads the node and reserves it, releasing it
+        # clears the reservation.
+        self.counters['db_reads'] += 1
+        self.counters['db_writes'] += 2
+        return SimTask(self.driver, node)
+
+    def _deploy(self, node):
+        if node.provision_state != states.NOSTATE:
+            self.schedule(self.args.idle_time, 'deploy', node)
+            return
+        task = self._task(node)
+        node.instance_info = {
+            'image_info': {'image_id': 'image-{0}'.format(
+                self.rng.randint(1, self.args.images))},
+            'metadata': {},
+            'files': {},
+        }
+        node.provision_state = self.driver.deploy.deploy(task, node)
+        node.target_provision_state = states.ACTIVE
+        node.save(task)
+
+    def _tear_down(self, node):
+        task = self._task(node)
+        try:
+            node.provision_state = self.driver.deploy.tear_down(task, node)
+        except exception.IronicException:
+            node.provision_state = states.ERROR
+            self.schedule(self.args.repair_time, 'repair', node)
+        node.target_provision_state = states.NOSTATE
+        node.save(task)
+
+    def _repair(self, node):
+        """An operator fixes the node and boots it back into standby."""
+        task = self._task(node)
+        node.instance_info = {}
+        node.provision_state = states.NOSTATE
+        node.target_provision_state = states.NOSTATE
+        node.save(task)
+        self.agents[self.hosts[node.uuid]].reboot()
+        node.boots += 1
+        self.schedule(self.args.boot_time, 'lookup', node)
+        self.schedule(self.args.boot_time + self.args.idle_time, 'deploy',
+                      node)
+
+    def _lookup(self, node):
+        self.driver.vendor.driver_vendor_passthru(
+            {}, 'lookup',
+            hardware=[{'type': 'mac_address', 'id': mac}
+                      for mac in node.macs])
+        self.schedule(self.args.heartbeat_interval, 'heartbeat', node)
+
+    def _heartbeat(self, node):
+        task = self._task(node)
+        agent = self.agents[self.hosts[node.uuid]]
+        previous = node.provision_state
+        self.driver.vendor.vendor_passthru(
+            task, node, method='heartbeat',
+            agent_url=node.driver_info['agent_url'],
+            commands=agent.results(), drives=self.drives)
+
+        if previous == states.DEPLOYING and node.provision_state != previous:
+            if node.provision_state == states.ACTIVE:
+                self.counters['deploys'] += 1
+                # The agent is gone once the instance runs.
+                node.boots += 1
+                self.schedule(self.args.active_time, 'tear_down', node)
+                return
+            self.counters['deploy_failures'] += 1
+            self.schedule(self.args.repair_time, 'tear_down', node)
+        elif previous == states.DELETING and node.provision_state != previous:
+            if node.provision_state == states.NOSTATE:
+                self.counters['decoms'] += 1
+                self.counters['lifecycles'] += 1
+                self.schedule(self.args.idle_time, 'deploy', node)
+            else:
+                self.counters['decom_failures'] += 1
+                node.boots += 1
+                self.schedule(self.args.repair_time, 'repair', node)
+                return
+        self.schedule(self.args.heartbeat_interval, 'heartbeat', node)
+
+
+def _percentile(values, pct):
+    return timeline.percentile(sorted(values), pct) or 0.0
+
+
+def report(sim, duration):
+    args = sim.args
+    hours = duration / 3600.0
+    counters = sim.counters
+    utilization = sim.busy / (args.workers * duration)
+    lifecycles = max(counters['lifecycles'], 1)
+    print('Simulated {0} nodes for {1:.1f} hours with {2} workers'.format(
+        args.nodes, hours, args.workers))
+    print('')
+    print('deploys/hour:            {0:.1f}'.format(
+        counters['deploys'] / hours))
+    if utilization > 0:
+        print('deploys/hour at 100%:    {0:.1f} (linear estimate)'.format(
+            counters['deploys'] / hours / utilization))
+    print('deploys / failed:        {0} / {1}'.format(
+        counters['deploys'], counters['deploy_failures']))
+    print('decoms / failed:         {0} / {1}'.format(
+        counters['decoms'], counters['decom_failures']))
+    print('power actions / failed:  {0} / {1}'.format(
+        counters['power_actions'], counters['power_failures']))
+    print('worker utilization:      {0:.1%}'.format(utilization))
+    print('queue wait p50/p99/max:  {0:.3f}s / {1:.3f}s / {2:.3f}s'.format(
+        _percentile(sim.waits, 50), _percentile(sim.waits, 99),
+        max(sim.waits) if sim.waits else 0.0))
+    if _percentile(sim.waits, 99) > args.heartbeat_interval:
+        print('WARNING: calls wait longer than the heartbeat interval, the '
+              'conductor is saturated.')
+    print('')
+    print('per completed lifecycle ({0}):'.format(counters['lifecycles']))
+    print('  db reads:              {0:.1f}'.format(
+        counters['db_reads'] / float(lifecycles)))
+    print('  db writes:             {0:.1f}'.format(
+        counters['db_writes'] / float(lifecycles)))
+    print('  agent requests:        {0:.1f}'.format(
+        counters['agent_requests'] / float(lifecycles)))
+    print('')
+    print('{0:<12} {1:>9} {2:>12}'.format('call', 'count', 'mean cost ms'))
+    for kind, (count, cost) in sorted(sim.jobs.items()):
+        print('{0:<12} {1:>9} {2:>12.2f}'.format(kind, count,
+                                                  cost / count * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a conductor driving a fleet through deploy, '
+                    'tear_down and decom.')
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--workers', type=int, default=64,
+                        help='Conductor worker threads.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--images', type=int, default=5,
+                        help='Number of distinct images deployed.')
+    parser.add_argument('--drives', type=int, default=2,
+                        help='Drives erased per node.')
+    timing = parser.add_argument_group('timings, in seconds')
+    timing.add_argument('--heartbeat-interval', type=float, default=200)
+    timing.add_argument('--boot-time', type=float, default=180)
+    timing.add_argument('--prepare-time', type=float, default=300)
+    timing.add_argument('--run-time', type=float, default=10)
+    timing.add_argument('--secure-time', type=float, default=30)
+    timing.add_argument('--erase-time', type=float, default=1800)
+    timing.add_argument('--active-time', type=float, default=4 * 3600)
+    timing.add_argument('--idle-time', type=float, default=1800)
+    timing.add_argument('--repair-time', type=float, default=3600)
+    timing.add_argument('--power-time', type=float, default=2.0,
+                        help='Time a power action keeps a worker busy.')
+    timing.add_argument('--agent-rtt', type=float, default=5.0,
+                        help='Round trip to an agent, in milliseconds.')
+    failures = parser.add_argument_group('failure rates, from 0 to 1')
+    failures.add_argument('--command-failure-rate', type=float,
+                          default=0.01)
+    failures.add_argument('--power-failure-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    CONF.set_override('blob_store_dir', workdir, group='teeth_driver')
+    # Power actions take simulated time, not real time.
+    CONF.set_override('bmc_min_interval', 0, group='teeth_driver')
+    CONF.set_override('power_action_retries', 0, group='teeth_driver')
+
+    def node_power_action(task, node, new_state):
+        task.driver.power.reboot(task, node)
+
+    try:
+        sim = Simulation(args)
+        patchers = [mock.patch.object(power.manager_utils,
+                                      'node_power_action',
+                                      node_power_action)]
+        for module in (power, rest, swarm):
+            patchers.append(mock.patch.object(module, 'time', sim.clock))
+        for patcher in patchers:
+            patcher.start()
+        try:
+            duration = sim.run()
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+        report(sim, duration)
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())